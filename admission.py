@@ -0,0 +1,448 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import ipaddress
+import threading
+import contextvars
+from collections import OrderedDict, deque
+import metrics
+from shared_state import shared_state
+
+# Admission control in front of the model calls.
+# Nothing used to bound how many Vertex streams ran at once, so a spike or one heavy client
+# pushed everyone into quota errors that only surfaced mid-stream. Requests now take a ticket
+# before calling the model: global and per-model concurrency limits, a token bucket per client,
+# and a bounded wait queue served round-robin across clients (chat before titles). When the
+# queue is full or a client is over its rate, the request is rejected up front with 429 and
+# Retry-After instead of failing later. Under several worker processes the token buckets live in
+# shared_state so a client has one budget per host; concurrency limits and queues stay per worker.
+# Clients are keyed by peer address. Behind a reverse proxy every request would share the proxy's
+# bucket, so list the proxies in TRUSTED_PROXIES: for those peers (and only those, since anyone
+# can send X-Forwarded-For) the client is the right-most forwarded hop that is not itself a proxy.
+
+ADMISSION_ENABLED = os.getenv("ADMISSION", "1") != "0"
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))
+# Per-model limits, e.g. "gemini-2.0-flash-001=48,gemini-2.0-flash-lite-001=16"
+ADMISSION_MODEL_LIMITS = os.getenv("ADMISSION_MODEL_LIMITS", "")
+ADMISSION_DEFAULT_MODEL_LIMIT = int(os.getenv("ADMISSION_DEFAULT_MODEL_LIMIT", "0"))  # 0: only the global limit
+ADMISSION_QUEUE_MAX = int(os.getenv("ADMISSION_QUEUE_MAX", "256"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "15"))
+# Token bucket per client: sustained requests per second and burst size (rate 0 disables).
+ADMISSION_CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "1"))
+ADMISSION_CLIENT_BURST = int(os.getenv("ADMISSION_CLIENT_BURST", "20"))
+ADMISSION_MAX_CLIENTS = int(os.getenv("ADMISSION_MAX_CLIENTS", "10000"))
+# Reverse proxies whose X-Forwarded-For is believed: comma-separated addresses or CIDRs,
+# e.g. "10.0.0.0/8,127.0.0.1".
+TRUSTED_PROXIES = os.getenv("TRUSTED_PROXIES", "")
+
+PRIORITY_CHAT = 0
+PRIORITY_TITLE = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_TITLE: "title", PRIORITY_BATCH: "batch"}
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_limits(spec: str):
+    limits = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip().isdigit():
+            limits[name.strip()] = int(value)
+    return limits
+
+
+def _parse_networks(spec: str):
+    """Parses comma-separated addresses and CIDRs; malformed entries are logged and skipped."""
+    networks = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.warning("Ignoring malformed TRUSTED_PROXIES entry: %s", item)
+    return networks
+
+
+_trusted_proxies = _parse_networks(TRUSTED_PROXIES)
+if os.getenv("ADMISSION_TRUST_FORWARDED") == "1" and not _trusted_proxies:
+    logger.warning("ADMISSION_TRUST_FORWARDED is no longer read; list your reverse proxies in TRUSTED_PROXIES")
+
+
+def _is_trusted_proxy(address: str, proxies):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in proxies)
+
+
+def client_id_from(headers, remote_addr: str, trusted_proxies: list = None):
+    """
+    Identifies the client for rate limiting and fair queueing.
+
+    Args:
+        headers: The request headers.
+        remote_addr (str): The peer address of the connection.
+        trusted_proxies (list, optional): ip_network objects; defaults to TRUSTED_PROXIES.
+
+    Returns:
+        str: For a trusted proxy, the right-most X-Forwarded-For hop that is not a trusted
+            proxy; otherwise the peer address, whatever X-Forwarded-For says.
+    """
+    proxies = _trusted_proxies if trusted_proxies is None else trusted_proxies
+    if not remote_addr:
+        return "unknown"
+    if not _is_trusted_proxy(remote_addr, proxies):
+        return remote_addr
+    hops = [hop.strip() for hop in headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    # Hops are appended left to right, so only those added by trusted proxies can be believed.
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop, proxies):
+            return hop
+    return hops[0] if hops else remote_addr
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted; maps to HTTP 429 with Retry-After."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Server is busy ({reason}); retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {"error": str(self), "code": self.reason, "retry_after": self.retry_after}
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, now: float):
+        """Takes one token; returns 0 on success or the seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("client", "model", "priority", "enqueued_at", "granted", "event", "future", "loop")
+
+    def __init__(self, client, model, priority, loop=None):
+        self.client = client
+        self.model = model
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def grant(self):
+        self.granted = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+        else:
+            self.event.set()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class Ticket:
+    """An admitted request's slot; release() it exactly when the model call is over."""
+
+    def __init__(self, controller, model: str, priority: int, waited: float):
+        self._controller = controller
+        self.model = model
+        self.priority = priority
+        self.waited = waited
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __del__(self):
+        # Safety net for responses that were never iterated (so their cleanup never ran).
+        self.release()
+
+
+class AdmissionController:
+    """Concurrency limits, per-client rate limits and a fair bounded queue for model calls."""
+
+    def __init__(self, max_concurrent: int = ADMISSION_MAX_CONCURRENT, model_limits: dict = None,
+                 default_model_limit: int = ADMISSION_DEFAULT_MODEL_LIMIT, queue_max: int = ADMISSION_QUEUE_MAX,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS, client_rate: float = ADMISSION_CLIENT_RATE,
+                 client_burst: int = ADMISSION_CLIENT_BURST, enabled: bool = ADMISSION_ENABLED):
+        self.max_concurrent = max(1, max_concurrent)
+        self.model_limits = model_limits if model_limits is not None else _parse_limits(ADMISSION_MODEL_LIMITS)
+        self.default_model_limit = default_model_limit
+        self.queue_max = max(0, queue_max)
+        self.queue_timeout = queue_timeout
+        self.client_rate = client_rate
+        self.client_burst = max(1, client_burst)
+        self.enabled = enabled
+        # Reentrant: Ticket.__del__ may release from a GC pass on a thread that holds the lock.
+        self._lock = threading.RLock()
+        self._in_flight = 0
+        self._in_flight_by_model = {}
+        # priority -> client -> deque of waiters; clients are served round-robin within a priority.
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._queued = 0
+        self._buckets = OrderedDict()
+        self._average_hold = 1.0
+        self.admitted = 0
+        self.rejected = {}
+
+    # --- Capacity -------------------------------------------------------------------------
+
+    def _model_limit(self, model: str):
+        return self.model_limits.get(model, self.default_model_limit)
+
+    def _has_capacity_locked(self, model: str):
+        if self._in_flight >= self.max_concurrent:
+            return False
+        limit = self._model_limit(model)
+        return not limit or self._in_flight_by_model.get(model, 0) < limit
+
+    def _take_slot_locked(self, model: str):
+        self._in_flight += 1
+        self._in_flight_by_model[model] = self._in_flight_by_model.get(model, 0) + 1
+        self.admitted += 1
+
+    def _rate_limit_locked(self, client: str, now: float):
+        if self.client_rate <= 0:
+            return 0.0
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.client_rate, self.client_burst, now)
+            while len(self._buckets) > ADMISSION_MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return bucket.take(now)
+
+    def _reject_locked(self, reason: str, retry_after: float):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        logger.warning("Admission rejected: %s", reason, extra={"in_flight": self._in_flight, "queued": self._queued})
+        metrics.ADMISSION_REJECTED.labels(reason).inc()
+        return AdmissionRejected(reason, max(1, math.ceil(retry_after)))
+
+    def _queue_retry_after_locked(self):
+        # Roughly how long until the queue ahead of a new request drains.
+        return self._average_hold * (self._queued + 1) / self.max_concurrent
+
+    # --- Queue ----------------------------------------------------------------------------
+
+    def _enqueue_locked(self, waiter: _Waiter):
+        self._queues[waiter.priority].setdefault(waiter.client, deque()).append(waiter)
+        self._queued += 1
+        metrics.ADMISSION_QUEUE_DEPTH.set(self._queued)
+
+    def _remove_locked(self, waiter: _Waiter):
+        clients = self._queues[waiter.priority]
+        waiters = clients.get(waiter.client)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del clients[waiter.client]
+            self._queued -= 1
+            metrics.ADMISSION_QUEUE_DEPTH.set(self._queued)
+
+    def _dispatch_locked(self):
+        """Grants free slots to queued waiters: higher priority first, round-robin across clients."""
+        while self._queued and self._in_flight < self.max_concurrent:
+            granted = False
+            for priority in sorted(self._queues):
+                clients = self._queues[priority]
+                for client in list(clients):
+                    waiters = clients[client]
+                    waiter = waiters[0]
+                    if not self._has_capacity_locked(waiter.model):
+                        continue
+                    waiters.popleft()
+                    if waiters:
+                        clients.move_to_end(client)
+                    else:
+                        del clients[client]
+                    self._queued -= 1
+                    self._take_slot_locked(waiter.model)
+                    waiter.grant()
+                    granted = True
+                    break
+                if granted:
+                    break
+            if not granted:
+                break  # Every queued waiter is blocked on a per-model limit.
+        metrics.ADMISSION_QUEUE_DEPTH.set(self._queued)
+
+    # --- Acquire / release ----------------------------------------------------------------
+
+    def _admit_or_enqueue(self, client: str, model: str, priority: int, consume: bool, loop=None):
+        """Returns a Ticket when admitted immediately, otherwise the queued _Waiter."""
+        now = time.monotonic()
+        if consume and self._shared_buckets():
+            self._take_shared_token(client)
+            consume = False
+        with self._lock:
+            if consume:
+                retry_after = self._rate_limit_locked(client, now)
+                if retry_after:
+                    raise self._reject_locked("client_rate_limited", retry_after)
+            if not self._queued and self._has_capacity_locked(model):
+                self._take_slot_locked(model)
+                return self._ticket(model, priority, 0.0)
+            if self._queued >= self.queue_max:
+                raise self._reject_locked("queue_full", self._queue_retry_after_locked())
+            waiter = _Waiter(client, model, priority, loop)
+            self._enqueue_locked(waiter)
+            self._dispatch_locked()
+            return waiter
+
+    def _shared_buckets(self):
+        return shared_state.enabled and self.client_rate > 0
+
+    def _take_shared_token(self, client: str):
+        """Takes one token from the client's host-wide bucket; raises AdmissionRejected when it is empty."""
+        retry_after = shared_state.take_token(client, self.client_rate, self.client_burst)
+        if retry_after:
+            with self._lock:
+                raise self._reject_locked("client_rate_limited", retry_after)
+
+    def _ticket(self, model, priority, waited):
+        metrics.ADMISSION_WAIT.labels(PRIORITY_NAMES.get(priority, str(priority))).observe(waited)
+        metrics.ADMISSION_IN_FLIGHT.set(self._in_flight)
+        return Ticket(self, model, priority, waited)
+
+    def _give_up(self, waiter: _Waiter):
+        """Called when a queued waiter stops waiting; returns a Ticket if it was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return self._ticket(waiter.model, waiter.priority, time.monotonic() - waiter.enqueued_at)
+            self._remove_locked(waiter)
+            return None
+
+    def acquire(self, client: str, model: str, priority: int = PRIORITY_CHAT, timeout: float = None, consume: bool = True):
+        """
+        Blocks until the request may call the model.
+
+        Args:
+            client (str): Client id used for the token bucket and fair queueing.
+            model (str): Model the request will call (per-model limits).
+            priority (int): PRIORITY_CHAT, PRIORITY_TITLE or PRIORITY_BATCH; lower values are served first.
+            timeout (float, optional): Maximum queue wait; defaults to ADMISSION_QUEUE_TIMEOUT_SECONDS.
+            consume (bool): Take a token from the client's bucket (False for follow-up work).
+
+        Returns:
+            Ticket: Release it when the model call is over.
+
+        Raises:
+            AdmissionRejected: Rate limited, queue full, or queue wait timed out.
+        """
+        if not self.enabled:
+            return _NullTicket()
+        result = self._admit_or_enqueue(client, model, priority, consume)
+        if isinstance(result, Ticket):
+            return result
+        result.event.wait(self.queue_timeout if timeout is None else timeout)
+        return self._finish_wait(result)
+
+    async def acquire_async(self, client: str, model: str, priority: int = PRIORITY_CHAT, timeout: float = None, consume: bool = True):
+        """Async counterpart of acquire that waits on the event loop instead of a thread."""
+        if not self.enabled:
+            return _NullTicket()
+        loop = asyncio.get_running_loop()
+        if consume and self._shared_buckets():
+            # shared_state is SQLite, so the host-wide bucket is read off the event loop.
+            await loop.run_in_executor(None, contextvars.copy_context().run, self._take_shared_token, client)
+            consume = False
+        result = self._admit_or_enqueue(client, model, priority, consume, loop)
+        if isinstance(result, Ticket):
+            return result
+        try:
+            await asyncio.wait({result.future}, timeout=self.queue_timeout if timeout is None else timeout)
+        except asyncio.CancelledError:
+            ticket = self._give_up(result)
+            if ticket is not None:
+                ticket.release()
+            raise
+        return self._finish_wait(result)
+
+    def _finish_wait(self, waiter: _Waiter):
+        ticket = self._give_up(waiter)
+        if ticket is not None:
+            return ticket
+        with self._lock:
+            raise self._reject_locked("queue_timeout", self._queue_retry_after_locked())
+
+    def _release(self, ticket: Ticket):
+        with self._lock:
+            self._in_flight -= 1
+            count = self._in_flight_by_model.get(ticket.model, 1) - 1
+            if count:
+                self._in_flight_by_model[ticket.model] = count
+            else:
+                self._in_flight_by_model.pop(ticket.model, None)
+            held = time.monotonic() - ticket.acquired_at
+            self._average_hold += 0.1 * (held - self._average_hold)
+            self._dispatch_locked()
+            metrics.ADMISSION_IN_FLIGHT.set(self._in_flight)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "in_flight": self._in_flight,
+                "in_flight_by_model": dict(self._in_flight_by_model),
+                "max_concurrent": self.max_concurrent,
+                "queued": self._queued,
+                "queued_by_priority": {PRIORITY_NAMES[p]: sum(len(w) for w in clients.values()) for p, clients in self._queues.items()},
+                "queue_max": self.queue_max,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "average_hold_seconds": round(self._average_hold, 3),
+            }
+
+
+class _NullTicket:
+    """Ticket handed out when admission control is disabled."""
+
+    released = False
+    waited = 0.0
+
+    def release(self):
+        self.released = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+admission = AdmissionController()
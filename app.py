@@ -1,19 +1,78 @@
+import time
+_import_started = time.perf_counter()  # Import time is reported by /healthz to catch cold-start regressions
 import os
 import json  # Import json for SSE data formatting
-import traceback  # For detailed error logging
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+import logging
+import hashlib
+import asyncio
+import threading
+import contextvars
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, send_file
 from dotenv import load_dotenv
-from chatbot import get_gemini_response_stream, Content, Part  # Import necessary items
+from chatbot import (  # Import necessary items
+    get_gemini_response_stream, get_gemini_response_stream_async, warmup_chat_model, is_error_marker,
+    CHAT_GENERATION_CONFIG
+)
+from sessions import session_store, is_valid_conversation_id
+from context_window import context_manager, content_text, estimate_tokens
+from response_cache import response_cache, make_cache_key
+from chat_titles import title_service, title_key as title_key_for, CHAT_TITLE_STREAM_WAIT_SECONDS, TITLE_MAX_TURNS
+import metrics
+from coalescer import ChunkCoalescer, coalesce, acoalesce
+from disconnect import ClientDisconnectProbe, StreamCancellation, cancellable, cancellation_stats
+import app_logging
+import tracing
+from admission import admission, AdmissionRejected, client_id_from
+from stream_buffers import stream_registry, ResumeError, SSE_RESUME
+from single_flight import single_flight, flight_key as flight_key_for
+import compression
+from markdown_blocks import BlockStream, MARKDOWN_BLOCKS, RENDER_MODES
+import assets
+from batch_jobs import batch_runner, BatchError, BATCH_WORKERS
+from chat_store import chat_store, ChatStoreError, is_valid_library_id, CHAT_PAGE_SIZE, CHAT_MESSAGES_PAGE_SIZE
+from shared_state import shared_state
+from context_cache import context_cache
+from model_router import model_router, AUTO_MODEL
+from backends import get_backend
+import vertex_runtime
+from vertex_runtime import make_content
 
 # Load environment variables
 load_dotenv()
 
+app_logging.configure_logging()
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 # Default settings (cannot be changed by the user)
 DEFAULT_MODEL = os.getenv("DEFAULT_GEMINI_MODEL", "gemini-2.0-flash-001")
 DEFAULT_SYSTEM_INSTRUCTION = ""
 
+@app.context_processor
+def asset_helpers():
+    """Exposes asset_tags(group) to templates: built bundles, or the unbundled files without a build."""
+    return {"asset_tags": assets.asset_manifest.tags}
+
+@app.route('/assets/<path:filename>')
+def built_asset(filename):
+    """
+    Serves a file from the asset build.
+
+    Names carry a content hash, so responses are cacheable forever; the ETag still lets clients
+    revalidate, and a precompressed .br/.gz sibling is sent when the client accepts it.
+    """
+    found = assets.asset_manifest.resolve(filename, compression.accepted_encodings(request.headers.get('Accept-Encoding')))
+    if found is None:
+        return jsonify({"error": "Unknown asset"}), 404
+    path, encoding, etag, mimetype = found
+    response = send_file(path, mimetype=mimetype, etag=etag, max_age=assets.ASSETS_MAX_AGE_SECONDS, conditional=True)
+    response.headers['Cache-Control'] = f'public, max-age={assets.ASSETS_MAX_AGE_SECONDS}, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
 @app.route('/')
 def index():
     """Renders the main chat page."""
@@ -21,85 +80,751 @@ def index():
                            default_model=DEFAULT_MODEL,
                            default_system_instruction=DEFAULT_SYSTEM_INSTRUCTION)
 
+@app.before_request
+def bind_request_id():
+    """Tags every log record of the request with its id (taken from X-Request-Id when valid)."""
+    app_logging.bind_request_id(request.headers.get('X-Request-Id'))
+    # A server thread's context outlives its requests; routes that trace start their own.
+    tracing.bind(None)
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers.setdefault('X-Request-Id', app_logging.current_request_id() or '')
+    return response
+
+@app.after_request
+def compress_json_response(response):
+    """Compresses JSON bodies above COMPRESS_MIN_BYTES when the client accepts gzip or br."""
+    if (response.mimetype != 'application/json' or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.status_code < 200 or response.status_code in (204, 304)):
+        return response
+    body = response.get_data()
+    if len(body) < compression.COMPRESS_MIN_BYTES:
+        return response
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(compression.compress_body(body, encoding))
+        response.headers.update(compression.response_headers(encoding))
+    return response
+
+class ChatRequestError(ValueError):
+    """Raised when a /chat payload fails validation; carries the HTTP status to return."""
+
+    def __init__(self, message, status_code=400, code=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+    def to_dict(self):
+        body = {"error": str(self)}
+        if self.code:
+            body["code"] = self.code
+        return body
+
+
+class ChatRequest:
+    """
+    A validated /chat request plus the per-stream state shared by the sync and async views.
+
+    The views stream SSE frames from iter_frames()/aiter_frames() and call finish() once the
+    stream ends, so features that observe the answer (sessions, response cache, titles, ...)
+    hook in here rather than in each view.
+    """
+
+    def __init__(self, model_name, user_prompt, system_instruction, chat_history, session=None, announce_session=False,
+                 context_report=None, cache_key=None, title_key=None, title_future=None, flight_key=None,
+                 render_mode="text", route=None):
+        self.request_id = app_logging.current_request_id() or app_logging.new_request_id()
+        self.model_name = model_name
+        self.user_prompt = user_prompt
+        self.system_instruction = system_instruction
+        self.chat_history = chat_history
+        self.session = session
+        self.announce_session = announce_session
+        self.context_report = context_report
+        self.cache_key = cache_key
+        self.cached_chunks = response_cache.get(cache_key) if cache_key else None
+        self.cache_hit = False
+        self.completed = False
+        self.title_key = title_key
+        self.title_future = title_future
+        self._title_sent = False
+        self._parts = []
+        self.started_at = None
+        self.first_chunk_at = None
+        self.failed = False
+        self.coalescer = ChunkCoalescer()
+        self.cancellation = StreamCancellation()
+        self.disconnect_probe = None
+        self.admission_ticket = None
+        self.stream_buffer = None
+        self._producer_task = None
+        self.flight_key = flight_key
+        self.joined = False
+        self.render_mode = render_mode
+        self.block_stream = BlockStream() if render_mode == "blocks" else None
+        self.route = route
+        self.trace = tracing.current_trace()
+        self.stream_span = None
+        self._first_write_at = None
+        self._frames_written = 0
+        self._write_seconds = 0.0
+
+    def stream_kwargs(self):
+        """Keyword arguments for get_gemini_response_stream(_async)."""
+        return {
+            "model_name": self.model_name,
+            "user_prompt": self.user_prompt,
+            "system_instruction": self.system_instruction,
+            "chat_history": self.chat_history,
+            "stable_prefix": self.context_report.stable_prefix() if self.context_report else None,
+        }
+
+    def response_headers(self):
+        headers = {"X-Request-Id": self.request_id}
+        if self.trace is not None:
+            headers["X-Trace-Id"] = self.trace.trace_id
+        if self.session:
+            headers["X-Conversation-Id"] = self.session.conversation_id
+        if self.context_report:
+            headers.update(self.context_report.headers())
+        if self.cache_key:
+            headers["X-Cache"] = "HIT" if self.cached_chunks is not None else "MISS"
+        if self.title_key:
+            headers["X-Title-Key"] = self.title_key
+        if self.stream_buffer:
+            headers["X-Stream-Id"] = self.stream_buffer.stream_id
+        if self.joined:
+            headers["X-Single-Flight"] = "joined"
+        if self.block_stream is not None:
+            headers["X-Render-Mode"] = "blocks"
+        if self.route is not None:
+            headers["X-Model"] = self.model_name
+        return headers
+
+    def opening_frames(self):
+        """SSE frames sent before the first model chunk."""
+        # Lets the client quote the id (and the trace it is filed under) when it reports a slow reply.
+        yield format_sse({"request_id": self.request_id, "trace_id": self.trace.trace_id if self.trace else None},
+                         event='request')
+        if self.announce_session:
+            yield format_sse({"conversation_id": self.session.conversation_id}, event='conversation')
+        if self.route is not None:
+            yield format_sse(self.route.to_dict(), event='model')
+
+    def begin(self):
+        """Marks the stream as open; called when the first frame is requested."""
+        # Streaming can outlive the view that bound the id, so bind it again for the stream's own records.
+        app_logging.bind_request_id(self.request_id)
+        if self.trace is not None:
+            self.stream_span = self.trace.start_span("chat.stream", render_mode=self.render_mode)
+            tracing.bind(self.trace, self.stream_span)
+        self.started_at = time.perf_counter()
+        metrics.OPEN_STREAMS.inc()
+
+    def timed_frames(self, frames):
+        """Passes a response's frames through, timing how long each takes to write to the client."""
+        if self.trace is None:
+            yield from frames
+            return
+        for frame in frames:
+            started = time.perf_counter()
+            yield frame
+            self._record_write(time.perf_counter() - started)
+
+    async def atimed_frames(self, frames):
+        """Async counterpart of timed_frames."""
+        async for frame in frames:
+            started = time.perf_counter()
+            yield frame
+            if self.trace is not None:
+                self._record_write(time.perf_counter() - started)
+
+    def _record_write(self, seconds):
+        if self._first_write_at is None:
+            self._first_write_at = time.time() - seconds
+        self._frames_written += 1
+        self._write_seconds += seconds
+
+    def _record_chunk(self, chunk):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        self._parts.append(chunk)
+
+    def client_gone(self):
+        """True once the stream was cancelled or the probe saw the client disconnect."""
+        if not self.cancellation.cancelled and self.disconnect_probe and self.disconnect_probe.disconnected():
+            self.cancellation.cancel("client_disconnected")
+        return self.cancellation.cancelled
+
+    def iter_chunks(self):
+        """Yields the answer chunks, replaying a cached response when one exists."""
+        if self.cached_chunks is not None:
+            self.cache_hit = True
+            stream = response_cache.replay(self.cached_chunks)
+        else:
+            stream = get_gemini_response_stream(**self.stream_kwargs())
+        try:
+            for chunk in stream:
+                self._record_chunk(chunk)
+                if self.client_gone():
+                    return
+                yield chunk
+            self.completed = True
+        finally:
+            # Closing the generator chain cancels the upstream call instead of draining it.
+            stream.close()
+
+    async def aiter_chunks(self):
+        """Async counterpart of iter_chunks for the ASGI view."""
+        if self.cached_chunks is not None:
+            self.cache_hit = True
+            stream = response_cache.replay_async(self.cached_chunks)
+        else:
+            stream = get_gemini_response_stream_async(**self.stream_kwargs())
+        try:
+            async for chunk in cancellable(stream, self.cancellation):
+                self._record_chunk(chunk)
+                yield chunk
+            self.completed = not self.cancellation.cancelled
+        finally:
+            await stream.aclose()
+
+    def _title_frames(self):
+        """Emits the title event once the background title job has finished."""
+        if self.title_future is None or self._title_sent or not self.title_future.done():
+            return
+        self._title_sent = True
+        try:
+            title = self.title_future.result()
+        except Exception as e:
+            logger.warning("Error generating chat title: %s", e)
+            return
+        yield format_sse({"title": title, "title_key": self.title_key}, event='title')
+
+    def _answer_frames(self, text):
+        """SSE frames for one coalesced piece of answer text: a data frame, or block events in block mode."""
+        if self.block_stream is None:
+            yield format_sse(text)
+        elif is_error_marker(text):
+            # Markers stay plain data frames, sent once the blocks before them are final.
+            yield from self._block_frames(self.block_stream.finish())
+            yield format_sse(text)
+        else:
+            yield from self._block_frames(self.block_stream.feed(text))
+
+    def _block_frames(self, events):
+        for event, payload in events:
+            yield format_sse(payload, event=event)
+
+    def _closing_frames(self):
+        """Finalizes the last markdown block once the answer has ended."""
+        if self.block_stream is not None:
+            yield from self._block_frames(self.block_stream.finish())
+
+    def iter_frames(self):
+        """Yields every SSE frame of the response: events, answer chunks and the title."""
+        self.begin()
+        yield from self.opening_frames()
+        for text in coalesce(self.iter_chunks(), self.coalescer, is_error_marker):
+            yield from self._answer_frames(text)
+            yield from self._title_frames()
+        if self.client_gone():
+            return
+        yield from self._closing_frames()
+        if self.title_future is not None and not self._title_sent:
+            try:
+                self.title_future.result(timeout=CHAT_TITLE_STREAM_WAIT_SECONDS)
+            except Exception:
+                pass  # Still running: the client can fetch it from /name_chat/<title_key>.
+            yield from self._title_frames()
+
+    async def aiter_frames(self):
+        """Async counterpart of iter_frames for the ASGI view."""
+        self.begin()
+        for frame in self.opening_frames():
+            yield frame
+        async for text in acoalesce(self.aiter_chunks(), self.coalescer, is_error_marker):
+            for frame in self._answer_frames(text):
+                yield frame
+            for frame in self._title_frames():
+                yield frame
+        if self.cancellation.cancelled:
+            return
+        for frame in self._closing_frames():
+            yield frame
+        if self.title_future is not None and not self._title_sent:
+            try:
+                await asyncio.wait_for(asyncio.wrap_future(self.title_future), CHAT_TITLE_STREAM_WAIT_SECONDS)
+            except Exception:
+                pass
+            for frame in self._title_frames():
+                yield frame
+
+    def join_in_flight(self):
+        """
+        Attaches to an identical generation that is already running, if there is one.
+
+        Returns:
+            StreamBuffer: The shared stream, or None.
+        """
+        if self.cached_chunks is not None:
+            return None
+        self.stream_buffer = single_flight.join(self.flight_key)
+        self.joined = self.stream_buffer is not None
+        return self.stream_buffer
+
+    def _create_stream(self):
+        """Joins a running identical stream or registers a new one; True if this request must produce it."""
+        key = self.flight_key if self.cached_chunks is None else None
+        self.stream_buffer, leader = single_flight.acquire(key, lambda: stream_registry.create(self.cancellation.cancel))
+        if not leader:
+            # Another request got there first while this one was queued; its ticket is not needed.
+            self.joined = True
+            self.release_admission()
+        return leader
+
+    def start_producer(self):
+        """
+        Runs the stream in a background thread that writes its frames into a resumable buffer.
+
+        The response, and any reconnect, only reads from the returned buffer, so a dropped
+        connection no longer stops the generation; the buffer's grace window does.
+        """
+        if self._create_stream():
+            if self.coalescer.enabled and self.coalescer.max_delay:
+                self.stream_buffer.flusher = self.flush_due
+            threading.Thread(target=self._produce, name=f"chat-stream-{self.request_id}", daemon=True).start()
+        return self.stream_buffer
+
+    def flush_due(self):
+        """
+        Sends coalesced text whose max-delay deadline has passed; called by waiting subscribers.
+
+        The producer thread is blocked on the upstream between chunks, so the deadline is kept
+        by the readers of its buffer instead. The coalescer lock orders these frames with the
+        producer's own.
+
+        Returns:
+            float: Seconds until the next check.
+        """
+        with self.coalescer.lock:
+            text = self.coalescer.flush_due()
+            if text is not None:
+                for frame in self._answer_frames(text):
+                    self.stream_buffer.append(frame)
+            due = self.coalescer.time_to_deadline()
+        # Nothing buffered yet: look again after one max-delay period.
+        return self.coalescer.max_delay if due is None else due
+
+    def _produce(self):
+        try:
+            for frame in self.iter_frames():
+                self.stream_buffer.append(frame)
+        except Exception as e:
+            self.stream_buffer.append(self.error_frame(e))
+        finally:
+            self.finish()
+            self.stream_buffer.close()
+            single_flight.forget(self.flight_key, self.stream_buffer)
+
+    async def start_producer_async(self):
+        """Async counterpart of start_producer: the producer is a task on the running loop."""
+        # Registering the stream may write its owner to shared_state, so it runs off the loop.
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, contextvars.copy_context().run, self._create_stream):
+            self._producer_task = asyncio.ensure_future(self._aproduce())
+        return self.stream_buffer
+
+    async def _aproduce(self):
+        try:
+            async for frame in self.aiter_frames():
+                self.stream_buffer.append(frame)
+        except Exception as e:
+            self.stream_buffer.append(self.error_frame(e))
+        finally:
+            self.finish()
+            self.stream_buffer.close()
+            single_flight.forget(self.flight_key, self.stream_buffer)
+
+    def error_frame(self, e):
+        """Marks the stream as failed and returns the SSE error frame for e."""
+        self.failed = True
+        return stream_error_frame(e)
+
+    def _observe(self):
+        """
+        Records the finished stream in the Prometheus metrics.
+
+        Returns:
+            str: The stream's outcome (see metrics.stream_outcome).
+        """
+        metrics.OPEN_STREAMS.dec()
+        model = metrics.model_label(self.model_name)
+        outcome = metrics.stream_outcome(self._parts, self.failed, is_error_marker, self.completed)
+        metrics.CHAT_REQUESTS.labels(model, outcome).inc()
+        metrics.STREAM_DURATION.labels(model).observe(time.perf_counter() - self.started_at)
+        if self.first_chunk_at is not None:
+            metrics.TIME_TO_FIRST_CHUNK.labels(model).observe(self.first_chunk_at - self.started_at)
+        if not self.cache_hit:
+            # Error markers arrive as chunks, so only real answers count towards the model's TTFT.
+            ttft = self.first_chunk_at - self.started_at if self.first_chunk_at is not None and outcome != "error" else None
+            model_router.record(self.model_name, ttft, None if outcome == "cancelled" else outcome != "error")
+        metrics.STREAM_CHUNKS.observe(len(self._parts))
+        metrics.STREAM_FRAMES.observe(self.coalescer.frames_out)
+        metrics.STREAM_BYTES.observe(sum(len(part.encode("utf-8")) for part in self._parts))
+        extra = {}
+        if outcome == "ok" and not self.cache_hit:
+            cancellation_stats.record_completed(self.model_name, estimate_tokens("".join(self._parts)))
+        elif outcome == "cancelled":
+            extra["tokens_saved"] = cancellation_stats.record_cancelled(
+                self.model_name, estimate_tokens("".join(self._parts)), upstream=not self.cache_hit)
+            extra["cancel_reason"] = self.cancellation.reason or "client_disconnected"
+        logger.info("Chat stream finished", extra={"model": self.model_name, "outcome": outcome,
+                                                   "cache_hit": self.cache_hit, **extra, **self.coalescer.stats()})
+        return outcome
+
+    def needs_admission(self):
+        """Cache replays never reach the model, so only live streams take an admission ticket."""
+        return self.cached_chunks is None
+
+    def release_admission(self):
+        if self.admission_ticket is not None:
+            self.admission_ticket.release()
+
+    def finish(self):
+        """Runs once when the stream ends, whether it completed, failed or was cancelled."""
+        self.release_admission()
+        outcome = self._observe() if self.started_at is not None else None
+        # Only complete answers are cached; blocked, failed or cancelled streams never are.
+        if (self.cache_key and self.completed and not self.cache_hit
+                and not any(is_error_marker(part) for part in self._parts)):
+            response_cache.put(self.cache_key, self._parts)
+        response_text = "".join(self._parts)
+        # Only real answers become part of the server-held history; errors and blocks are dropped.
+        if self.session and response_text and not is_error_marker(response_text):
+            session_store.record_turn(self.session.conversation_id, self.user_prompt, response_text)
+        self.finish_trace(outcome)
+
+    def finish_trace(self, outcome=None):
+        """
+        Ends the request's trace; failed streams and slow first chunks are always exported.
+
+        Frames the client reads after the stream has ended are not in the sse.write span.
+        """
+        if self.trace is None or self.trace.finished:
+            return
+        if self.stream_span is not None:
+            self.stream_span.finish()
+        if self._frames_written:
+            self.trace.record_span("sse.write", self._first_write_at, time.time(), frames=self._frames_written,
+                                   write_ms=round(self._write_seconds * 1000, 1))
+        attributes = {"model": self.model_name, "outcome": outcome, "cache_hit": self.cache_hit,
+                      "chunks": len(self._parts), "joined": self.joined,
+                      "route": self.route.reason if self.route is not None else None}
+        if self.first_chunk_at is not None:
+            attributes["ttft_ms"] = round((self.first_chunk_at - self.started_at) * 1000, 1)
+            if attributes["ttft_ms"] >= tracing.TRACE_SLOW_FIRST_CHUNK_MS:
+                self.trace.keep("slow_first_chunk")
+        self.trace.root.set(**attributes)
+        self.trace.finish(error=outcome if outcome == "error" else None)
+
+
+def convert_history(history):
+    """
+    Converts history from the simple client format to Content objects.
+
+    Returns:
+        tuple: (messages, contents) with invalid items skipped.
+    """
+    messages = []
+    chat_history = []
+    for i, msg in enumerate(history):
+        if not isinstance(msg, dict):
+            logger.warning("Invalid item type in history ignored", extra={"index": i, "item_type": type(msg).__name__})
+            continue  # Skip invalid items
+        role = msg.get('role')
+        text = msg.get('text')
+        if role in ['user', 'model'] and isinstance(text, str):
+            messages.append({"role": role.lower(), "text": text})
+            chat_history.append(make_content(role.lower(), text))
+        else:
+            logger.warning("Invalid message format in history ignored", extra={"index": i, "role": str(msg.get('role'))[:20]})
+    return messages, chat_history
+
+
+def parse_chat_request(data, client_id=None):
+    """
+    Validates a /chat JSON payload and converts it into a ChatRequest.
+
+    Shared by the Flask view and the ASGI app so both serve the same request contract.
+    Clients opt into server-held sessions by sending a 'conversation_id' key: null starts a
+    new session (announced as a 'conversation' SSE event), and a known id lets the client
+    omit 'history'. Sending 'history' alongside an id resynchronizes that session.
+    'render': 'blocks' streams the answer as markdown block events (see markdown_blocks.py)
+    instead of text frames; the response says so with an X-Render-Mode header.
+    'model': 'auto' lets model_router pick the model, announced as a 'model' SSE event.
+
+    Args:
+        data (dict): The decoded JSON body.
+        client_id (str, optional): Admission-control client id, used for speculative title jobs.
+
+    Returns:
+        ChatRequest: The validated request.
+
+    Raises:
+        ChatRequestError: If the payload is empty or malformed, or the conversation is unknown.
+    """
+    if not data:  # Handle empty JSON body
+        logger.warning("Empty JSON body received")
+        raise ChatRequestError("Request body cannot be empty")
+
+    user_prompt = data.get('prompt')
+    history = data.get('history')  # Expected format: [{role: 'user'/'model', text: '...'}, ...]
+    use_session = 'conversation_id' in data
+    conversation_id = data.get('conversation_id')
+
+    # Extract custom instructions entered by the user and trim whitespace.
+    custom_instructions = data.get('system_instruction', '').strip()
+    # Combine custom instructions with the base (immutable) instructions from .env.
+    if custom_instructions:
+        system_instruction = f"User instructions: {custom_instructions}\n\nSystem instructions: {DEFAULT_SYSTEM_INSTRUCTION}"
+    else:
+        system_instruction = DEFAULT_SYSTEM_INSTRUCTION
+
+    model_name = data.get('model', DEFAULT_MODEL)
+
+    # --- Input Validation ---
+    if not user_prompt or not isinstance(user_prompt, str):
+        logger.warning("Invalid prompt received", extra={"prompt_type": type(user_prompt).__name__})
+        raise ChatRequestError("Valid 'prompt' (string) is required")
+    if history is not None and not isinstance(history, list):
+        logger.warning("Invalid history format received", extra={"history_type": type(history).__name__})
+        raise ChatRequestError("'history' must be a list")
+    if conversation_id is not None and not is_valid_conversation_id(conversation_id):
+        raise ChatRequestError("'conversation_id' must be an alphanumeric string")
+
+    want_title = data.get('title') is True
+    render_mode = data.get('render', 'text')
+    if render_mode not in RENDER_MODES:
+        raise ChatRequestError("'render' must be 'text' or 'blocks'")
+    if not MARKDOWN_BLOCKS:
+        render_mode = 'text'  # The client falls back to text frames when X-Render-Mode is absent.
+    session = None
+    if use_session and conversation_id and history is None:
+        # Delta-only request: the server already holds the history.
+        with tracing.span("session.load"):
+            session = session_store.get(conversation_id)
+        if session is None:
+            logger.warning("Unknown or expired conversation_id: %s", conversation_id)
+            raise ChatRequestError("Unknown or expired conversation; resend the full history",
+                                   404, code="conversation_not_found")
+        chat_history = list(session.contents)
+        messages = session.messages
+        history_length = len(chat_history)
+    else:
+        with tracing.span("history.convert", messages=len(history or [])):
+            messages, chat_history = convert_history(history or [])
+        history_length = len(history or [])
+        if use_session:
+            if conversation_id:
+                session = session_store.reset(conversation_id, messages, chat_history)
+            else:
+                session = session_store.create(messages, chat_history)
+
+    route = None
+    if model_name == AUTO_MODEL:
+        route = model_router.route(user_prompt, messages)
+        model_name = route.model
+
+    # Fit the history into the model's token budget; the session keeps the full history.
+    if session:
+        conversation_key = session.conversation_id
+    elif chat_history:
+        conversation_key = hashlib.sha1(content_text(chat_history[0]).encode("utf-8")).hexdigest()
+    else:
+        conversation_key = None
+    with tracing.span("context.fit", model=model_name) as fit_span:
+        chat_history, context_report = context_manager.fit(model_name, system_instruction, chat_history, user_prompt, conversation_key)
+        if fit_span is not None:
+            fit_span.set(tokens_sent=context_report.tokens_sent, tokens_saved=context_report.tokens_saved)
+
+    request_key = make_cache_key(model_name, system_instruction,
+                                 [(content.role, content_text(content)) for content in chat_history],
+                                 user_prompt, CHAT_GENERATION_CONFIG)
+    cache_key = None
+    if response_cache.enabled and data.get('cache', True) is not False:
+        cache_key = request_key
+    # New sessions get a fresh id, so only retries within one conversation (or without one) share a flight.
+    flight_key = flight_key_for(request_key, session.conversation_id if session else None, want_title, render_mode)
+
+    # Start titling speculatively so the title is ready by the time the answer is.
+    title_key = title_future = None
+    if want_title:
+        title_messages = list(messages[:TITLE_MAX_TURNS]) + [{"role": "user", "text": user_prompt}]
+        title_key = title_key_for(title_messages)
+        title_future = title_service.request(title_key, title_messages, client_id=client_id)
+
+    metrics.HISTORY_LENGTH.observe(history_length)
+    metrics.PROMPT_BYTES.observe(len(user_prompt.encode("utf-8")))
+
+    logger.info("Chat request received", extra={
+        "model": model_name,
+        "route": route.reason if route else None,
+        "system_instruction": bool(system_instruction),
+        "history_length": history_length,
+        "conversation_id": session.conversation_id if session else None,
+        "context_tokens_sent": context_report.tokens_sent,
+        "context_tokens_saved": context_report.tokens_saved,
+    })
+
+    return ChatRequest(model_name, user_prompt, system_instruction, chat_history,
+                       session=session, announce_session=use_session and not conversation_id,
+                       context_report=context_report, cache_key=cache_key,
+                       title_key=title_key, title_future=title_future, flight_key=flight_key,
+                       render_mode=render_mode, route=route)
+
+
+def format_sse(data, event=None):
+    """Formats one Server-Sent Events frame with a JSON-encoded payload."""
+    if event:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def admission_error_response(rejected):
+    """429 response for a request that was not admitted."""
+    response = jsonify(rejected.to_dict())
+    response.status_code = 429
+    response.headers.update(rejected.headers())
+    return response
+
+
+def end_request_trace(status_code, **attributes):
+    """Ends the current trace of a request answered without a stream; 5xx responses count as failed."""
+    trace = tracing.current_trace()
+    if trace is not None:
+        trace.root.set(status_code=status_code, **attributes)
+        trace.finish(error=f"HTTP {status_code}" if status_code >= 500 else None)
+
+
+def sse_response(frames, headers):
+    """
+    Builds a text/event-stream response, compressed frame by frame when the client accepts it.
+    """
+    headers = dict(headers)
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding:
+        frames = compression.compress_stream(frames, encoding)
+        headers.update(compression.response_headers(encoding))
+    return Response(frames, mimetype='text/event-stream', headers=headers)
+
+
+def probe_disconnected(environ):
+    """The disconnect check for a subscriber on this WSGI request, or None if the server hides the socket."""
+    probe = ClientDisconnectProbe.from_environ(environ)
+    return probe.disconnected if probe else None
+
+
+def stream_error_frame(e):
+    """Builds the SSE error frame sent when generation fails mid-stream."""
+    logger.error("Error during streaming generation: %s", e, exc_info=e)
+    return format_sse({'error': f"Stream Error: {str(e)}"}, event='error')
+
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """Handles the chat request and streams the response."""
     if not request.is_json:
-        print("Error: Request content type is not application/json")
+        logger.warning("Request content type is not application/json")
         return jsonify({"error": "Request must be JSON"}), 415
 
+    # Ended by ChatRequest.finish once the stream is over, or below for an early response.
+    tracing.start_trace("POST /chat", app_logging.current_request_id(), request.headers.get('traceparent'))
     try:
-        data = request.get_json()
-        if not data:  # Handle empty JSON body
-            print("Error: Empty JSON body received")
-            return jsonify({"error": "Request body cannot be empty"}), 400
-
-        user_prompt = data.get('prompt')
-        history = data.get('history', [])  # Expected format: [{role: 'user'/'model', text: '...'}, ...]
-        
-        # Extract custom instructions entered by the user and trim whitespace.
-        custom_instructions = data.get('system_instruction', '').strip()
-        # Combine custom instructions with the base (immutable) instructions from .env.
-        if custom_instructions:
-            system_instruction = f"User instructions: {custom_instructions}\n\nSystem instructions: {DEFAULT_SYSTEM_INSTRUCTION}"
-        else:
-            system_instruction = DEFAULT_SYSTEM_INSTRUCTION
-
-        model_name = data.get('model', DEFAULT_MODEL)
-
-        # --- Input Validation ---
-        if not user_prompt or not isinstance(user_prompt, str):
-            print(f"Error: Invalid prompt received: {user_prompt}")
-            return jsonify({"error": "Valid 'prompt' (string) is required"}), 400
-        if not isinstance(history, list):
-            print(f"Error: Invalid history format received: {history}")
-            return jsonify({"error": "'history' must be a list"}), 400
-
-        # Convert history from the simple client format to Content objects.
-        chat_history = []
-        for i, msg in enumerate(history):
-            if not isinstance(msg, dict):
-                print(f"Warning: Invalid item type in history (index {i}), expected dict: {msg}")
-                continue  # Skip invalid items
-            role = msg.get('role')
-            text = msg.get('text')
-            if role in ['user', 'model'] and isinstance(text, str):
-                chat_history.append(Content(role=role.lower(), parts=[Part.from_text(text)]))
-            else:
-                print(f"Warning: Invalid message format in history ignored (index {i}): {msg}")
+        client_id = client_id_from(request.headers, request.remote_addr)
+        with tracing.span("chat.parse_json", bytes=request.content_length):
+            data = request.get_json()
+        chat_request = parse_chat_request(data, client_id)
+        if SSE_RESUME and chat_request.join_in_flight() is not None:
+            # The joined generation is traced by the request that started it.
+            end_request_trace(200, joined=True)
+            return sse_response(chat_request.stream_buffer.iter_frames(disconnected=probe_disconnected(request.environ)),
+                                chat_request.response_headers())
+        if chat_request.needs_admission():
+            # Blocks this request thread while queued; rejects with 429 when the queue is full.
+            with tracing.span("admission.wait"):
+                chat_request.admission_ticket = admission.acquire(client_id, chat_request.model_name)
+        if SSE_RESUME:
+            # This response is one reader of the stream's buffer; the producer owns the ticket.
+            stream_buffer = chat_request.start_producer()
+            if chat_request.joined:
+                end_request_trace(200, joined=True)
+            return sse_response(chat_request.timed_frames(stream_buffer.iter_frames(disconnected=probe_disconnected(request.environ))),
+                                chat_request.response_headers())
 
-        # Debug output
-        print("\n--- Received Request ---")
-        print(f"Model: {model_name}")
-        print(f"System Instruction: {'Provided' if system_instruction else 'Empty/Default'}")
-        print(f"History Length Sent (items): {len(history)}")
-        print("----------------------\n")
+        chat_request.disconnect_probe = ClientDisconnectProbe.from_environ(request.environ)
 
         @stream_with_context
         def generate_response_stream():
             try:
-                stream = get_gemini_response_stream(
-                    model_name=model_name,
-                    user_prompt=user_prompt,
-                    system_instruction=system_instruction,
-                    chat_history=chat_history
-                )
-                for chunk in stream:
-                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield from chat_request.iter_frames()
             except Exception as e:
-                print(f"Error during streaming generation in Flask: {e}\n{traceback.format_exc()}")
-                error_message = f"Stream Error: {str(e)}"
-                yield f"event: error\ndata: {json.dumps({'error': error_message})}\n\n"
+                yield chat_request.error_frame(e)
+            finally:
+                chat_request.finish()
 
-        return Response(generate_response_stream(), mimetype='text/event-stream')
+        response = sse_response(chat_request.timed_frames(generate_response_stream()), chat_request.response_headers())
+        # Also release when the response is closed without ever being iterated.
+        response.call_on_close(chat_request.release_admission)
+        response.call_on_close(chat_request.finish_trace)
+        return response
 
+    except AdmissionRejected as rejected:
+        end_request_trace(429)
+        return admission_error_response(rejected)
+    except ChatRequestError as req_err:
+        end_request_trace(req_err.status_code)
+        return jsonify(req_err.to_dict()), req_err.status_code
     except json.JSONDecodeError as json_err:
-        print(f"Error decoding JSON request body: {json_err}")
+        logger.warning("Error decoding JSON request body: %s", json_err)
+        end_request_trace(400)
         return jsonify({"error": f"Invalid JSON format: {json_err}"}), 400
     except Exception as e:
-        print(f"Error in /chat endpoint before streaming: {e}\n{traceback.format_exc()}")
+        logger.exception("Error in /chat endpoint before streaming: %s", e)
+        end_request_trace(500)
         return jsonify({"error": f"An internal server error occurred: {str(e)}"}), 500
 
+@app.route('/chat/stream/<stream_id>', methods=['GET'])
+def resume_chat(stream_id):
+    """
+    Resumes a /chat stream after a dropped connection.
+
+    Takes the X-Stream-Id of the original response and the id of the last frame received, as a
+    Last-Event-ID header or a last_event_id query parameter, and streams from the next frame.
+    Responds 404 for an unknown or expired stream and 410 when those frames are gone.
+    """
+    try:
+        stream_buffer, last_event_id = stream_registry.resume(
+            stream_id, request.headers.get('Last-Event-ID', request.args.get('last_event_id')))
+    except ResumeError as e:
+        return jsonify(e.to_dict()), e.status_code
+    return sse_response(stream_buffer.iter_frames(last_event_id, probe_disconnected(request.environ)),
+                        {"X-Stream-Id": stream_id})
+
+@app.route('/chat/stream/<stream_id>', methods=['DELETE'])
+def cancel_chat(stream_id):
+    """
+    Stops a /chat stream right away (the user pressed cancel) instead of after the grace window.
+    A stream shared by identical requests keeps running until all of them have cancelled.
+    Responds 202 when the stream runs in another worker process, which stops it shortly after.
+    """
+    try:
+        released = stream_registry.cancel(stream_id)
+    except ResumeError as e:
+        return jsonify(e.to_dict()), e.status_code
+    return '', 204 if released else 202
+
 @app.route('/name_chat', methods=['POST'])
 def name_chat():
     """
@@ -108,17 +833,239 @@ def name_chat():
     """
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 415
+    started = time.perf_counter()
+    tracing.start_trace("POST /name_chat", app_logging.current_request_id(), request.headers.get('traceparent'))
     try:
-        data = request.get_json()
+        with tracing.span("chat.parse_json", bytes=request.content_length):
+            data = request.get_json()
         chat_history = data.get('chat_history', [])
-        # Import the chat naming function from name_chat.py (ensure that file is in your project)
-        from name_chat import generate_chat_name
-        chat_title = generate_chat_name(chat_history)
-        return jsonify({"chat_title": chat_title}), 200
+        # Identical histories share one background job and its cached result.
+        key = title_key_for(chat_history)
+        chat_title = title_service.get(key)
+        if chat_title is None:
+            # The job takes its own title-priority ticket, so no slot is held here while it is
+            # queued behind chat streams or while this request joins a job that already is.
+            client_id = client_id_from(request.headers, request.remote_addr)
+            chat_title = title_service.request(key, chat_history, client_id).result()
+        end_request_trace(200)
+        return jsonify({"chat_title": chat_title, "title_key": key}), 200
     except Exception as e:
-        print(f"Error in /name_chat endpoint: {e}\n{traceback.format_exc()}")
+        logger.exception("Error in /name_chat endpoint: %s", e)
+        end_request_trace(500)
         return jsonify({"chat_title": "Untitled Chat", "error": str(e)}), 500
+    finally:
+        metrics.NAME_CHAT_LATENCY.observe(time.perf_counter() - started)
+
+@app.route('/name_chat/<title_key>', methods=['GET'])
+def get_chat_name(title_key):
+    """
+    Returns a title started by a /chat request with "title": true, without waiting for it.
+    Responds 202 while the job is still running and 404 if the key is unknown.
+    """
+    chat_title = title_service.get(title_key)
+    if chat_title is not None:
+        return jsonify({"chat_title": chat_title, "title_key": title_key}), 200
+    if title_service.is_pending(title_key):
+        return jsonify({"status": "pending", "title_key": title_key}), 202
+    return jsonify({"error": "Unknown title key"}), 404
+
+def library_id_from_request():
+    """Returns the chat library named by the X-Library-Id header."""
+    library_id = request.headers.get('X-Library-Id', '')
+    if not is_valid_library_id(library_id):
+        raise ChatStoreError("An X-Library-Id header of 16-64 alphanumeric characters is required",
+                             400, code="library_id_required")
+    return library_id
+
+def int_arg(name, default, minimum=0, maximum=1000):
+    """Reads an integer query parameter, clamped to [minimum, maximum]."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return max(minimum, min(int(value), maximum))
+    except ValueError:
+        raise ChatStoreError(f"'{name}' must be an integer") from None
+
+def json_object_body():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ChatStoreError("Request body must be a JSON object")
+    return data
+
+@app.errorhandler(ChatStoreError)
+def chat_store_error(e):
+    return jsonify(e.to_dict()), e.status_code
+
+@app.route('/api/chats', methods=['GET'])
+def list_chats():
+    """
+    Lists the library's chats, most recently active first, one page at a time.
+    With q, searches message text and chat names instead (best match first, with a snippet).
+    Pass the returned next_cursor as cursor for the next page.
+    """
+    library_id = library_id_from_request()
+    limit = int_arg('limit', CHAT_PAGE_SIZE, 1, 200)
+    query = request.args.get('q', '').strip()
+    if query:
+        return jsonify(chat_store.search(library_id, query, request.args.get('cursor'), limit)), 200
+    return jsonify(chat_store.list_chats(library_id, request.args.get('cursor'), limit)), 200
+
+@app.route('/api/chats', methods=['POST'])
+def create_chat():
+    """Creates a chat. Expects: { "name": "...", "messages": [{role, text}, ...], "unread": false }"""
+    data = json_object_body()
+    chat = chat_store.create_chat(library_id_from_request(), data.get('name', ''), data.get('messages'),
+                                  data.get('unread') is True)
+    return jsonify(chat), 201
+
+@app.route('/api/chats/export', methods=['GET'])
+def export_chats():
+    """Streams the whole library as NDJSON, one chat with its messages per line."""
+    lines = chat_store.export_ndjson(library_id_from_request())
+    headers = {"Content-Disposition": 'attachment; filename="chats.ndjson"'}
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding:
+        lines = compression.compress_stream(lines, encoding)
+        headers.update(compression.response_headers(encoding))
+    return Response(lines, mimetype='application/x-ndjson', headers=headers)
+
+@app.route('/api/chats/import', methods=['POST'])
+def import_chats():
+    """
+    Imports NDJSON chats from the request body (the export format, or old localStorage chats
+    as {id, name, history}). Chats already imported from the same source id are skipped.
+    """
+    library_id = library_id_from_request()
+    return jsonify(chat_store.import_ndjson(library_id, request.stream)), 200
+
+@app.route('/api/chats/<chat_id>', methods=['GET'])
+def get_chat(chat_id):
+    """Returns a chat with a page of its messages from seq 'start'; next_start is null on the last page."""
+    start = int_arg('start', 0, 0, 2 ** 31)
+    limit = int_arg('limit', CHAT_MESSAGES_PAGE_SIZE, 1, 5000)
+    return jsonify(chat_store.get_chat(library_id_from_request(), chat_id, start, limit)), 200
+
+@app.route('/api/chats/<chat_id>', methods=['PATCH'])
+def update_chat(chat_id):
+    """Renames a chat or sets its unread flag. Expects: { "name": "...", "unread": true }"""
+    data = json_object_body()
+    unread = data.get('unread')
+    if unread is not None and not isinstance(unread, bool):
+        raise ChatStoreError("'unread' must be a boolean")
+    return jsonify(chat_store.update_chat(library_id_from_request(), chat_id, data.get('name'), unread)), 200
+
+@app.route('/api/chats/<chat_id>', methods=['DELETE'])
+def delete_chat(chat_id):
+    chat_store.delete_chat(library_id_from_request(), chat_id)
+    return '', 204
+
+@app.route('/api/chats/<chat_id>/messages', methods=['POST'])
+def append_chat_messages(chat_id):
+    """Appends messages to a chat. Expects: { "messages": [{role, text}, ...] }"""
+    data = json_object_body()
+    return jsonify(chat_store.append_messages(library_id_from_request(), chat_id, data.get('messages'))), 200
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Runs a JSONL batch of chat or title items (see batch_jobs.py) and streams JSONL results back
+    in completion order, ending with a summary line.
+
+    Query parameters: job_id (reuse one to resume a job from its checkpoint) and workers (the
+    number of items run in parallel). The job id is returned in X-Batch-Job-Id.
+    """
+    try:
+        job = batch_runner.start(request.args.get('job_id'), request.args.get('workers', BATCH_WORKERS, type=int))
+    except BatchError as e:
+        return jsonify(e.to_dict()), e.status_code
+    lines = request.stream
+
+    def generate_results():
+        try:
+            yield from job.run(lines)
+        finally:
+            batch_runner.finish(job)
+
+    results = generate_results()
+    headers = {"X-Batch-Job-Id": job.job_id}
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding:
+        results = compression.compress_stream(results, encoding)
+        headers.update(compression.response_headers(encoding))
+    response = Response(results, mimetype='application/x-ndjson', headers=headers)
+    # Also unregister when the response is closed without ever being iterated.
+    response.call_on_close(lambda: batch_runner.finish(job))
+    return response
+
+@app.route('/batch/<job_id>', methods=['GET'])
+def batch_status(job_id):
+    """Progress and throughput of a running batch job, or the completed count of a finished one."""
+    status = batch_runner.status(job_id)
+    if status is None:
+        return jsonify({"error": "Unknown batch job", "code": "job_not_found"}), 404
+    return jsonify(status), 200
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness probe: the process is up. Also reports import and SDK init timings."""
+    body = {"status": "ok", "app_import_seconds": APP_IMPORT_SECONDS, **vertex_runtime.status(),
+            "admission": admission.stats(), "streams": stream_registry.stats(),
+            "single_flight": single_flight.stats(), "chat_store": chat_store.stats(), "batch": batch_runner.stats(),
+            "pid": os.getpid(), "shared_state": shared_state.stats(), "context_cache": context_cache.stats(),
+            "tracing": tracing.exporter.stats(), "model_router": model_router.stats()}
+    pool = getattr(get_backend(), 'pool', None)
+    if pool is not None:
+        body["endpoints"] = pool.stats()
+    return jsonify(body), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness probe: 200 once the SDK is initialized and the model backends are warm."""
+    status = vertex_runtime.status()
+    if vertex_runtime.is_ready():
+        return jsonify({"status": "ready", **status}), 200
+    return jsonify({"status": "warming", **status}), 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint for the streaming hot path."""
+    body, content_type = metrics.render_metrics()
+    return Response(body, content_type=content_type)
+
+def start_model_warmup():
+    """Initializes the SDK and pre-opens the chat and title model connections in the background."""
+    def warmup_title_model():
+        from name_chat import warmup_chat_name_model
+        return warmup_chat_name_model()
+    vertex_runtime.start_prewarm({
+        "chat_model": lambda: warmup_chat_model(DEFAULT_MODEL, DEFAULT_SYSTEM_INSTRUCTION),
+        "title_model": warmup_title_model,
+    })
+
+
+# Under the pre-fork server the app may be imported in the parent before forking; each worker
+# starts its own warmup after the fork instead (gunicorn.conf.py post_worker_init).
+if os.getenv("MODEL_WARMUP", "1") != "0" and os.getenv("WEB_PREFORK") != "1":
+    start_model_warmup()
+
+def build_assets():
+    """Incremental asset build at startup; unchanged bundles are reused, so this is cheap."""
+    try:
+        manifest, built, _ = assets.build()
+        logger.info("Assets ready", extra={"built": built, "cdn_fallbacks": sorted(manifest["fallbacks"])})
+    except Exception as e:
+        # The page still works without a build: it links the unbundled files.
+        logger.warning("Asset build failed, serving unbundled assets: %s", e, exc_info=e)
+
+if assets.ASSETS_AUTO_BUILD:
+    build_assets()
+
+APP_IMPORT_SECONDS = round(time.perf_counter() - _import_started, 4)
+logger.info("App imported in %ss", APP_IMPORT_SECONDS)
 
 if __name__ == '__main__':
-    print(f"Starting Flask server on http://0.0.0.0:5000 with debug={'True' if os.environ.get('FLASK_DEBUG') else 'False'}")
-    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
+    # Development server: one process. For production run `gunicorn -c gunicorn.conf.py app:app`.
+    debug = os.environ.get('FLASK_DEBUG') == '1'
+    print(f"Starting Flask server on http://0.0.0.0:5000 with debug={debug}")
+    app.run(debug=debug, host='0.0.0.0', port=5000, threaded=True)
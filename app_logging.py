@@ -0,0 +1,213 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import zlib
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+import logging.handlers
+
+# Structured logging kept off the request path.
+# Request threads and coroutines only put records on a bounded in-memory queue; a background
+# QueueListener formats them as JSON lines and writes them to stdout, so a slow or blocked
+# stdout never stalls a stream. Repetitive warnings are rate limited per message template, and
+# INFO/DEBUG records can be sampled per request so that all lines of one request are kept or
+# dropped together.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# At most LOG_RATE_LIMIT warnings per message template every LOG_RATE_WINDOW_SECONDS (0 disables).
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW_SECONDS = float(os.getenv("LOG_RATE_WINDOW_SECONDS", "60"))
+# Fraction of requests whose INFO/DEBUG records are kept; warnings and errors are always kept.
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+# Attributes every LogRecord has; anything else on a record came from extra= and is emitted as a field.
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "request_id", "suppressed"}
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def bind_request_id(request_id: str = None):
+    """
+    Sets the request id for log records emitted from the current thread or task.
+
+    Args:
+        request_id (str, optional): Id supplied by the client (X-Request-Id); a new one is
+            generated if it is missing or malformed.
+
+    Returns:
+        str: The bound request id.
+    """
+    if not request_id or not _REQUEST_ID_PATTERN.match(request_id):
+        request_id = new_request_id()
+    request_id_var.set(request_id)
+    return request_id
+
+
+def current_request_id():
+    return request_id_var.get()
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the request id while still on the calling thread."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps INFO/DEBUG records for a stable fraction of request ids."""
+
+    def __init__(self, rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+        self._threshold = int(max(0.0, min(1.0, rate)) * 0xFFFFFFFF)
+
+    def filter(self, record):
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        request_id = getattr(record, "request_id", None)
+        if not request_id:
+            return True
+        return zlib.crc32(request_id.encode("utf-8")) <= self._threshold
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Allows at most `limit` WARNING-or-above records per (logger, level, message template) per window.
+
+    The first record let through after a suppressed run carries a `suppressed` count so the
+    volume stays visible without the repetition.
+    """
+
+    def __init__(self, limit: int = LOG_RATE_LIMIT, window_seconds: float = LOG_RATE_WINDOW_SECONDS):
+        super().__init__()
+        self.limit = limit
+        self.window = window_seconds
+        self._buckets = {}  # key -> [window start, records allowed, records suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.limit <= 0 or record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or now - bucket[0] >= self.window:
+                suppressed = bucket[2] if bucket else 0
+                if len(self._buckets) > 10000:
+                    self._buckets.clear()
+                self._buckets[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if bucket[1] < self.limit:
+                bucket[1] += 1
+                return True
+            bucket[2] += 1
+            return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only merge the arguments here; JSON encoding and traceback formatting happen on the listener thread.
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "suppressed", None):
+            entry["suppressed"] = record.suppressed
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+def _start_listener():
+    global _listener
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    _listener = logging.handlers.QueueListener(_handler.queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+
+
+def _restart_after_fork():
+    # The listener thread does not survive fork(); each worker process needs its own.
+    if _handler is not None:
+        _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        _start_listener()
+
+
+def configure_logging():
+    """Routes the root logger through the background queue. Safe to call more than once."""
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return
+        _handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _handler.addFilter(RequestContextFilter())
+        _handler.addFilter(SamplingFilter())
+        _handler.addFilter(RateLimitFilter())
+        root = logging.getLogger()
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(_handler)
+        _start_listener()
+        atexit.register(lambda: _listener.stop())
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def stats():
+    return {"queued": _handler.queue.qsize() if _handler else 0, "dropped": _handler.dropped if _handler else 0}
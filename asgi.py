@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+import metrics
+import app_logging
+import tracing
+import compression
+from app import app as flask_app, parse_chat_request, ChatRequestError, end_request_trace
+from disconnect import watch_disconnect, StreamCancellation
+from stream_buffers import stream_registry, ResumeError, SSE_RESUME
+from admission import admission, AdmissionRejected, client_id_from
+from chat_titles import title_service, title_key
+
+# Async serving mode: /chat is served natively on the event loop so an open stream costs a
+# coroutine rather than an OS thread. Every other route is delegated to the Flask app.
+# Steps that block (session and chat-store reads, and shared_state, which is SQLite) run in the
+# threadpool so a slow disk never stalls the other streams on the loop.
+
+logger = logging.getLogger(__name__)
+
+
+async def chat(request: Request):
+    """Async /chat view with the same request contract and SSE framing as app.chat."""
+    request_id = app_logging.bind_request_id(request.headers.get('x-request-id'))
+    if request.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+        logger.warning("Request content type is not application/json")
+        return JSONResponse({"error": "Request must be JSON"}, status_code=415)
+
+    tracing.start_trace("POST /chat", request_id, request.headers.get('traceparent'))
+    try:
+        try:
+            with tracing.span("chat.parse_json"):
+                data = await request.json()
+        except json.JSONDecodeError as json_err:
+            logger.warning("Error decoding JSON request body: %s", json_err)
+            end_request_trace(400)
+            return JSONResponse({"error": f"Invalid JSON format: {json_err}"}, status_code=400)
+
+        client_id = client_id_from(request.headers, request.client.host if request.client else None)
+        chat_request = await run_in_threadpool(parse_chat_request, data, client_id)
+        if SSE_RESUME and await run_in_threadpool(chat_request.join_in_flight) is not None:
+            end_request_trace(200, joined=True)
+            return sse_response(request, subscribe(request, chat_request.stream_buffer), chat_request.response_headers())
+        if chat_request.needs_admission():
+            # Queued requests wait on the event loop, not on a thread.
+            with tracing.span("admission.wait"):
+                chat_request.admission_ticket = await admission.acquire_async(client_id, chat_request.model_name)
+
+        if SSE_RESUME:
+            stream_buffer = await chat_request.start_producer_async()
+            if chat_request.joined:
+                end_request_trace(200, joined=True)
+            return sse_response(request, chat_request.atimed_frames(subscribe(request, stream_buffer)),
+                                chat_request.response_headers())
+
+        async def generate_response_stream():
+            # Watch for http.disconnect so an abandoned stream stops even between writes.
+            watcher = asyncio.ensure_future(watch_disconnect(request.receive, chat_request.cancellation))
+            try:
+                async for frame in chat_request.aiter_frames():
+                    if chat_request.cancellation.cancelled:
+                        break
+                    yield frame
+            except Exception as e:
+                yield chat_request.error_frame(e)
+            finally:
+                watcher.cancel()
+                chat_request.finish()
+
+        return sse_response(request, chat_request.atimed_frames(generate_response_stream()), chat_request.response_headers())
+
+    except AdmissionRejected as rejected:
+        end_request_trace(429)
+        return JSONResponse(rejected.to_dict(), status_code=429, headers=rejected.headers())
+    except ChatRequestError as req_err:
+        end_request_trace(req_err.status_code)
+        return JSONResponse(req_err.to_dict(), status_code=req_err.status_code)
+    except Exception as e:
+        logger.exception("Error in async /chat endpoint before streaming: %s", e)
+        end_request_trace(500)
+        return JSONResponse({"error": f"An internal server error occurred: {str(e)}"}, status_code=500)
+
+
+def sse_response(request: Request, frames, headers):
+    """Async counterpart of app.sse_response."""
+    headers = dict(headers)
+    encoding = compression.negotiate(request.headers.get('accept-encoding'))
+    if encoding:
+        frames = compression.acompress_stream(frames, encoding)
+        headers.update(compression.response_headers(encoding))
+    return StreamingResponse(frames, media_type='text/event-stream', headers=headers)
+
+
+async def subscribe(request: Request, stream_buffer, last_event_id: int = 0):
+    """Streams a buffer's frames to one client; a disconnect ends this reader, not the stream."""
+    cancellation = StreamCancellation()
+    watcher = asyncio.ensure_future(watch_disconnect(request.receive, cancellation))
+    try:
+        async for frame in stream_buffer.aiter_frames(last_event_id, cancellation):
+            yield frame
+    finally:
+        watcher.cancel()
+
+
+async def resume_chat(request: Request):
+    """Async counterpart of app.resume_chat."""
+    stream_id = request.path_params['stream_id']
+    try:
+        stream_buffer, last_event_id = await run_in_threadpool(
+            stream_registry.resume, stream_id, request.headers.get('last-event-id', request.query_params.get('last_event_id')))
+    except ResumeError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status_code)
+    return sse_response(request, subscribe(request, stream_buffer, last_event_id), {"X-Stream-Id": stream_id})
+
+
+async def name_chat(request: Request):
+    """Async /name_chat: awaits the background title job without holding a thread."""
+    request_id = app_logging.bind_request_id(request.headers.get('x-request-id'))
+    if request.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+        return JSONResponse({"error": "Request must be JSON"}, status_code=415)
+    started = time.perf_counter()
+    tracing.start_trace("POST /name_chat", request_id, request.headers.get('traceparent'))
+    try:
+        with tracing.span("chat.parse_json"):
+            data = await request.json()
+        chat_history = data.get('chat_history', [])
+        key = title_key(chat_history)
+        chat_title = await run_in_threadpool(title_service.get, key)
+        if chat_title is None:
+            # As in app.name_chat, the title job takes its own admission ticket.
+            client_id = client_id_from(request.headers, request.client.host if request.client else None)
+            future = await run_in_threadpool(title_service.request, key, chat_history, client_id)
+            chat_title = await asyncio.wrap_future(future)
+        end_request_trace(200)
+        return JSONResponse({"chat_title": chat_title, "title_key": key}, headers={"X-Request-Id": request_id})
+    except Exception as e:
+        logger.exception("Error in async /name_chat endpoint: %s", e)
+        end_request_trace(500)
+        return JSONResponse({"chat_title": "Untitled Chat", "error": str(e)}, status_code=500,
+                            headers={"X-Request-Id": request_id})
+    finally:
+        metrics.NAME_CHAT_LATENCY.observe(time.perf_counter() - started)
+
+
+app = Starlette(routes=[
+    Route('/chat', chat, methods=['POST']),
+    Route('/chat/stream/{stream_id}', resume_chat, methods=['GET']),
+    Route('/name_chat', name_chat, methods=['POST']),
+    Mount('/', app=WSGIMiddleware(flask_app)),
+])
+
+if __name__ == '__main__':
+    import uvicorn
+    port = int(os.getenv("PORT", "5000"))
+    print(f"Starting ASGI server on http://0.0.0.0:{port}")
+    uvicorn.run(app, host='0.0.0.0', port=port)
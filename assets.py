@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import gzip
+import json
+import base64
+import hashlib
+import logging
+import argparse
+import threading
+import mimetypes
+import importlib.util
+import urllib.request
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only .gz siblings are written.
+    brotli = None
+
+# Static asset build pipeline.
+# The page used to load style.css plus one of 18 per-theme stylesheets (swapped at runtime,
+# one extra round trip per switch, no cache-busting), and marked, Prism and Font Awesome from
+# third-party CDNs on every cold load. The build bundles the app CSS with every theme scoped by
+# [data-theme], vendors the third-party JS and CSS (fetched once with `python assets.py fetch`),
+# names every output by its content hash and writes .gz/.br siblings next to it. A bundle is only
+# rebuilt when one of its inputs changed. Flask serves the results from /assets/ with immutable
+# cache headers, ETags and the precompressed sibling the client accepts.
+#
+#     python assets.py fetch           # download the vendored files into static/vendor/
+#     python assets.py build [--force] # incremental build into static/dist/
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, "static")
+VENDOR_DIR = os.path.join(STATIC_DIR, "vendor")
+ASSETS_DIST_DIR = os.getenv("ASSETS_DIST_DIR", os.path.join(STATIC_DIR, "dist"))
+ASSETS_AUTO_BUILD = os.getenv("ASSETS_AUTO_BUILD", "1") != "0"
+ASSETS_URL_PREFIX = "/assets/"
+ASSETS_MAX_AGE_SECONDS = 365 * 24 * 3600
+# Bump when the build's output format changes so every bundle is rebuilt once.
+BUILD_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+PRECOMPRESS_EXTENSIONS = (".css", ".js", ".svg", ".json")
+PRISM_COMPONENTS_URL = "https://cdnjs.cloudflare.com/ajax/libs/prism/1.29.0/components/"
+FONT_AWESOME_WEBFONTS_URL = "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/webfonts/"
+
+logger = logging.getLogger(__name__)
+
+
+class VendorAsset:
+    """A pinned third-party file: where it lives under static/vendor/ and where to fetch it from."""
+
+    def __init__(self, path: str, url: str, integrity: str = None):
+        self.path = path
+        self.url = url
+        self.integrity = integrity  # Subresource Integrity value, checked on fetch and used by CDN fallbacks
+
+    @property
+    def local_path(self):
+        return os.path.join(VENDOR_DIR, self.path)
+
+    def exists(self):
+        return os.path.isfile(self.local_path)
+
+
+VENDOR_ASSETS = {asset.path: asset for asset in (
+    VendorAsset("font-awesome.min.css", "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/css/all.min.css",
+                "sha512-DTOQO9RWCH3ppGqcWaEA1BIZOC6xxalwEsw9c2QQeAIftl+Vegovlnee1c9QX4TctnWMn13TZye+giMm8e2LwA=="),
+    VendorAsset("webfonts/fa-solid-900.woff2", FONT_AWESOME_WEBFONTS_URL + "fa-solid-900.woff2"),
+    VendorAsset("webfonts/fa-regular-400.woff2", FONT_AWESOME_WEBFONTS_URL + "fa-regular-400.woff2"),
+    VendorAsset("webfonts/fa-brands-400.woff2", FONT_AWESOME_WEBFONTS_URL + "fa-brands-400.woff2"),
+    VendorAsset("webfonts/fa-v4compatibility.woff2", FONT_AWESOME_WEBFONTS_URL + "fa-v4compatibility.woff2"),
+    VendorAsset("prism-okaidia.min.css", "https://cdnjs.cloudflare.com/ajax/libs/prism/1.29.0/themes/prism-okaidia.min.css"),
+    VendorAsset("marked.min.js", "https://cdn.jsdelivr.net/npm/marked@12.0.2/marked.min.js"),
+    VendorAsset("prism-core.min.js", PRISM_COMPONENTS_URL + "prism-core.min.js",
+                "sha512-9khQRAUBYEJDCDVP2ywQ0ckNV0rihodoZh+3lVdGIQJSGS2Z7fMAWSoacNzGimE6QIqG9OQXoHgVYvi/9JpZxA=="),
+    VendorAsset("prism-autoloader.min.js",
+                "https://cdnjs.cloudflare.com/ajax/libs/prism/1.29.0/plugins/autoloader/prism-autoloader.min.js"),
+)}
+# Copied as standalone hashed files; vendor.css points at them.
+VENDOR_FONTS = tuple(path for path in VENDOR_ASSETS if path.startswith("webfonts/"))
+
+# Once bundled, the autoloader can no longer derive the grammar path from its own <script> src.
+PRISM_AUTOLOADER_CONFIG = f"Prism.plugins.autoloader.languages_path = {json.dumps(PRISM_COMPONENTS_URL)};\n"
+
+# (bundle name, tag group, inputs). Inputs are "vendor:<path>", "static:<path>", "themes" or
+# "inline:<name>". A vendor bundle with any file missing is replaced by its CDN originals.
+BUNDLES = (
+    ("vendor.css", "css", ("vendor:font-awesome.min.css", "vendor:prism-okaidia.min.css")),
+    ("app.css", "css", ("static:style.css", "themes")),
+    ("vendor.js", "vendor_js", ("vendor:marked.min.js", "vendor:prism-core.min.js", "vendor:prism-autoloader.min.js",
+                                "inline:prism-autoloader-config")),
+    ("app.js", "app_js", ("static:script.js",)),
+)
+INLINE_SOURCES = {"prism-autoloader-config": PRISM_AUTOLOADER_CONFIG}
+
+
+def load_themes():
+    """Returns (themes, default theme) from static/themes.py."""
+    spec = importlib.util.spec_from_file_location("zoro_themes", os.path.join(STATIC_DIR, "themes.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.themes, getattr(module, "DEFAULT_THEME", "dark")
+
+
+def themes_css(themes: dict, default: str):
+    """One rule per theme, scoped by [data-theme]; the default theme also applies without the attribute."""
+    rules = []
+    for name, variables in themes.items():
+        selector = f':root[data-theme="{name}"]'
+        if name == default:
+            selector = f":root,{selector}"
+        body = ";".join(f"--{var}:{value}" for var, value in variables.items())
+        rules.append(f"{selector}{{{body}}}")
+    return "\n".join(rules) + "\n"
+
+
+def minify_css(css: str):
+    """Conservative CSS minifier: drops comments and the whitespace around punctuation."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip() + "\n"
+
+
+def rewrite_font_urls(css: str, font_files: dict):
+    """Points Font Awesome's ../webfonts/ urls at the hashed copies, or at the CDN for fonts not vendored."""
+    def replace(match):
+        name = match.group(1)
+        hashed = font_files.get(f"webfonts/{name}")
+        return f"url({hashed})" if hashed else f"url({FONT_AWESOME_WEBFONTS_URL}{name})"
+    return re.sub(r"url\(\s*['\"]?\.\./webfonts/([^'\")?#]+)[^)]*\)", replace, css)
+
+
+def content_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def hashed_name(name: str, digest: str):
+    stem, ext = os.path.splitext(os.path.basename(name))
+    return f"{stem}.{digest}{ext}"
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _precompress(path: str, data: bytes):
+    """Writes .gz and .br siblings when they are smaller; returns the encodings written."""
+    if not path.endswith(PRECOMPRESS_EXTENSIONS):
+        return []
+    encodings = []
+    candidates = [("gzip", ".gz", lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        candidates.insert(0, ("br", ".br", lambda: brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)))
+    for encoding, suffix, compress in candidates:
+        if not os.path.exists(path + suffix):
+            compressed = compress()
+            if len(compressed) >= len(data):
+                continue
+            _write_atomic(path + suffix, compressed)
+        encodings.append(encoding)
+    return encodings
+
+
+def _emit(dist_dir: str, name: str, data: bytes):
+    """Writes one hashed output (unless it already exists) and returns its manifest entry."""
+    digest = content_hash(data)
+    filename = hashed_name(name, digest)
+    path = os.path.join(dist_dir, filename)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    return {"file": filename, "etag": digest, "size": len(data), "encodings": _precompress(path, data)}
+
+
+class AssetBuilder:
+    """
+    Incremental build of BUNDLES and VENDOR_FONTS into dist_dir.
+
+    Every output records a fingerprint of its inputs in the manifest; an output whose
+    fingerprint is unchanged and whose file still exists is reused without being rebuilt.
+    """
+
+    def __init__(self, dist_dir: str = ASSETS_DIST_DIR, force: bool = False):
+        self.dist_dir = dist_dir
+        self.force = force
+        self.previous = read_manifest(dist_dir) or {}
+        if self.previous.get("version") != BUILD_VERSION:
+            self.previous = {}
+        self._themes = None
+        self.built = []
+        self.reused = []
+
+    def _read_input(self, source: str):
+        """Returns the text of one bundle input, or None for a vendor file that was not fetched."""
+        kind, _, path = source.partition(":")
+        if kind == "vendor":
+            asset = VENDOR_ASSETS[path]
+            if not asset.exists():
+                return None
+            with open(asset.local_path, encoding="utf-8") as f:
+                return f.read()
+        if kind == "static":
+            with open(os.path.join(STATIC_DIR, path), encoding="utf-8") as f:
+                return f.read()
+        if kind == "inline":
+            return INLINE_SOURCES[path]
+        if source == "themes":
+            if self._themes is None:
+                self._themes = themes_css(*load_themes())
+            return self._themes
+        raise ValueError(f"Unknown bundle input: {source}")
+
+    def _reuse(self, name: str, fingerprint: str):
+        entry = (self.previous.get("assets") or {}).get(name)
+        if (not self.force and entry and entry.get("inputs") == fingerprint
+                and os.path.exists(os.path.join(self.dist_dir, entry["file"]))):
+            self.reused.append(name)
+            return entry
+        return None
+
+    def _fonts(self):
+        fonts = {}
+        for path in VENDOR_FONTS:
+            asset = VENDOR_ASSETS[path]
+            if not asset.exists():
+                continue
+            with open(asset.local_path, "rb") as f:
+                data = f.read()
+            fingerprint = content_hash(data)
+            entry = self._reuse(path, fingerprint)
+            if entry is None:
+                entry = {**_emit(self.dist_dir, path, data), "inputs": fingerprint}
+                self.built.append(path)
+            fonts[path] = entry
+        return fonts
+
+    def _bundle(self, name: str, sources: tuple, font_files: dict):
+        texts = [self._read_input(source) for source in sources]
+        if any(text is None for text in texts):
+            return None
+        fingerprint = hashlib.sha256(json.dumps(
+            [BUILD_VERSION, sources, texts, font_files if name == "vendor.css" else None]).encode("utf-8")).hexdigest()
+        entry = self._reuse(name, fingerprint)
+        if entry is not None:
+            return entry
+        if name.endswith(".css"):
+            texts = [minify_css(rewrite_font_urls(text, font_files)) for text in texts]
+            data = "".join(texts)
+        else:
+            # The separator keeps a file without a trailing semicolon from running into the next.
+            data = "\n;\n".join(text.rstrip() for text in texts) + "\n"
+        entry = {**_emit(self.dist_dir, name, data.encode("utf-8")), "inputs": fingerprint}
+        self.built.append(name)
+        return entry
+
+    def build(self):
+        """Builds what changed, writes the manifest and prunes stale outputs; returns the manifest."""
+        os.makedirs(self.dist_dir, exist_ok=True)
+        fonts = self._fonts()
+        font_files = {path: entry["file"] for path, entry in fonts.items()}
+        assets, groups, fallbacks = dict(fonts), {}, {}
+        for name, group, sources in BUNDLES:
+            entry = self._bundle(name, sources, font_files)
+            if entry is None:
+                missing = [source for source in sources if source.startswith("vendor:")
+                           and not VENDOR_ASSETS[source[7:]].exists()]
+                logger.warning("Vendor files missing, %s falls back to the CDN (run `python assets.py fetch`): %s",
+                               name, ", ".join(missing))
+                groups.setdefault(group, []).extend(
+                    {"url": VENDOR_ASSETS[source[7:]].url, "integrity": VENDOR_ASSETS[source[7:]].integrity}
+                    for source in sources if source.startswith("vendor:"))
+                fallbacks[name] = missing
+                continue
+            assets[name] = entry
+            groups.setdefault(group, []).append({"url": ASSETS_URL_PREFIX + entry["file"], "integrity": None})
+
+        current = {entry["file"] for entry in assets.values()}
+        # Pages rendered before this build may still reference the previous generation.
+        keep = current | set(self.previous.get("files") or ())
+        manifest = {"version": BUILD_VERSION, "assets": assets, "groups": groups, "fallbacks": fallbacks,
+                    "files": sorted(current), "retained": sorted(keep - current)}
+        _write_atomic(os.path.join(self.dist_dir, MANIFEST_NAME), json.dumps(manifest, indent=1).encode("utf-8"))
+        self._prune(keep)
+        return manifest
+
+    def _prune(self, keep: set):
+        for filename in os.listdir(self.dist_dir):
+            base = filename[:-3] if filename.endswith((".gz", ".br")) else filename
+            if filename == MANIFEST_NAME or base in keep or filename.endswith(".tmp"):
+                continue
+            try:
+                os.remove(os.path.join(self.dist_dir, filename))
+            except OSError:
+                pass
+
+
+def read_manifest(dist_dir: str = ASSETS_DIST_DIR):
+    try:
+        with open(os.path.join(dist_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build(dist_dir: str = ASSETS_DIST_DIR, force: bool = False):
+    """Runs an incremental build; returns (manifest, built names, reused names)."""
+    builder = AssetBuilder(dist_dir, force)
+    manifest = builder.build()
+    return manifest, builder.built, builder.reused
+
+
+def fetch_vendor(force: bool = False):
+    """Downloads VENDOR_ASSETS into static/vendor/, checking Subresource Integrity where pinned."""
+    for asset in VENDOR_ASSETS.values():
+        if asset.exists() and not force:
+            continue
+        with urllib.request.urlopen(asset.url, timeout=30) as response:
+            data = response.read()
+        if asset.integrity:
+            algorithm, _, expected = asset.integrity.partition("-")
+            actual = base64.b64encode(hashlib.new(algorithm, data).digest()).decode("ascii")
+            if actual != expected:
+                raise ValueError(f"Integrity mismatch for {asset.url}")
+        os.makedirs(os.path.dirname(asset.local_path), exist_ok=True)
+        _write_atomic(asset.local_path, data)
+        print(f"Fetched {asset.url} -> {os.path.relpath(asset.local_path, ROOT)}")
+
+
+class AssetManifest:
+    """
+    Read side of the build for the Flask app: template URLs and the files /assets/ may serve.
+
+    The manifest is re-read when its mtime changes, so a rebuild is picked up without a restart.
+    Without a manifest the page falls back to the unbundled files and CDN links.
+    """
+
+    def __init__(self, dist_dir: str = ASSETS_DIST_DIR):
+        self.dist_dir = dist_dir
+        self._mtime = None
+        self._manifest = None
+        self._servable = {}
+        self._lock = threading.Lock()
+
+    def _current(self):
+        try:
+            mtime = os.stat(os.path.join(self.dist_dir, MANIFEST_NAME)).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            with self._lock:
+                manifest = read_manifest(self.dist_dir) if mtime is not None else None
+                servable = {}
+                if manifest:
+                    servable = {entry["file"]: entry for entry in manifest["assets"].values()}
+                    for filename in manifest.get("retained", ()):
+                        servable.setdefault(filename, {"file": filename, "etag": filename.rsplit(".", 2)[-2],
+                                                       "encodings": [
+                                                           encoding for encoding, suffix in (("br", ".br"), ("gzip", ".gz"))
+                                                           if os.path.exists(os.path.join(self.dist_dir, filename + suffix))]})
+                self._manifest, self._servable, self._mtime = manifest, servable, mtime
+        return self._manifest
+
+    @property
+    def built(self):
+        return self._current() is not None
+
+    def tags(self, group: str):
+        """
+        Returns [{"url", "integrity"}] for a tag group ("css", "vendor_js", "app_js"), in load order.
+
+        Without a build this is the unbundled page: CDN links, style.css and the default theme
+        file, whose link carries id="theme-style" so script.js can swap it.
+        """
+        manifest = self._current()
+        if manifest is not None:
+            return manifest["groups"].get(group, [])
+        if group == "css":
+            return ([{"url": VENDOR_ASSETS[path].url, "integrity": VENDOR_ASSETS[path].integrity}
+                     for path in ("font-awesome.min.css", "prism-okaidia.min.css")]
+                    + [{"url": "/static/style.css", "integrity": None},
+                       {"url": "/static/themes/dark.css", "integrity": None, "id": "theme-style"}])
+        if group == "vendor_js":
+            return [{"url": VENDOR_ASSETS[path].url, "integrity": VENDOR_ASSETS[path].integrity}
+                    for path in ("marked.min.js", "prism-core.min.js", "prism-autoloader.min.js")]
+        if group == "app_js":
+            return [{"url": "/static/script.js", "integrity": None}]
+        return []
+
+    def resolve(self, filename: str, encodings: tuple):
+        """
+        Finds a servable built file.
+
+        Args:
+            filename (str): Hashed file name from the URL.
+            encodings (tuple): Encodings the client accepts, best first.
+
+        Returns:
+            tuple: (path, encoding or None, etag, mimetype), or None if the file is not servable.
+        """
+        self._current()
+        entry = self._servable.get(filename)
+        if entry is None:
+            return None
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        path = os.path.join(self.dist_dir, filename)
+        for encoding in encodings:
+            suffix = {"br": ".br", "gzip": ".gz"}.get(encoding)
+            if suffix and encoding in entry.get("encodings", ()) and os.path.exists(path + suffix):
+                return path + suffix, encoding, f"{entry['etag']}-{encoding}", mimetype
+        if not os.path.exists(path):
+            return None
+        return path, None, entry["etag"], mimetype
+
+
+asset_manifest = AssetManifest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or fetch the static assets.")
+    parser.add_argument("command", choices=("build", "fetch"))
+    parser.add_argument("--force", action="store_true", help="rebuild (or refetch) everything")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    if args.command == "fetch":
+        fetch_vendor(args.force)
+        return
+    manifest, built, reused = build(force=args.force)
+    for name, entry in manifest["assets"].items():
+        state = "built" if name in built else "unchanged"
+        print(f"{state:9} {name:36} -> {entry['file']} ({entry['size']} bytes; {', '.join(entry['encodings']) or 'raw'})")
+    for name, missing in manifest["fallbacks"].items():
+        print(f"cdn       {name:36} (missing: {', '.join(missing)})")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
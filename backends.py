@@ -0,0 +1,350 @@
+import os
+import time
+import random
+import logging
+import asyncio
+import hashlib
+import datetime
+import threading
+from model_pool import model_pool
+import vertex_runtime
+
+# Pluggable generation backends.
+# get_gemini_response_stream, title generation and context summaries talk to a backend rather
+# than to a GenerativeModel directly. VertexBackend is the production path; StubBackend emits
+# locally generated GenerationResponse-shaped chunks with configurable timing and failure
+# injection, so /chat can be load-tested offline without spending Vertex quota. Both support
+# context caching (context_cache.py): a system instruction and conversation prefix stored once as
+# cached content, after which calls send only the new turns.
+#
+# Select with CHAT_BACKEND=vertex (default) or CHAT_BACKEND=stub.
+
+CHAT_BACKEND = os.getenv("CHAT_BACKEND", "vertex")
+
+STUB_TOKENS_PER_SECOND = float(os.getenv("STUB_TOKENS_PER_SECOND", "80"))
+STUB_CHUNK_TOKENS = int(os.getenv("STUB_CHUNK_TOKENS", "12"))
+STUB_FIRST_TOKEN_DELAY_MS = float(os.getenv("STUB_FIRST_TOKEN_DELAY_MS", "400"))
+# Mean of an exponential extra first-token delay, to give the latency distribution a tail.
+STUB_FIRST_TOKEN_JITTER_MS = float(os.getenv("STUB_FIRST_TOKEN_JITTER_MS", "0"))
+STUB_RESPONSE_TOKENS = int(os.getenv("STUB_RESPONSE_TOKENS", "400"))
+STUB_BLOCK_RATE = float(os.getenv("STUB_BLOCK_RATE", "0"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+# Extra first-token delay per 1000 uncached input tokens, so context caching shows up in TTFT.
+STUB_PREFILL_MS_PER_1K_TOKENS = float(os.getenv("STUB_PREFILL_MS_PER_1K_TOKENS", "0"))
+
+logger = logging.getLogger(__name__)
+
+
+class ChatBackend:
+    """
+    Interface for the model calls the app makes.
+
+    Every method takes the Content list to send plus the model settings; streamed chunks and
+    responses must look like vertexai GenerationResponse objects (text, candidates,
+    prompt_feedback) so chatbot._process_chunk handles them unchanged.
+    """
+
+    name = "base"
+    supports_context_cache = False
+
+    def stream(self, model_name: str, system_instruction: str, contents: list, generation_config: dict, safety_settings: list = None,
+               cached_content=None):
+        """
+        Returns an iterator of streamed chunks.
+
+        With cached_content (a handle from create_cache) the system instruction and the cached
+        prefix come from the cache, and contents holds only the turns after that prefix.
+        """
+        raise NotImplementedError
+
+    async def stream_async(self, model_name: str, system_instruction: str, contents: list, generation_config: dict, safety_settings: list = None,
+                           cached_content=None):
+        """Returns an async iterator of streamed chunks."""
+        raise NotImplementedError
+
+    def generate(self, model_name: str, system_instruction: str, contents: list, generation_config: dict, safety_settings: list = None):
+        """Returns one complete (non-streamed) response."""
+        raise NotImplementedError
+
+    def warmup(self, model_name: str, system_instruction: str, generation_config: dict, safety_settings: list = None):
+        """Prepares the backend for a model; returns True when it is ready to serve."""
+        return True
+
+    def create_cache(self, model_name: str, system_instruction: str, contents: list, ttl_seconds: float):
+        """Stores a system instruction and conversation prefix as cached content; returns its handle."""
+        raise NotImplementedError
+
+    def refresh_cache(self, cached_content, ttl_seconds: float):
+        """Extends a cache's lifetime to ttl_seconds from now."""
+        raise NotImplementedError
+
+    def delete_cache(self, cached_content):
+        """Deletes a cache before its TTL runs out."""
+
+
+class VertexBackend(ChatBackend):
+    """Calls Vertex AI through pooled GenerativeModel handles."""
+
+    name = "vertex"
+    supports_context_cache = True
+
+    def _model(self, model_name, system_instruction, generation_config, safety_settings, cached_content):
+        if cached_content is not None:
+            return model_pool.get_cached_model(cached_content, generation_config, safety_settings)
+        return model_pool.get_model(model_name, system_instruction, generation_config, safety_settings)
+
+    def stream(self, model_name, system_instruction, contents, generation_config, safety_settings=None, cached_content=None):
+        model = self._model(model_name, system_instruction, generation_config, safety_settings, cached_content)
+        # Generation config and safety settings are baked into the pooled model handle.
+        return model.generate_content(contents=contents, stream=True)
+
+    async def stream_async(self, model_name, system_instruction, contents, generation_config, safety_settings=None,
+                           cached_content=None):
+        model = self._model(model_name, system_instruction, generation_config, safety_settings, cached_content)
+        model_pool.share_async_client(model)
+        return await model.generate_content_async(contents=contents, stream=True)
+
+    def generate(self, model_name, system_instruction, contents, generation_config, safety_settings=None):
+        model = model_pool.get_model(model_name, system_instruction, generation_config, safety_settings)
+        return model.generate_content(contents=contents, stream=False)
+
+    def warmup(self, model_name, system_instruction, generation_config, safety_settings=None):
+        return model_pool.warmup(model_name, system_instruction, generation_config, safety_settings)
+
+    def create_cache(self, model_name, system_instruction, contents, ttl_seconds):
+        return vertex_runtime.caching().CachedContent.create(
+            model_name=model_name, system_instruction=system_instruction or None, contents=contents or None,
+            ttl=datetime.timedelta(seconds=ttl_seconds))
+
+    def refresh_cache(self, cached_content, ttl_seconds):
+        cached_content.update(ttl=datetime.timedelta(seconds=ttl_seconds))
+
+    def delete_cache(self, cached_content):
+        cached_content.delete()
+
+
+class StubError(RuntimeError):
+    """Injected upstream failure raised by StubBackend."""
+
+
+class _Named:
+    def __init__(self, name):
+        self.name = name
+
+
+class _StubPart:
+    def __init__(self, text):
+        self.text = text
+
+
+class _StubCandidate:
+    def __init__(self, text, finish_reason=None, safety_ratings=None):
+        self.content = _StubContent([_StubPart(text)] if text else [])
+        self.finish_reason = _Named(finish_reason) if finish_reason else None
+        self.safety_ratings = safety_ratings or []
+
+
+class _StubContent:
+    def __init__(self, parts):
+        self.parts = parts
+
+
+class _StubRating:
+    def __init__(self, category, probability):
+        self.category = _Named(category)
+        self.probability = _Named(probability)
+
+
+class _StubFeedback:
+    block_reason = None
+    safety_ratings = []
+
+
+class _StubUsage:
+    def __init__(self, prompt_token_count, cached_content_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class StubChunk:
+    """Minimal stand-in for a streamed GenerationResponse."""
+
+    def __init__(self, text="", finish_reason=None, safety_ratings=None, usage_metadata=None):
+        self.text = text
+        self.candidates = [_StubCandidate(text, finish_reason, safety_ratings)]
+        self.prompt_feedback = _StubFeedback()
+        self.usage_metadata = usage_metadata
+
+
+class StubCachedContent:
+    """Stand-in for a vertexai CachedContent handle."""
+
+    def __init__(self, name, model_name, token_count, expires_at):
+        self.name = name
+        self.model_name = model_name
+        self.token_count = token_count
+        self.expires_at = expires_at
+
+
+def _stub_tokens(text):
+    # Same 4-characters-per-token rule as context_window.estimate_tokens (which imports this module).
+    return len(text) // 4 + 1 if text else 0
+
+
+_STUB_WORDS = ("the model streams tokens while the server frames each chunk as an event and the "
+               "client renders markdown so latency depends on first token time chunk size and "
+               "network buffering across regions under load").split()
+_STUB_CODE = ["```python\n", "def handler(request):\n", "    data = request.get_json()\n",
+              "    return {'ok': True, 'items': len(data)}\n", "```\n"]
+
+
+class StubBackend(ChatBackend):
+    """
+    Local stand-in that emits realistic chunk streams without calling Vertex.
+
+    Timing and failure behaviour come from the STUB_* environment variables: token rate,
+    tokens per chunk, first-token delay and jitter, response length, and the probability of a
+    safety block or an upstream error. Output is seeded from the prompt, so a given request always
+    produces the same text. Context caches are kept in memory with their TTL; input tokens that
+    are not cached add STUB_PREFILL_MS_PER_1K_TOKENS to the first-token delay, and the last chunk
+    reports prompt and cached token counts like Vertex usage metadata.
+    """
+
+    name = "stub"
+    supports_context_cache = True
+
+    def __init__(self, tokens_per_second=STUB_TOKENS_PER_SECOND, chunk_tokens=STUB_CHUNK_TOKENS,
+                 first_token_delay_ms=STUB_FIRST_TOKEN_DELAY_MS, response_tokens=STUB_RESPONSE_TOKENS,
+                 block_rate=STUB_BLOCK_RATE, error_rate=STUB_ERROR_RATE, first_token_jitter_ms=STUB_FIRST_TOKEN_JITTER_MS,
+                 prefill_ms_per_1k_tokens=STUB_PREFILL_MS_PER_1K_TOKENS):
+        self.tokens_per_second = max(1.0, tokens_per_second)
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.first_token_delay = max(0.0, first_token_delay_ms) / 1000.0
+        self.first_token_jitter = max(0.0, first_token_jitter_ms) / 1000.0
+        self.response_tokens = max(1, response_tokens)
+        self.block_rate = block_rate
+        self.error_rate = error_rate
+        self.prefill_ms_per_1k_tokens = max(0.0, prefill_ms_per_1k_tokens)
+        self._caches = {}
+        self._caches_lock = threading.Lock()
+
+    def _cached_tokens(self, cached_content):
+        """Returns the token count of a live cache; raises like Vertex for an unknown or expired one."""
+        if cached_content is None:
+            return 0
+        with self._caches_lock:
+            cache = self._caches.get(cached_content.name)
+            if cache is None or cache.expires_at <= time.time():
+                self._caches.pop(cached_content.name, None)
+                raise StubError(f"404 Cached content {cached_content.name} not found (stub backend)")
+            return cache.token_count
+
+    def create_cache(self, model_name, system_instruction, contents, ttl_seconds):
+        tokens = _stub_tokens(system_instruction) + sum(
+            _stub_tokens("".join(getattr(part, 'text', '') or '' for part in content.parts)) for content in contents)
+        cache = StubCachedContent(f"stub/cachedContents/{os.urandom(8).hex()}",
+                                  model_name, tokens, time.time() + ttl_seconds)
+        with self._caches_lock:
+            self._caches[cache.name] = cache
+        return cache
+
+    def refresh_cache(self, cached_content, ttl_seconds):
+        self._cached_tokens(cached_content)
+        with self._caches_lock:
+            self._caches[cached_content.name].expires_at = time.time() + ttl_seconds
+
+    def delete_cache(self, cached_content):
+        with self._caches_lock:
+            self._caches.pop(cached_content.name, None)
+
+    def _plan(self, contents, generation_config, system_instruction="", cached_tokens=0):
+        """Returns (list of (delay, chunk)) plus an optional error to raise after them."""
+        last_text = ""
+        if contents:
+            last_text = "".join(getattr(part, 'text', '') or '' for part in contents[-1].parts)
+        rng = random.Random(hashlib.sha1(last_text.encode("utf-8")).hexdigest())
+        max_tokens = (generation_config or {}).get("max_output_tokens", self.response_tokens)
+        total_tokens = min(self.response_tokens, max_tokens)
+
+        words = []
+        for i in range(total_tokens):
+            words.append(rng.choice(_STUB_WORDS) + (".\n\n" if rng.random() < 0.06 else " "))
+        # A code block in the middle of the answer, as in real code-heavy replies.
+        middle = len(words) // 2
+        words[middle:middle] = _STUB_CODE
+
+        chunks = ["".join(words[i:i + self.chunk_tokens]) for i in range(0, len(words), self.chunk_tokens)]
+        per_chunk = self.chunk_tokens / self.tokens_per_second
+        # With a cache the system instruction is part of the cached tokens.
+        input_tokens = (0 if cached_tokens else _stub_tokens(system_instruction)) + sum(
+            _stub_tokens("".join(getattr(part, 'text', '') or '' for part in content.parts)) for content in contents or [])
+        first_delay = self.first_token_delay + input_tokens * self.prefill_ms_per_1k_tokens / 1e6
+        if self.first_token_jitter:
+            # Unseeded, so retries and hedges of the same prompt see independent latencies.
+            first_delay += random.expovariate(1.0 / self.first_token_jitter)
+        plan = [(first_delay if i == 0 else per_chunk, StubChunk(text)) for i, text in enumerate(chunks)]
+
+        roll = rng.random()
+        error = None
+        if roll < self.block_rate:
+            cut = rng.randint(0, len(plan))
+            ratings = [_StubRating("HARM_CATEGORY_DANGEROUS_CONTENT", "HIGH")]
+            plan = plan[:cut] + [(per_chunk, StubChunk("", "SAFETY", ratings))]
+        elif roll < self.block_rate + self.error_rate:
+            cut = rng.randint(0, len(plan))
+            plan = plan[:cut]
+            error = StubError("Injected upstream error (stub backend)")
+        else:
+            usage = _StubUsage(input_tokens + cached_tokens, cached_tokens, total_tokens)
+            plan[-1] = (plan[-1][0], StubChunk(plan[-1][1].text, "STOP", usage_metadata=usage))
+        return plan, error
+
+    def stream(self, model_name, system_instruction, contents, generation_config, safety_settings=None, cached_content=None):
+        plan, error = self._plan(contents, generation_config, system_instruction, self._cached_tokens(cached_content))
+
+        def generator():
+            for delay, chunk in plan:
+                time.sleep(delay)
+                yield chunk
+            if error:
+                raise error
+        return generator()
+
+    async def stream_async(self, model_name, system_instruction, contents, generation_config, safety_settings=None,
+                           cached_content=None):
+        plan, error = self._plan(contents, generation_config, system_instruction, self._cached_tokens(cached_content))
+
+        async def generator():
+            for delay, chunk in plan:
+                await asyncio.sleep(delay)
+                yield chunk
+            if error:
+                raise error
+        return generator()
+
+    def generate(self, model_name, system_instruction, contents, generation_config, safety_settings=None):
+        plan, error = self._plan(contents, generation_config)
+        time.sleep(self.first_token_delay)
+        if error:
+            raise error
+        words = "".join(chunk.text for _, chunk in plan).split()[:4]
+        return StubChunk(" ".join(word.capitalize() for word in words), "STOP")
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Returns the process-wide backend selected by CHAT_BACKEND.
+
+    With two or more VERTEX_ENDPOINTS the backend is wrapped in an endpoint pool that routes,
+    fails over and optionally hedges each call across them.
+    """
+    global _backend
+    if _backend is None:
+        from endpoints import build_pool_backend
+        _backend = build_pool_backend(CHAT_BACKEND) or (StubBackend() if CHAT_BACKEND == "stub" else VertexBackend())
+        logger.info("Chat backend: %s", _backend.name)
+    return _backend
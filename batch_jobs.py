@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+from admission import admission, AdmissionRejected, PRIORITY_BATCH
+from chat_titles import TITLE_MODEL, FALLBACK_TITLE
+from context_window import context_manager
+from model_router import model_router, AUTO_MODEL
+
+# Bulk JSONL batch generation.
+# Offline jobs (re-titling archives, prompt sweeps, content generation) used to run one /chat
+# SSE call per item through the interactive path. A batch job reads a JSONL upload line by line
+# and fans the items out to a bounded worker pool. Each item gets a few attempts with jittered
+# exponential backoff, and its JSONL result is streamed back as soon as it completes, so results
+# arrive in completion order. Model calls take the lowest admission priority and do not spend
+# the client's rate budget, so interactive traffic is always served first. Completed results are
+# appended to a per-job checkpoint file; rerunning the same upload under the same job id skips
+# the ids already done. Every result reports its latency, and the closing summary line reports
+# throughput and latency percentiles.
+#
+# Input lines:  {"id": "a1", "prompt": "...", "history": [...], "model": "...", "system_instruction": "..."}
+#               {"id": "t1", "type": "title", "chat_history": [{"role": "user", "text": "..."}, ...]}
+# A chat item's "model" may be "auto" to let model_router pick it.
+
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "32"))
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "4"))
+BATCH_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "3"))
+BATCH_BACKOFF_SECONDS = float(os.getenv("BATCH_BACKOFF_SECONDS", "1"))
+BATCH_BACKOFF_MAX_SECONDS = float(os.getenv("BATCH_BACKOFF_MAX_SECONDS", "30"))
+BATCH_CHECKPOINT_DIR = os.getenv("BATCH_CHECKPOINT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "batch"))
+BATCH_MAX_LINE_BYTES = int(os.getenv("BATCH_MAX_LINE_BYTES", str(1024 * 1024)))
+BATCH_DEFAULT_MODEL = os.getenv("DEFAULT_GEMINI_MODEL", "gemini-2.0-flash-001")
+BATCH_CLIENT_ID = "batch"
+
+ITEM_TYPES = ("chat", "title")
+# Safety blocks are deterministic, so retrying them only burns quota.
+NON_RETRYABLE_MARKERS = ("[Content Blocked", "[Prompt Blocked")
+
+logger = logging.getLogger(__name__)
+
+
+class BatchError(ValueError):
+    """Raised when a batch job cannot start; carries the HTTP status to return."""
+
+    def __init__(self, message, status_code=400, code=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+    def to_dict(self):
+        body = {"error": str(self)}
+        if self.code:
+            body["code"] = self.code
+        return body
+
+
+class ItemError(Exception):
+    """A failed attempt at one batch item."""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def is_valid_job_id(job_id):
+    return isinstance(job_id, str) and 0 < len(job_id) <= 64 and job_id.replace("-", "").replace("_", "").isalnum()
+
+
+def backoff_delay(attempt: int, retry_after=None):
+    """Full-jitter exponential backoff before retry number attempt (1-based), at least retry_after."""
+    delay = random.uniform(0, min(BATCH_BACKOFF_MAX_SECONDS, BATCH_BACKOFF_SECONDS * 2 ** (attempt - 1)))
+    return max(delay, retry_after or 0)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    summary = {f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+    summary["max"] = ordered[-1]
+    return summary
+
+
+def parse_item(line: str, number: int):
+    """
+    Validates one input line.
+
+    Returns:
+        dict: The item with 'id' and 'type' filled in (the id defaults to the line number).
+
+    Raises:
+        ItemError: The line is not a valid item (never retried).
+    """
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        raise ItemError(f"Invalid JSON: {e}", retryable=False) from None
+    if not isinstance(item, dict):
+        raise ItemError("Each line must be a JSON object", retryable=False)
+    item["id"] = str(item.get("id", f"line-{number}"))
+    item_type = item.setdefault("type", "chat")
+    if item_type not in ITEM_TYPES:
+        raise ItemError(f"'type' must be one of {', '.join(ITEM_TYPES)}", retryable=False)
+    if item_type == "chat":
+        if not isinstance(item.get("prompt"), str) or not item["prompt"]:
+            raise ItemError("Chat items need a 'prompt' string", retryable=False)
+        if not isinstance(item.get("history", []), list):
+            raise ItemError("'history' must be a list", retryable=False)
+    elif not isinstance(item.get("chat_history"), list) or not item["chat_history"]:
+        raise ItemError("Title items need a non-empty 'chat_history' list", retryable=False)
+    return item
+
+
+def run_chat_item(item):
+    """Generates one chat answer. Returns (result fields, time to first chunk in seconds)."""
+    from chatbot import get_gemini_response_stream, is_error_marker
+    from vertex_runtime import make_content
+    model_name = item.get("model") or BATCH_DEFAULT_MODEL
+    if model_name == AUTO_MODEL:
+        model_name = model_router.route(item["prompt"], item.get("history")).model
+    system_instruction = item.get("system_instruction") or ""
+    history = [make_content(msg["role"], msg["text"]) for msg in item.get("history", [])
+               if isinstance(msg, dict) and msg.get("role") in ("user", "model") and isinstance(msg.get("text"), str)]
+    history, context_report = context_manager.fit(model_name, system_instruction, history, item["prompt"])
+    started = time.perf_counter()
+    first_chunk = None
+    parts = []
+    stream = get_gemini_response_stream(model_name, item["prompt"], system_instruction, history,
+                                        context_report.stable_prefix())
+    try:
+        with admission.acquire(BATCH_CLIENT_ID, model_name, PRIORITY_BATCH, consume=False):
+            for chunk in stream:
+                if is_error_marker(chunk):
+                    raise ItemError(chunk, retryable=not chunk.startswith(NON_RETRYABLE_MARKERS))
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                parts.append(chunk)
+    finally:
+        stream.close()
+    return {"text": "".join(parts), "model": model_name}, first_chunk
+
+
+def run_title_item(item):
+    from name_chat import generate_chat_name
+    with admission.acquire(BATCH_CLIENT_ID, TITLE_MODEL, PRIORITY_BATCH, consume=False):
+        title = generate_chat_name(item["chat_history"])
+    if not title or title == FALLBACK_TITLE:
+        raise ItemError("Title generation failed")
+    return {"title": title}, None
+
+
+RUNNERS = {"chat": run_chat_item, "title": run_title_item}
+
+
+def process_item(item, runners=RUNNERS, max_attempts: int = BATCH_MAX_ATTEMPTS, sleep=time.sleep):
+    """
+    Runs one item with retries and returns its result line (a dict).
+
+    Retries model errors, admission rejections (waiting at least their Retry-After) and
+    unexpected exceptions; safety blocks fail right away.
+    """
+    started = time.perf_counter()
+    result = {"id": item["id"], "type": item["type"]}
+    for attempt in range(1, max_attempts + 1):
+        try:
+            fields, first_chunk = runners[item["type"]](item)
+            result.update(fields, status="ok")
+            if first_chunk is not None:
+                result["ttft_ms"] = round(first_chunk * 1000, 1)
+            break
+        except AdmissionRejected as e:
+            error = ItemError(str(e), retry_after=e.retry_after)
+        except ItemError as e:
+            error = e
+        except Exception as e:
+            logger.warning("Batch item %s failed: %s", item["id"], e, exc_info=True)
+            error = ItemError(f"{type(e).__name__}: {e}")
+        if not error.retryable or attempt == max_attempts:
+            result.update(status="error", error=str(error))
+            break
+        metrics.BATCH_RETRIES.labels(item["type"]).inc()
+        sleep(backoff_delay(attempt, error.retry_after))
+    result["attempts"] = attempt
+    latency = time.perf_counter() - started
+    result["latency_ms"] = round(latency * 1000, 1)
+    metrics.BATCH_ITEMS.labels(item["type"], result["status"]).inc()
+    metrics.BATCH_ITEM_SECONDS.labels(item["type"]).observe(latency)
+    return result
+
+
+class Checkpoint:
+    """
+    Append-only JSONL file of a job's completed results.
+
+    Only successful results are recorded, so a rerun retries failed items. Workers record
+    their own results, so items still running when the client goes away are kept too.
+    """
+
+    def __init__(self, job_id: str, directory: str = BATCH_CHECKPOINT_DIR):
+        self.path = os.path.join(directory, f"{job_id}.jsonl")
+        self.completed = set()
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.completed.add(json.loads(line)["id"])
+                    except (ValueError, KeyError):
+                        continue  # A line torn by a crash mid-write.
+        else:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def record(self, result: dict):
+        line = json.dumps(result, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self.completed.add(result["id"])
+
+
+class BatchJob:
+    """
+    One running batch: reads input lines lazily and yields JSONL result lines in completion order.
+
+    At most workers items run at once and at most twice that are read ahead, so neither the
+    upload nor the results are ever held in memory whole.
+    """
+
+    def __init__(self, job_id: str, workers: int = BATCH_WORKERS, checkpoint: Checkpoint = None, process=process_item):
+        self.job_id = job_id
+        self.workers = max(1, min(workers, BATCH_MAX_WORKERS))
+        self.checkpoint = checkpoint or Checkpoint(job_id)
+        self.process = process
+        self.started_at = None
+        self.finished_at = None
+        self.counts = {"submitted": 0, "ok": 0, "error": 0, "invalid": 0, "skipped": 0}
+        self.latencies_ms = []
+
+    def _result_line(self, result):
+        self.counts[result["status"]] += 1
+        if "latency_ms" in result:
+            self.latencies_ms.append(result["latency_ms"])
+        return json.dumps(result, ensure_ascii=False) + "\n"
+
+    def _process(self, item):
+        result = self.process(item)
+        if result["status"] == "ok":
+            self.checkpoint.record(result)
+        return result
+
+    def run(self, lines):
+        """
+        Yields one JSONL line per item as it completes, then a summary line.
+
+        Closing the generator (the client went away) cancels items not yet started; running
+        items finish and are checkpointed, so rerunning the job skips them.
+        """
+        self.started_at = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"batch-{self.job_id[:8]}")
+        pending = set()
+        seen = set()
+        lines = iter(lines)
+        exhausted = False
+        number = 0
+        try:
+            while not exhausted or pending:
+                while not exhausted and len(pending) < self.workers * 2:
+                    line = next(lines, None)
+                    if line is None:
+                        exhausted = True
+                        break
+                    number += 1
+                    if isinstance(line, bytes):
+                        line = line.decode("utf-8", errors="replace")
+                    if not line.strip():
+                        continue
+                    try:
+                        if len(line) > BATCH_MAX_LINE_BYTES:
+                            raise ItemError(f"Line is longer than {BATCH_MAX_LINE_BYTES} bytes", retryable=False)
+                        item = parse_item(line, number)
+                        if item["id"] in seen:
+                            raise ItemError(f"Duplicate id {item['id']!r}", retryable=False)
+                    except ItemError as e:
+                        yield self._result_line({"line": number, "status": "invalid", "error": str(e)})
+                        continue
+                    seen.add(item["id"])
+                    if item["id"] in self.checkpoint.completed:
+                        self.counts["skipped"] += 1
+                        continue
+                    self.counts["submitted"] += 1
+                    pending.add(executor.submit(self._process, item))
+                if not pending:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield self._result_line(future.result())
+            self.finished_at = time.perf_counter()
+            yield json.dumps({"summary": self.stats()}) + "\n"
+        finally:
+            if self.finished_at is None:
+                self.finished_at = time.perf_counter()
+            executor.shutdown(wait=False, cancel_futures=True)
+            logger.info("Batch job finished", extra={"job_id": self.job_id, **self.counts})
+
+    def stats(self):
+        elapsed = ((self.finished_at or time.perf_counter()) - self.started_at) if self.started_at else 0.0
+        completed = self.counts["ok"] + self.counts["error"]
+        return {
+            "job_id": self.job_id,
+            "running": self.started_at is not None and self.finished_at is None,
+            "workers": self.workers,
+            **self.counts,
+            "elapsed_seconds": round(elapsed, 3),
+            "items_per_second": round(completed / elapsed, 3) if elapsed else None,
+            "latency_ms": percentiles(self.latencies_ms),
+        }
+
+
+class BatchRunner:
+    """Registry of running batch jobs; caps how many run at once and refuses duplicate job ids."""
+
+    def __init__(self, max_jobs: int = BATCH_MAX_JOBS):
+        self.max_jobs = max(1, max_jobs)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def start(self, job_id=None, workers: int = BATCH_WORKERS):
+        """
+        Registers a new job.
+
+        Args:
+            job_id (str, optional): Reuse an earlier job's id to resume it from its checkpoint.
+            workers (int): Items processed in parallel (capped at BATCH_MAX_WORKERS).
+
+        Returns:
+            BatchJob: Iterate job.run(lines) and call finish(job) when done.
+
+        Raises:
+            BatchError: Invalid or already running job id, or too many jobs running.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        if not is_valid_job_id(job_id):
+            raise BatchError("'job_id' must be up to 64 letters, digits, '-' or '_'")
+        with self._lock:
+            if job_id in self._jobs:
+                raise BatchError("This job is already running", 409, code="job_running")
+            if len(self._jobs) >= self.max_jobs:
+                raise BatchError("Too many batch jobs running; retry later", 429, code="too_many_jobs")
+            job = self._jobs[job_id] = BatchJob(job_id, workers)
+        return job
+
+    def finish(self, job):
+        with self._lock:
+            if self._jobs.get(job.job_id) is job:
+                del self._jobs[job.job_id]
+
+    def status(self, job_id):
+        """
+        Returns live stats for a running job, the checkpointed count for a finished one, or None.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.stats()
+        if not is_valid_job_id(job_id) or not os.path.exists(os.path.join(BATCH_CHECKPOINT_DIR, f"{job_id}.jsonl")):
+            return None
+        return {"job_id": job_id, "running": False, "completed": len(Checkpoint(job_id).completed)}
+
+    def stats(self):
+        with self._lock:
+            return {"running": len(self._jobs), "max_jobs": self.max_jobs}
+
+
+batch_runner = BatchRunner()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Exercises the endpoint pool against in-process stub endpoints.
+
+Each endpoint is a StubBackend with its own latency and failure profile, so routing,
+fail-over and hedging can be checked offline. The run is repeated with hedging off and on
+and reports time-to-first-chunk percentiles, errors and how traffic was spread:
+
+    python benchmarks/endpoint_pool_sim.py -n 400 -c 40
+    python benchmarks/endpoint_pool_sim.py --endpoints "p:fast?first_token_delay_ms=150,p:slow?first_token_delay_ms=600"
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from endpoints import EndpointPool, EndpointPoolBackend, parse_endpoints  # noqa: E402
+from backends import StubBackend  # noqa: E402
+
+DEFAULT_ENDPOINTS = ",".join([
+    "proj-a:us-central1?first_token_delay_ms=200&first_token_jitter_ms=150",
+    "proj-a:us-east4?first_token_delay_ms=250&first_token_jitter_ms=400",
+    "proj-b:europe-west4?first_token_delay_ms=350&first_token_jitter_ms=100&error_rate=0.1",
+])
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+async def run(spec, hedging, requests, concurrency, response_tokens):
+    endpoints = parse_endpoints(spec)
+    for endpoint in endpoints:
+        endpoint.options.setdefault("response_tokens", response_tokens)
+        endpoint.options.setdefault("tokens_per_second", 2000)
+    pool = EndpointPool(endpoints, hedging=hedging, hedge_min_delay_ms=50)
+    backend = EndpointPoolBackend(pool, lambda ep: StubBackend(**ep.options))
+    semaphore = asyncio.Semaphore(concurrency)
+    ttfts, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        contents = [SimpleNamespace(role="user", parts=[SimpleNamespace(text=f"prompt {i}")])]
+        async with semaphore:
+            started = time.perf_counter()
+            first = None
+            try:
+                stream = await backend.stream_async("gemini-2.0-flash-001", "", contents, {})
+                async for _ in stream:
+                    if first is None:
+                        first = time.perf_counter() - started
+            except Exception:
+                errors += 1
+            if first is not None:
+                ttfts.append(first)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    ms = lambda s: round(s * 1000, 1)
+    return {
+        "hedging": hedging,
+        "elapsed_s": round(time.perf_counter() - started, 2),
+        "errors": errors,
+        "ttft_ms": {"p50": ms(percentile(ttfts, 50)), "p90": ms(percentile(ttfts, 90)), "p99": ms(percentile(ttfts, 99))},
+        **pool.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", default=DEFAULT_ENDPOINTS, help="VERTEX_ENDPOINTS-style spec with stub options")
+    parser.add_argument("-n", "--requests", type=int, default=300)
+    parser.add_argument("-c", "--concurrency", type=int, default=30)
+    parser.add_argument("--response-tokens", type=int, default=40)
+    args = parser.parse_args()
+    for hedging in (False, True):
+        print(json.dumps(asyncio.run(run(args.endpoints, hedging, args.requests, args.concurrency, args.response_tokens)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+SSE load generator for /chat.
+
+Opens N concurrent /chat streams and reports time-to-first-byte, inter-chunk latency
+percentiles, throughput and server RSS. Uses only the standard library (asyncio sockets), so
+one client process can hold thousands of streams.
+
+Typical offline run against the stub backend, comparing serving modes:
+
+    python benchmarks/sse_loadgen.py --spawn flask -c 200 -n 1000
+    python benchmarks/sse_loadgen.py --spawn asgi  -c 200 -n 1000
+
+Or point it at a running server (pass --server-pid to sample its RSS):
+
+    python benchmarks/sse_loadgen.py --url http://127.0.0.1:5000/chat -c 50 -n 200
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPTS = [
+    "Write a Python script to convert CSV to JSON",
+    "Explain quantum computing to a 12-year-old",
+    "Draft an email requesting a meeting",
+    "Summarize renewable energy benefits",
+    "5 travel blog post ideas",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * (len(values) - 1)))))
+    return values[index]
+
+
+def read_rss_kb(pid):
+    """Returns the resident set size of a process in KiB (Linux /proc), or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+class StreamResult:
+    def __init__(self):
+        self.status = None
+        self.ttfb = None
+        self.gaps = []
+        self.frames = 0
+        self.bytes = 0
+        self.duration = 0.0
+        self.error = None
+
+
+async def run_stream(host, port, path, payload, timeout):
+    """Sends one /chat request and times every SSE data frame of the response."""
+    result = StreamResult()
+    body = json.dumps(payload).encode("utf-8")
+    request = (f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+               f"Accept: text/event-stream\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("ascii") + body
+    started = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        writer.write(request)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        result.status = int(status_line.split()[1])
+        chunked = False
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b"\r\n", b""):
+                break
+            if line.lower().startswith(b"transfer-encoding:") and b"chunked" in line.lower():
+                chunked = True
+
+        buffer = b""
+        last = None
+
+        def consume(data):
+            nonlocal buffer, last
+            result.bytes += len(data)
+            buffer += data
+            while b"\n\n" in buffer:
+                frame, buffer = buffer.split(b"\n\n", 1)
+                if b"data:" not in frame:
+                    continue
+                now = time.perf_counter()
+                if result.ttfb is None:
+                    result.ttfb = now - started
+                else:
+                    result.gaps.append(now - last)
+                last = now
+                result.frames += 1
+
+        while True:
+            if chunked:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.strip().split(b";")[0] or b"0", 16)
+                if size == 0:
+                    break
+                data = await asyncio.wait_for(reader.readexactly(size + 2), timeout)
+                consume(data[:-2])
+            else:
+                data = await asyncio.wait_for(reader.read(65536), timeout)
+                if not data:
+                    break
+                consume(data)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.duration = time.perf_counter() - started
+        if writer is not None:
+            writer.close()
+    return result
+
+
+async def run_load(args):
+    url = urlparse(args.url)
+    host, port, path = url.hostname, url.port or 80, url.path or "/chat"
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+    rss_samples = []
+
+    async def one(i):
+        payload = {"prompt": f"{random.choice(PROMPTS)} #{i if args.unique else 0}", "history": [],
+                   "model": args.model, "cache": not args.no_cache}
+        async with semaphore:
+            results.append(await run_stream(host, port, path, payload, args.timeout))
+
+    async def sample_rss():
+        while True:
+            rss = read_rss_kb(args.server_pid) if args.server_pid else None
+            if rss:
+                rss_samples.append(rss)
+            await asyncio.sleep(0.25)
+
+    sampler = asyncio.create_task(sample_rss())
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    return results, elapsed, rss_samples
+
+
+def report(results, elapsed, rss_samples, args):
+    ok = [r for r in results if r.error is None and r.status == 200]
+    ttfb = [r.ttfb for r in ok if r.ttfb is not None]
+    gaps = [gap for r in ok for gap in r.gaps]
+    frames = sum(r.frames for r in ok)
+    total_bytes = sum(r.bytes for r in ok)
+    errors = {}
+    for r in results:
+        if r.error or r.status != 200:
+            key = r.error or f"HTTP {r.status}"
+            errors[key] = errors.get(key, 0) + 1
+    ms = lambda s: round(s * 1000, 1)
+    summary = {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 2),
+        "streams_per_s": round(len(ok) / elapsed, 2) if elapsed else 0,
+        "frames_per_s": round(frames / elapsed, 1) if elapsed else 0,
+        "mbytes_per_s": round(total_bytes / elapsed / 1e6, 3) if elapsed else 0,
+        "ttfb_ms": {"p50": ms(percentile(ttfb, 50)), "p90": ms(percentile(ttfb, 90)), "p99": ms(percentile(ttfb, 99))},
+        "inter_chunk_ms": {"p50": ms(percentile(gaps, 50)), "p90": ms(percentile(gaps, 90)), "p99": ms(percentile(gaps, 99))},
+        "stream_duration_ms_p50": ms(percentile([r.duration for r in ok], 50)),
+        "server_rss_mb": {"max": round(max(rss_samples) / 1024, 1), "last": round(rss_samples[-1] / 1024, 1)} if rss_samples else None,
+    }
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+def spawn_server(mode, port):
+    """Starts app.py (Flask, threaded) or asgi.py (uvicorn) against the stub backend."""
+    env = dict(os.environ, CHAT_BACKEND=os.environ.get("CHAT_BACKEND", "stub"), PORT=str(port))
+    if mode == "asgi":
+        cmd = [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port), "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "-c", f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    import urllib.request
+    # Wait for readiness so the SDK import and warmup are not billed to the first streams.
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/readyz", timeout=1)
+            return process
+        except Exception:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000/chat")
+    parser.add_argument("-c", "--concurrency", type=int, default=50, help="Concurrent open streams")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Total streams to open")
+    parser.add_argument("--model", default="gemini-2.0-flash-001")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-read timeout in seconds")
+    parser.add_argument("--unique", action="store_true", help="Make every prompt unique (defeats caching and de-duplication)")
+    parser.add_argument("--no-cache", action="store_true", help="Send \"cache\": false so the response cache is bypassed")
+    parser.add_argument("--server-pid", type=int, help="Sample this process's RSS while the load runs")
+    parser.add_argument("--spawn", choices=["flask", "asgi"], help="Start a local server on the stub backend for the run")
+    parser.add_argument("--port", type=int, default=5055, help="Port for --spawn")
+    parser.add_argument("--json-out", help="Also write the summary to this file")
+    args = parser.parse_args()
+
+    process = None
+    if args.spawn:
+        process = spawn_server(args.spawn, args.port)
+        args.url = f"http://127.0.0.1:{args.port}/chat"
+        args.server_pid = process.pid
+    try:
+        results, elapsed, rss_samples = asyncio.run(run_load(args))
+        summary = report(results, elapsed, rss_samples, args)
+        if args.json_out:
+            with open(args.json_out, "w") as f:
+                json.dump(summary, f, indent=2)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+import os
+import json
+import time
+import uuid
+import base64
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+# Server-side chat library.
+# Saved chats used to live in localStorage as one JSON array that script.js parsed and rewrote
+# whole on every save, load and delete, bounded by the browser's storage quota. They now live in
+# SQLite in WAL mode, so reads never wait for the single writer. Messages are append-only rows,
+# and an FTS5 index kept in sync by triggers backs search. Listing is keyset-paginated on
+# (updated_at, id), so a page costs the same however large a library grows. A library is keyed by
+# an opaque id the browser generates and sends as X-Library-Id. NDJSON import and export move a
+# whole library, including chats migrated from localStorage.
+
+CHAT_STORE_PATH = os.getenv("CHAT_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "chats.sqlite3"))
+CHAT_STORE_BUSY_TIMEOUT_SECONDS = float(os.getenv("CHAT_STORE_BUSY_TIMEOUT_SECONDS", "5"))
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "50"))
+CHAT_MESSAGES_PAGE_SIZE = int(os.getenv("CHAT_MESSAGES_PAGE_SIZE", "500"))
+CHAT_MAX_MESSAGE_BYTES = int(os.getenv("CHAT_MAX_MESSAGE_BYTES", str(1024 * 1024)))
+CHAT_MAX_NAME_LENGTH = 200
+CHAT_IMPORT_BATCH = 200  # Chats per import transaction.
+CHAT_IMPORT_MAX_ERRORS = 20
+
+ROLES = ("user", "model")
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    library_id TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    unread INTEGER NOT NULL DEFAULT 0,
+    external_id TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chats_by_library ON chats (library_id, updated_at DESC, id DESC);
+CREATE UNIQUE INDEX IF NOT EXISTS chats_by_external_id ON chats (library_id, external_id)
+    WHERE external_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id TEXT NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    UNIQUE (chat_id, seq)
+);
+"""
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+_CHAT_COLUMNS = "id, name, unread, message_count, created_at, updated_at"
+
+
+class ChatStoreError(ValueError):
+    """Raised for invalid or unknown chat library requests; carries the HTTP status to return."""
+
+    def __init__(self, message, status_code=400, code=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+    def to_dict(self):
+        body = {"error": str(self)}
+        if self.code:
+            body["code"] = self.code
+        return body
+
+
+def is_valid_library_id(library_id):
+    """Library ids are opaque alphanumeric tokens generated by the browser."""
+    return isinstance(library_id, str) and 16 <= len(library_id) <= 64 and library_id.isalnum()
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes an opaque page cursor; raises ChatStoreError (400) if it was tampered with."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ChatStoreError("Invalid cursor", 400, code="invalid_cursor") from None
+
+
+def fts_query(text: str):
+    """Turns free text into an FTS5 query: every word must match, the last one as a prefix."""
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in text.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def validate_messages(messages):
+    """
+    Checks client messages ({role, text}) before they are written.
+
+    Returns:
+        list: (role, text) pairs.
+    """
+    if not isinstance(messages, list):
+        raise ChatStoreError("'messages' must be a list")
+    pairs = []
+    for i, msg in enumerate(messages):
+        role = msg.get("role") if isinstance(msg, dict) else None
+        text = msg.get("text") if isinstance(msg, dict) else None
+        if role not in ROLES or not isinstance(text, str):
+            raise ChatStoreError(f"Message {i} must have a role of 'user' or 'model' and a text string")
+        if len(text.encode("utf-8")) > CHAT_MAX_MESSAGE_BYTES:
+            raise ChatStoreError(f"Message {i} is larger than {CHAT_MAX_MESSAGE_BYTES} bytes", 413,
+                                 code="message_too_large")
+        pairs.append((role, text))
+    return pairs
+
+
+def validate_name(name):
+    if not isinstance(name, str):
+        raise ChatStoreError("'name' must be a string")
+    return name.strip()[:CHAT_MAX_NAME_LENGTH]
+
+
+def chat_dict(row):
+    return {"id": row["id"], "name": row["name"], "unread": bool(row["unread"]),
+            "message_count": row["message_count"], "created_at": row["created_at"], "updated_at": row["updated_at"]}
+
+
+class ChatStore:
+    """
+    SQLite-backed chat library shared by every request thread.
+
+    Each thread keeps its own connection. Writes are serialized in-process and run in
+    BEGIN IMMEDIATE transactions, so other processes on the same file wait on the busy
+    timeout instead of failing.
+    """
+
+    def __init__(self, path: str = CHAT_STORE_PATH):
+        self.path = path
+        self.fts = False
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # An SQLite connection must not be used on both sides of a fork.
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _connect(self, check_same_thread=True):
+        conn = sqlite3.connect(self.path, timeout=CHAT_STORE_BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                               check_same_thread=check_same_thread)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # Durable across crashes of this process; WAL keeps it consistent.
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _ensure_schema(self, conn):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            conn.executescript(_SCHEMA)
+            try:
+                conn.executescript(_FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError as e:
+                # SQLite built without FTS5: search falls back to a scan.
+                logger.warning("FTS5 unavailable, chat search will scan messages: %s", e)
+            self._schema_ready = True
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = self._local.conn = self._connect()
+            self._ensure_schema(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _chat_row(self, conn, library_id, chat_id):
+        row = conn.execute(f"SELECT {_CHAT_COLUMNS} FROM chats WHERE id = ? AND library_id = ?",
+                           (chat_id, library_id)).fetchone()
+        if row is None:
+            raise ChatStoreError("Unknown chat", 404, code="chat_not_found")
+        return row
+
+    def _insert_chat(self, conn, library_id, name, unread, pairs, created_at, external_id=None):
+        chat_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO chats (id, library_id, name, unread, external_id, message_count, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, library_id, name, int(unread), external_id, len(pairs), created_at, created_at))
+        conn.executemany("INSERT INTO messages (chat_id, seq, role, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                         [(chat_id, seq, role, text, created_at) for seq, (role, text) in enumerate(pairs)])
+        return chat_id
+
+    def create_chat(self, library_id, name="", messages=None, unread=False):
+        """Creates a chat, optionally with its first messages, and returns it."""
+        name = validate_name(name)
+        pairs = validate_messages(messages or [])
+        with self._transaction() as conn:
+            chat_id = self._insert_chat(conn, library_id, name, unread, pairs, time.time())
+            return chat_dict(self._chat_row(conn, library_id, chat_id))
+
+    def append_messages(self, library_id, chat_id, messages):
+        """
+        Appends messages to a chat; earlier messages are never rewritten.
+
+        Returns:
+            dict: The updated chat.
+        """
+        pairs = validate_messages(messages)
+        now = time.time()
+        with self._transaction() as conn:
+            seq = self._chat_row(conn, library_id, chat_id)["message_count"]
+            conn.executemany("INSERT INTO messages (chat_id, seq, role, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                             [(chat_id, seq + i, role, text, now) for i, (role, text) in enumerate(pairs)])
+            conn.execute("UPDATE chats SET message_count = ?, updated_at = ? WHERE id = ?",
+                         (seq + len(pairs), now, chat_id))
+            return chat_dict(self._chat_row(conn, library_id, chat_id))
+
+    def update_chat(self, library_id, chat_id, name=None, unread=None):
+        """Renames a chat or sets its unread flag; neither counts as activity for ordering."""
+        with self._transaction() as conn:
+            self._chat_row(conn, library_id, chat_id)
+            if name is not None:
+                conn.execute("UPDATE chats SET name = ? WHERE id = ?", (validate_name(name), chat_id))
+            if unread is not None:
+                conn.execute("UPDATE chats SET unread = ? WHERE id = ?", (int(bool(unread)), chat_id))
+            return chat_dict(self._chat_row(conn, library_id, chat_id))
+
+    def delete_chat(self, library_id, chat_id):
+        with self._transaction() as conn:
+            deleted = conn.execute("DELETE FROM chats WHERE id = ? AND library_id = ?", (chat_id, library_id)).rowcount
+        if not deleted:
+            raise ChatStoreError("Unknown chat", 404, code="chat_not_found")
+
+    def get_chat(self, library_id, chat_id, start=0, limit=CHAT_MESSAGES_PAGE_SIZE):
+        """
+        Returns a chat with one page of its messages, oldest first.
+
+        Args:
+            start (int): Sequence number of the first message to return.
+            limit (int): Page size.
+
+        Returns:
+            dict: The chat plus 'messages' and 'next_start' (None on the last page).
+        """
+        conn = self._conn()
+        chat = chat_dict(self._chat_row(conn, library_id, chat_id))
+        rows = conn.execute("SELECT seq, role, text, created_at FROM messages WHERE chat_id = ? AND seq >= ? "
+                            "ORDER BY seq LIMIT ?", (chat_id, max(0, start), limit)).fetchall()
+        chat["messages"] = [{"seq": row["seq"], "role": row["role"], "text": row["text"],
+                             "created_at": row["created_at"]} for row in rows]
+        last = rows[-1]["seq"] if rows else None
+        chat["next_start"] = last + 1 if last is not None and last + 1 < chat["message_count"] else None
+        return chat
+
+    def list_chats(self, library_id, cursor=None, limit=CHAT_PAGE_SIZE):
+        """
+        Returns one page of a library's chats, most recently active first.
+
+        Returns:
+            dict: 'chats' and 'next_cursor' (None on the last page).
+        """
+        params = [library_id]
+        where = "library_id = ?"
+        if cursor:
+            updated_at, chat_id = decode_cursor(cursor)
+            where += " AND (updated_at < ? OR (updated_at = ? AND id < ?))"
+            params += [updated_at, updated_at, chat_id]
+        rows = self._conn().execute(
+            f"SELECT {_CHAT_COLUMNS} FROM chats WHERE {where} ORDER BY updated_at DESC, id DESC LIMIT ?",
+            params + [limit + 1]).fetchall()
+        chats = [chat_dict(row) for row in rows[:limit]]
+        next_cursor = encode_cursor([chats[-1]["updated_at"], chats[-1]["id"]]) if len(rows) > limit else None
+        return {"chats": chats, "next_cursor": next_cursor}
+
+    def search(self, library_id, query, cursor=None, limit=CHAT_PAGE_SIZE):
+        """
+        Full-text search over a library's messages and chat names, best match first.
+
+        Each chat appears once, with a snippet of its best-matching message.
+
+        Returns:
+            dict: 'chats' and 'next_cursor' (None on the last page).
+        """
+        offset = decode_cursor(cursor) if cursor else 0
+        if not isinstance(offset, int) or offset < 0:
+            raise ChatStoreError("Invalid cursor", 400, code="invalid_cursor")
+        like = "%{}%".format(query.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+        if self.fts and fts_query(query):
+            # FTS5 functions cannot run inside an aggregate, so rank the matching messages first;
+            # the bare snippet next to min() then comes from the best match (SQLite guarantees this).
+            hits = ("SELECT chat_id, min(rank) AS rank, snippet FROM ("
+                    "SELECT m.chat_id AS chat_id, bm25(messages_fts) AS rank, "
+                    "snippet(messages_fts, 0, '', '', '…', 16) AS snippet "
+                    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                    "JOIN chats c ON c.id = m.chat_id AND c.library_id = ? "
+                    "WHERE messages_fts MATCH ? LIMIT -1) GROUP BY chat_id")
+            hit_params = [library_id, fts_query(query)]
+        else:
+            hits = ("SELECT m.chat_id AS chat_id, 0 AS rank, substr(min(m.text), 1, 120) AS snippet "
+                    "FROM messages m JOIN chats c ON c.id = m.chat_id AND c.library_id = ? "
+                    "WHERE m.text LIKE ? ESCAPE '\\' GROUP BY m.chat_id")
+            hit_params = [library_id, like]
+        # Chats whose name matches rank ahead of message hits.
+        sql = (f"WITH hits AS ({hits}), names AS ("
+               "SELECT id AS chat_id, -1e9 AS rank, NULL AS snippet FROM chats "
+               "WHERE library_id = ? AND name LIKE ? ESCAPE '\\'), "
+               "ranked AS (SELECT chat_id, min(rank) AS rank, max(snippet) AS snippet "
+               "FROM (SELECT * FROM hits UNION ALL SELECT * FROM names) GROUP BY chat_id) "
+               f"SELECT {', '.join('c.' + column for column in _CHAT_COLUMNS.split(', '))}, r.snippet "
+               "FROM ranked r JOIN chats c ON c.id = r.chat_id "
+               "ORDER BY r.rank, c.updated_at DESC LIMIT ? OFFSET ?")
+        rows = self._conn().execute(sql, hit_params + [library_id, like, limit + 1, offset]).fetchall()
+        chats = []
+        for row in rows[:limit]:
+            chat = chat_dict(row)
+            chat["snippet"] = row["snippet"]
+            chats.append(chat)
+        return {"chats": chats, "next_cursor": encode_cursor(offset + limit) if len(rows) > limit else None}
+
+    def export_ndjson(self, library_id):
+        """
+        Yields the library as NDJSON, one chat with all its messages per line, oldest chat first.
+
+        Uses its own connection inside one read transaction, so the export is a consistent
+        snapshot even while new messages are written and whichever thread iterates it.
+        """
+        conn = self._connect(check_same_thread=False)
+        try:
+            self._ensure_schema(conn)
+            conn.execute("BEGIN")
+            chats = conn.execute(f"SELECT {_CHAT_COLUMNS} FROM chats WHERE library_id = ? ORDER BY created_at, id",
+                                 (library_id,)).fetchall()
+            for row in chats:
+                chat = chat_dict(row)
+                chat["messages"] = [
+                    {"role": msg["role"], "text": msg["text"], "created_at": msg["created_at"]}
+                    for msg in conn.execute("SELECT role, text, created_at FROM messages WHERE chat_id = ? ORDER BY seq",
+                                            (row["id"],))]
+                yield json.dumps(chat, ensure_ascii=False) + "\n"
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def import_ndjson(self, library_id, lines):
+        """
+        Imports chats from NDJSON lines.
+
+        Accepts the export format ({id, name, unread, messages}) and the old localStorage format
+        ({id, name, unread, history}). A chat whose source id was already imported into this
+        library is skipped, so a migration can safely be retried.
+
+        Returns:
+            dict: Counts of imported and skipped chats, plus up to CHAT_IMPORT_MAX_ERRORS errors.
+        """
+        result = {"imported": 0, "skipped": 0, "errors": []}
+        batch = []
+
+        def flush():
+            with self._transaction() as conn:
+                for external_id, name, unread, pairs, created_at in batch:
+                    if external_id is not None and conn.execute(
+                            "SELECT 1 FROM chats WHERE library_id = ? AND (external_id = ? OR id = ?)",
+                            (library_id, external_id, external_id)).fetchone():
+                        result["skipped"] += 1
+                        continue
+                    self._insert_chat(conn, library_id, name, unread, pairs, created_at, external_id)
+                    result["imported"] += 1
+            batch.clear()
+
+        for number, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                if not isinstance(data, dict):
+                    raise ChatStoreError("Each line must be a JSON object")
+                messages = data.get("messages", data.get("history", []))
+                pairs = validate_messages(messages)
+                unread = bool(data.get("unread")) or any(isinstance(m, dict) and m.get("unread") for m in messages)
+                external_id = str(data["id"])[:64] if data.get("id") is not None else None
+                created_at = data.get("created_at")
+                created_at = float(created_at) if isinstance(created_at, (int, float)) else time.time()
+                batch.append((external_id, validate_name(data.get("name", "")), unread, pairs, created_at))
+            except ValueError as e:
+                if len(result["errors"]) < CHAT_IMPORT_MAX_ERRORS:
+                    result["errors"].append({"line": number, "error": str(e)})
+                continue
+            if len(batch) >= CHAT_IMPORT_BATCH:
+                flush()
+        if batch:
+            flush()
+        logger.info("Chat library import finished", extra={"imported": result["imported"],
+                                                           "skipped": result["skipped"],
+                                                           "failed_lines": len(result["errors"])})
+        return result
+
+    def stats(self):
+        return {"path": self.path, "fts": self.fts, "ready": self._schema_ready}
+
+
+chat_store = ChatStore()
@@ -0,0 +1,142 @@
+import os
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from admission import admission, AdmissionRejected, PRIORITY_TITLE
+from shared_state import shared_state
+
+# Background chat-title generation.
+# Titling used to be a second blocking round trip issued after the answer finished streaming.
+# Jobs now start as soon as the first prompt arrives, run on a small worker pool, are
+# coalesced per conversation and cached, so the title can ride along with the chat stream.
+# Finished titles are also written to shared_state, so other worker processes reuse them.
+
+CHAT_TITLE_WORKERS = int(os.getenv("CHAT_TITLE_WORKERS", "4"))
+CHAT_TITLE_CACHE_SIZE = int(os.getenv("CHAT_TITLE_CACHE_SIZE", "5000"))
+CHAT_TITLE_SHARED_TTL_SECONDS = float(os.getenv("CHAT_TITLE_SHARED_TTL_SECONDS", str(24 * 3600)))
+# How long the end of a chat stream may wait for a title that is still being generated.
+CHAT_TITLE_STREAM_WAIT_SECONDS = float(os.getenv("CHAT_TITLE_STREAM_WAIT_SECONDS", "3"))
+FALLBACK_TITLE = "Untitled Chat"
+# Titles only need the opening of a conversation.
+TITLE_MAX_TURNS = int(os.getenv("CHAT_TITLE_MAX_TURNS", "4"))
+TITLE_MAX_CHARS = int(os.getenv("CHAT_TITLE_MAX_CHARS", "1000"))
+TITLE_MODEL = os.getenv("DEFAULT_CHAT_NAME_MODEL", "gemini-2.0-flash-lite-001")
+
+
+def build_title_prompt(chat_history, max_turns: int = TITLE_MAX_TURNS, max_chars: int = TITLE_MAX_CHARS):
+    """
+    Builds the titling prompt from the opening turns of a conversation.
+
+    Only the first max_turns messages are used and each is cut to max_chars, so the cost
+    of titling does not grow with the length of the chat.
+
+    Args:
+        chat_history (list): List of dictionaries with 'role' and 'text' keys.
+
+    Returns:
+        str: The user prompt sent to the chat name model.
+    """
+    lines = []
+    for msg in chat_history[:max_turns]:
+        if not isinstance(msg, dict):
+            continue
+        role = str(msg.get('role', ''))
+        text = str(msg.get('text', ''))[:max_chars]
+        lines.append(f"{role.capitalize()}: {text}")
+    conversation_text = "\n".join(lines)
+    return f"Conversation:\n{conversation_text}\n\n\nGenerate a title for this conversation:"
+
+
+def title_key(chat_history: list):
+    """Derives a coalescing key from the part of the history the titler actually reads."""
+    return hashlib.sha1(build_title_prompt(chat_history).encode("utf-8")).hexdigest()
+
+
+class TitleService:
+    """Runs title generation off the request path, one job per conversation key."""
+
+    def __init__(self, workers: int = CHAT_TITLE_WORKERS, cache_size: int = CHAT_TITLE_CACHE_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="chat-title")
+        self._cache_size = max(1, cache_size)
+        self._titles = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def request(self, key: str, chat_history: list, client_id: str = None):
+        """
+        Starts (or joins) the title job for a conversation.
+
+        Args:
+            key (str): Conversation key; concurrent requests with the same key share one job.
+            chat_history (list): Client-format messages; only the opening turns are used.
+            client_id (str, optional): Client the job is queued under for admission control.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the title string.
+        """
+        title = self.get(key)
+        if title is not None:
+            return _completed(title)
+        with self._lock:
+            title = self._titles.get(key)
+            if title is not None:
+                return _completed(title)
+            future = self._pending.get(key)
+            if future is None:
+                # The job runs in the requester's context so its spans land in the request's trace.
+                future = self._executor.submit(contextvars.copy_context().run, self._generate,
+                                               key, list(chat_history), client_id)
+                self._pending[key] = future
+            return future
+
+    def get(self, key: str):
+        """Returns the finished title for a key, or None if it is unknown or still running."""
+        with self._lock:
+            title = self._titles.get(key)
+            if title is not None:
+                self._titles.move_to_end(key)
+                return title
+        title = shared_state.get("title", key)
+        if title is not None:
+            self._remember(key, title)
+        return title
+
+    def _remember(self, key: str, title: str):
+        with self._lock:
+            self._titles[key] = title
+            while len(self._titles) > self._cache_size:
+                self._titles.popitem(last=False)
+
+    def is_pending(self, key: str):
+        with self._lock:
+            return key in self._pending
+
+    def _generate(self, key: str, chat_history: list, client_id: str = None):
+        # Imported lazily so the title model is only initialized once titling is used.
+        from name_chat import generate_chat_name
+        title = FALLBACK_TITLE
+        try:
+            # Titles queue behind chat streams and do not spend the client's rate budget.
+            with admission.acquire(client_id or "title-service", TITLE_MODEL, PRIORITY_TITLE, consume=False):
+                title = generate_chat_name(chat_history)
+            return title
+        except AdmissionRejected:
+            return title
+        finally:
+            # The fallback title is returned but not cached, so a later request can retry.
+            if title and title != FALLBACK_TITLE:
+                self._remember(key, title)
+                shared_state.put("title", key, title, CHAT_TITLE_SHARED_TTL_SECONDS)
+            with self._lock:
+                self._pending.pop(key, None)
+
+
+def _completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+title_service = TitleService()
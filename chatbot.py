@@ -1,62 +1,283 @@
 import os
-import vertexai
-import traceback # For detailed error logging
-# Import HarmBlockThreshold along with other necessary classes
-from vertexai.generative_models import (
-    GenerativeModel,
-    Part,
-    Content,
-    GenerationConfig,
-    SafetySetting,
-    HarmCategory,
-    HarmBlockThreshold # <-- Correct import
-)
-from google.cloud import aiplatform # Ensure google-cloud-aiplatform is installed
+import time
+import logging
+import itertools
 from dotenv import load_dotenv
+from backends import get_backend
+from vertex_runtime import generative_models, make_content, content_class, SDK_FREE
+from context_cache import context_cache
+import tracing
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize Vertex AI SDK
-try:
-    project_id = os.getenv("GOOGLE_PROJECT_ID")
-    location = os.getenv("GOOGLE_LOCATION")
-    if not project_id or not location:
-        raise ValueError("GOOGLE_PROJECT_ID and GOOGLE_LOCATION must be set in .env file")
-    vertexai.init(project=project_id, location=location)
-    print(f"Vertex AI initialized for project: {project_id} in location: {location}")
-except Exception as e:
-    print(f"Error initializing Vertex AI: {e}")
-    # Handle initialization error appropriately (e.g., exit or raise)
-    # For now, let's raise it to stop execution if initialization fails
-    raise
-
-# --- CORRECTED safety_settings ---
-# Define safety settings using the SafetySetting constructor and HarmBlockThreshold enum
-# Note: BLOCK_NONE allows potentially harmful content. Adjust thresholds for production.
-# Common thresholds: BLOCK_ONLY_HIGH, BLOCK_MEDIUM_AND_ABOVE, BLOCK_LOW_AND_ABOVE
-safety_settings = [
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-        threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
-    ),
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-        threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
-    ),
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-        threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
-    ),
-    SafetySetting(
-        category=HarmCategory.HARM_CATEGORY_HARASSMENT,
-        threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
-    ),
-]
-# --- End of Correction ---
-
-
-def get_gemini_response_stream(model_name: str, user_prompt: str, system_instruction: str, chat_history: list = None):
+logger = logging.getLogger(__name__)
+
+# The Vertex AI SDK is imported and initialized lazily by vertex_runtime on first use,
+# so importing this module is cheap and never raises on missing configuration.
+
+_safety_settings = None
+
+
+def get_safety_settings():
+    """Returns the chat safety settings, built once so the model pool can key on them."""
+    global _safety_settings
+    if SDK_FREE:
+        # The stub backend applies no safety settings, and building them would import the SDK.
+        return []
+    if _safety_settings is None:
+        gm = generative_models()
+        SafetySetting, HarmCategory, HarmBlockThreshold = gm.SafetySetting, gm.HarmCategory, gm.HarmBlockThreshold
+        # --- CORRECTED safety_settings ---
+        # Define safety settings using the SafetySetting constructor and HarmBlockThreshold enum
+        # Note: BLOCK_NONE allows potentially harmful content. Adjust thresholds for production.
+        # Common thresholds: BLOCK_ONLY_HIGH, BLOCK_MEDIUM_AND_ABOVE, BLOCK_LOW_AND_ABOVE
+        _safety_settings = [
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
+            ),
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
+            ),
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
+            ),
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=HarmBlockThreshold.BLOCK_NONE # Use the enum directly
+            ),
+        ]
+        # --- End of Correction ---
+    return _safety_settings
+
+# Prefixes of the bracketed status strings the stream yields instead of model text.
+# Mirrors the list script.js uses to render a message as an error.
+ERROR_MARKER_PREFIXES = (
+    "[Error", "[Content Blocked", "[Prompt Blocked", "[API", "[Internal Error", "[Stream Error",
+)
+
+
+def is_error_marker(text: str):
+    """Returns True if a streamed chunk is an error or safety-block marker rather than model text."""
+    return text.startswith(ERROR_MARKER_PREFIXES)
+
+# --- Generation Configuration ---
+# Shared by the sync and async streaming calls; the model pool builds the GenerationConfig once.
+CHAT_GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "top_p": 0.8,
+    "max_output_tokens": 8192, # Increased from 1024
+}
+
+
+def _build_conversation(user_prompt: str, chat_history: list = None):
+    """
+    Builds the list of Content objects sent to the model for one turn.
+
+    Args:
+        user_prompt (str): The user's input prompt.
+        chat_history (list, optional): Previous Content objects. Defaults to None.
+
+    Returns:
+        tuple: (conversation, error_message). error_message is None when the conversation is valid.
+    """
+    conversation = []
+    if chat_history:
+        # Basic validation of history items
+        Content = content_class()
+        valid_history = [item for item in chat_history if isinstance(item, Content) and hasattr(item, 'role') and hasattr(item, 'parts')]
+        if len(valid_history) != len(chat_history):
+             logger.warning("Some items in provided chat_history were invalid", extra={"invalid_items": len(chat_history) - len(valid_history)})
+        conversation.extend(valid_history)
+
+    # Ensure the last message is always the new user prompt before sending
+    if not user_prompt:
+        # Do not proceed if there's no user prompt
+        logger.error("User prompt is empty")
+        return None, "[Error: Cannot generate response without user input]"
+    # Make sure parts is a list, even for a single text part
+    conversation.append(make_content("user", user_prompt))
+
+    # Final check: The API requires the conversation to end with a 'user' role message.
+    if conversation[-1].role != "user":
+        logger.error("Conversation history does not end with a user message (last role: %s)", conversation[-1].role)
+        return None, "[Internal Error: Invalid conversation history state]"
+    return conversation, None
+
+
+def warmup_chat_model(model_name: str = None, system_instruction: str = ""):
+    """Pre-opens the pooled connection used for chat streams (defaults to DEFAULT_GEMINI_MODEL)."""
+    model_name = model_name or os.getenv("DEFAULT_GEMINI_MODEL", "gemini-2.0-flash-001")
+    return get_backend().warmup(model_name, system_instruction, CHAT_GENERATION_CONFIG, get_safety_settings())
+
+
+def _process_chunk(chunk):
+    """
+    Extracts the text of one streamed chunk and checks it for safety blocks.
+
+    Args:
+        chunk: A GenerationResponse received from the streaming call.
+
+    Returns:
+        tuple: (texts, stop_message, finish_reason). texts is the list of strings to yield;
+        stop_message, when set, is the last string to yield before ending the stream.
+    """
+    texts = []
+    # Check for blocked content FIRST
+    # Corrected check: finish_reason might indicate safety block.
+    finish_reason = None
+    safety_ratings_info = "" # Initialize safety ratings info string
+
+    if chunk.candidates and chunk.candidates[0].finish_reason:
+        finish_reason = chunk.candidates[0].finish_reason.name
+        if finish_reason == "SAFETY":
+            block_reason_message = "Blocked due to SAFETY"
+            # Safety ratings are usually on the candidate when blocked
+            if chunk.candidates[0].safety_ratings:
+                ratings = [f"{rating.category.name}: {rating.probability.name}" for rating in chunk.candidates[0].safety_ratings]
+                safety_ratings_info = f" Details: {'; '.join(ratings)}"
+            logger.warning("Response blocked. %s%s", block_reason_message, safety_ratings_info)
+            return texts, f"[Content Blocked: {block_reason_message}]", finish_reason
+
+        elif finish_reason not in ["STOP", "MAX_TOKENS", "UNSPECIFIED"]: # Log other reasons
+             logger.info("Stream finished with reason: %s", finish_reason)
+
+    # Check for prompt feedback (can be on early chunks)
+    # prompt_feedback is less common for blocking the *response*, usually blocks the prompt itself
+    if hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback.block_reason:
+         block_reason_message = f"Reason: {chunk.prompt_feedback.block_reason.name}" if chunk.prompt_feedback.block_reason else "Reason unspecified."
+         if chunk.prompt_feedback.safety_ratings: # Include details if available
+             ratings = [f"{rating.category.name}: {rating.probability.name}" for rating in chunk.prompt_feedback.safety_ratings]
+             safety_ratings_info = f" Details: {'; '.join(ratings)}"
+         logger.warning("Prompt blocked. %s%s", block_reason_message, safety_ratings_info)
+         return texts, f"[Prompt Blocked: {block_reason_message}]", finish_reason
+
+
+    # Process text content if available
+    try:
+        # Primary way to get text
+        if hasattr(chunk, 'text') and chunk.text:
+            texts.append(chunk.text)
+        # Fallback: check candidate parts (less common for pure text models but good practice)
+        elif hasattr(chunk, 'candidates') and chunk.candidates:
+            for candidate in chunk.candidates:
+                 if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
+                      for part in candidate.content.parts:
+                           if hasattr(part, 'text') and part.text:
+                                texts.append(part.text)
+    except ValueError as ve:
+         # Logged without the chunk itself: dumping whole responses is slow and floods the log.
+         logger.warning("ValueError processing chunk: %s", ve, extra={"finish_reason": finish_reason})
+         tracing.add_event("chunk_error", error=str(ve), finish_reason=finish_reason)
+    except AttributeError as ae:
+         logger.warning("AttributeError processing chunk: %s", ae, extra={"finish_reason": finish_reason})
+         tracing.add_event("chunk_error", error=str(ae), finish_reason=finish_reason)
+    except Exception as e:
+        logger.error("Error processing chunk content: %s", e)
+        tracing.add_event("chunk_error", error=str(e), finish_reason=finish_reason)
+        texts.append(f"[Error processing part of the response: {e}]")
+    return texts, None, finish_reason
+
+
+def _open_stream(model_name: str, system_instruction: str, conversation: list, stable_prefix: int = None):
+    """
+    Starts the model stream, through a context cache when one covers the conversation prefix.
+
+    A cached call that fails before its first chunk (the cache expired or was deleted upstream)
+    drops the cache and is resent with the full conversation.
+
+    Returns:
+        tuple: (stream, chunks already read from it, CachePlan used or None).
+    """
+    backend = get_backend()
+    plan = context_cache.plan(backend, model_name, system_instruction, conversation, stable_prefix)
+    if plan is not None:
+        stream = None
+        try:
+            stream = backend.stream(model_name, system_instruction, plan.contents, CHAT_GENERATION_CONFIG,
+                                    get_safety_settings(), cached_content=plan.handle)
+            first = next(iter(stream), None)
+            return stream, [first] if first is not None else [], plan
+        except Exception as e:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+            context_cache.fallback(plan, e)
+    stream = backend.stream(model_name, system_instruction, conversation, CHAT_GENERATION_CONFIG, get_safety_settings())
+    return stream, [], None
+
+
+async def _open_stream_async(model_name: str, system_instruction: str, conversation: list, stable_prefix: int = None):
+    """Async counterpart of _open_stream."""
+    backend = get_backend()
+    plan = context_cache.plan(backend, model_name, system_instruction, conversation, stable_prefix)
+    if plan is not None:
+        stream = None
+        try:
+            stream = await backend.stream_async(model_name, system_instruction, plan.contents, CHAT_GENERATION_CONFIG,
+                                                get_safety_settings(), cached_content=plan.handle)
+            try:
+                first = [await stream.__aiter__().__anext__()]
+            except StopAsyncIteration:
+                first = []
+            return stream, first, plan
+        except Exception as e:
+            if stream is not None and hasattr(stream, 'aclose'):
+                await stream.aclose()
+            context_cache.fallback(plan, e)
+    stream = await backend.stream_async(model_name, system_instruction, conversation, CHAT_GENERATION_CONFIG,
+                                        get_safety_settings())
+    return stream, [], None
+
+
+async def _achain(first_chunks: list, stream):
+    for chunk in first_chunks:
+        yield chunk
+    async for chunk in stream:
+        yield chunk
+
+
+def _first_chunk(upstream, ttft: float, cache_plan):
+    # Time to first chunk is where a slow reply usually loses its time, so it goes on the span.
+    if upstream is not None:
+        upstream.set(ttft_ms=round(ttft * 1000, 1), context_cache=cache_plan is not None)
+        upstream.event("first_chunk")
+
+
+def _end_upstream(upstream, chunks: int, finish_reason, error: Exception = None):
+    if upstream is None:
+        return
+    upstream.set(chunks=chunks, finish_reason=str(finish_reason) if finish_reason is not None else None)
+    if error is not None:
+        upstream.fail(error)
+    upstream.finish()
+
+
+def _log_stream_start(model_name: str, system_instruction: str, chat_history: list = None):
+    # The prompt itself is never logged; it can be very long.
+    logger.debug("Gemini stream started", extra={
+        "model": model_name,
+        "system_instruction": bool(system_instruction),
+        "history_length": len(chat_history) if chat_history else 0,
+    })
+
+
+def _log_stream_end(content_generated: bool, finish_reason):
+    # If the loop finishes without yielding any text content
+    if not content_generated:
+        # Check if the finish reason was STOP or MAX_TOKENS, which is normal for empty responses
+        if finish_reason not in ["STOP", "MAX_TOKENS"]:
+            logger.warning("Stream finished (reason: %s) without generating any text", finish_reason)
+            # yield "[No text response received]" # Optional: Send message to user
+
+    # Indicate successful end of stream processing (optional)
+    logger.debug("Gemini stream finished", extra={"finish_reason": finish_reason})
+
+
+def get_gemini_response_stream(model_name: str, user_prompt: str, system_instruction: str, chat_history: list = None,
+                               stable_prefix: int = None):
     """
     Generates content from the Gemini model using streaming.
 
@@ -65,146 +286,132 @@ def get_gemini_response_stream(model_name: str, user_prompt: str, system_instruc
         user_prompt (str): The user's input prompt.
         system_instruction (str): System instructions for the model.
         chat_history (list, optional): A list of previous Content objects representing the conversation history. Defaults to None.
+        stable_prefix (int, optional): Leading history messages that stay the same across turns when
+            the history was trimmed (ContextReport.stable_prefix); bounds the context cache.
 
     Yields:
         str: Chunks of the generated text or error messages prefixed with [Error].
     """
+    stream = upstream = error = None
+    chunks = 0
+    finish_reason = None
     try:
-        model = GenerativeModel(
-            model_name,
-            system_instruction=[Part.from_text(system_instruction)] if system_instruction else None
-        )
-
         # Construct the full conversation history including the new user prompt
-        conversation = []
-        if chat_history:
-            # Basic validation of history items
-            valid_history = [item for item in chat_history if isinstance(item, Content) and hasattr(item, 'role') and hasattr(item, 'parts')]
-            if len(valid_history) != len(chat_history):
-                 print("Warning: Some items in provided chat_history were invalid.")
-            conversation.extend(valid_history)
-
-        # Ensure the last message is always the new user prompt before sending
-        if user_prompt:
-             # Make sure parts is a list, even for a single text part
-             conversation.append(Content(role="user", parts=[Part.from_text(user_prompt)]))
-        else:
-             # Do not proceed if there's no user prompt
-             print("Error: User prompt is empty.")
-             yield "[Error: Cannot generate response without user input]"
-             return # Stop execution for this request
-
-        # --- Generation Configuration ---
-        generation_config = GenerationConfig(
-            temperature=0.2,
-            top_p=0.8,
-            max_output_tokens=8192, # Increased from 1024
-        )
-
-        # Final check: The API requires the conversation to end with a 'user' role message.
-        if not conversation or conversation[-1].role != "user":
-            print(f"Error: Conversation history does not end with a user message. Last role: {conversation[-1].role if conversation else 'None'}")
-            yield "[Internal Error: Invalid conversation history state]"
-            return
-
+        with tracing.span("conversation.build", history_length=len(chat_history) if chat_history else 0):
+            conversation, error_message = _build_conversation(user_prompt, chat_history)
+        if error_message:
+            yield error_message
+            return # Stop execution for this request
 
         # --- Start streaming generation ---
-        stream = model.generate_content(
-            contents=conversation,
-            generation_config=generation_config,
-            safety_settings=safety_settings, # Pass the corrected list here
-            stream=True
-        )
-
-        print("--- Gemini API Call ---")
-        print(f"Model: {model_name}")
-        print(f"System Instruction: {'Provided' if system_instruction else 'None'}")
-        print(f"History Length (Content objects): {len(chat_history) if chat_history else 0}")
-        # print(f"User Prompt: {user_prompt[:100]}...") # Avoid printing very long prompts
-        print("-----------------------")
-
+        started = time.perf_counter()
+        # Not a `with` block: the span stays open across this generator's yields.
+        upstream = tracing.start_span("upstream.stream", model=model_name)
+        stream, first_chunks, cache_plan = _open_stream(model_name, system_instruction, conversation, stable_prefix)
+        _log_stream_start(model_name, system_instruction, chat_history)
 
         # --- Process the stream ---
         content_generated = False # Flag to track if any text content was yielded
-        for chunk in stream:
-            # Check for blocked content FIRST
-            # Corrected check: finish_reason might indicate safety block.
-            finish_reason = None
-            safety_ratings_info = "" # Initialize safety ratings info string
-
-            if chunk.candidates and chunk.candidates[0].finish_reason:
-                finish_reason = chunk.candidates[0].finish_reason.name
-                if finish_reason == "SAFETY":
-                    block_reason_message = "Blocked due to SAFETY"
-                    # Safety ratings are usually on the candidate when blocked
-                    if chunk.candidates[0].safety_ratings:
-                        ratings = [f"{rating.category.name}: {rating.probability.name}" for rating in chunk.candidates[0].safety_ratings]
-                        safety_ratings_info = f" Details: {'; '.join(ratings)}"
-                    print(f"Response blocked. {block_reason_message}{safety_ratings_info}")
-                    yield f"[Content Blocked: {block_reason_message}]"
-                    return # Stop the generator
-
-                elif finish_reason not in ["STOP", "MAX_TOKENS", "UNSPECIFIED"]: # Log other reasons
-                     print(f"Stream finished with reason: {finish_reason}")
-
-            # Check for prompt feedback (can be on early chunks)
-            # prompt_feedback is less common for blocking the *response*, usually blocks the prompt itself
-            if hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback.block_reason:
-                 block_reason_message = f"Reason: {chunk.prompt_feedback.block_reason.name}" if chunk.prompt_feedback.block_reason else "Reason unspecified."
-                 if chunk.prompt_feedback.safety_ratings: # Include details if available
-                     ratings = [f"{rating.category.name}: {rating.probability.name}" for rating in chunk.prompt_feedback.safety_ratings]
-                     safety_ratings_info = f" Details: {'; '.join(ratings)}"
-                 print(f"Prompt blocked. {block_reason_message}{safety_ratings_info}")
-                 yield f"[Prompt Blocked: {block_reason_message}]"
-                 return # Stop the generator
-
-
-            # Process text content if available
-            try:
-                # Primary way to get text
-                if hasattr(chunk, 'text') and chunk.text:
-                    # print(f"DEBUG chunk.text: {chunk.text}") # Debugging
-                    yield chunk.text
-                    content_generated = True
-                # Fallback: check candidate parts (less common for pure text models but good practice)
-                elif hasattr(chunk, 'candidates') and chunk.candidates:
-                    for candidate in chunk.candidates:
-                         if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                              for part in candidate.content.parts:
-                                   if hasattr(part, 'text') and part.text:
-                                        # print(f"DEBUG part.text: {part.text}") # Debugging
-                                        yield part.text
-                                        content_generated = True
-            except ValueError as ve:
-                 print(f"ValueError processing chunk: {ve}. Chunk: {chunk}")
-                 pass
-            except AttributeError as ae:
-                 print(f"AttributeError processing chunk: {ae}. Chunk: {chunk}")
-                 pass
-            except Exception as e:
-                print(f"Error processing chunk content: {e}")
-                yield f"[Error processing part of the response: {e}]"
-                pass
-
-        # If the loop finishes without yielding any text content
-        if not content_generated:
-            # Check if the finish reason was STOP or MAX_TOKENS, which is normal for empty responses
-            if finish_reason not in ["STOP", "MAX_TOKENS"]:
-                print(f"Warning: Stream finished (Reason: {finish_reason}), but no text content was generated or yielded.")
-                # yield "[No text response received]" # Optional: Send message to user
-
-        # Indicate successful end of stream processing (optional)
-        print("--- End of Gemini Stream ---")
+        ttft = usage = None
+        for chunk in itertools.chain(first_chunks, stream):
+            chunks += 1
+            if ttft is None:
+                ttft = time.perf_counter() - started
+                _first_chunk(upstream, ttft, cache_plan)
+            usage = getattr(chunk, 'usage_metadata', None) or usage
+            texts, stop_message, finish_reason = _process_chunk(chunk)
+            if stop_message:
+                yield stop_message
+                return # Stop the generator
+            for text in texts:
+                yield text
+                content_generated = True
+
+        _log_stream_end(content_generated, finish_reason)
+        context_cache.record(cache_plan, ttft, usage, system_instruction, conversation)
 
 
     except ValueError as ve:
         # Errors during the initial setup or API call initiation
-        print(f"ValueError during generation setup or call: {ve}")
+        logger.error("ValueError during generation setup or call: %s", ve)
+        error = ve
         yield f"[API Configuration Error: {ve}]"
     except Exception as e:
         # Catch-all for other unexpected errors during the process
-        print(f"An unexpected error occurred in get_gemini_response_stream: {e}\n{traceback.format_exc()}")
+        logger.exception("Unexpected error in get_gemini_response_stream: %s", e)
+        error = e
         yield f"[Error: An unexpected error occurred. Please check server logs.]"
+    finally:
+        _end_upstream(upstream, chunks, finish_reason, error)
+        # Closing the SDK stream drops its gRPC call, which cancels generation if the client left early.
+        if stream is not None and hasattr(stream, 'close'):
+            stream.close()
+
+
+async def get_gemini_response_stream_async(model_name: str, user_prompt: str, system_instruction: str, chat_history: list = None,
+                                           stable_prefix: int = None):
+    """
+    Async counterpart of get_gemini_response_stream, built on the SDK's async streaming call.
+
+    While waiting on Vertex the coroutine is parked on the event loop instead of holding
+    an OS thread, so one process can keep many streams open at once.
+
+    Args:
+        model_name (str): The name of the Gemini model to use.
+        user_prompt (str): The user's input prompt.
+        system_instruction (str): System instructions for the model.
+        chat_history (list, optional): A list of previous Content objects. Defaults to None.
+        stable_prefix (int, optional): See get_gemini_response_stream.
+
+    Yields:
+        str: Chunks of the generated text or error messages prefixed with [Error].
+    """
+    stream = upstream = error = None
+    chunks = 0
+    finish_reason = None
+    try:
+        with tracing.span("conversation.build", history_length=len(chat_history) if chat_history else 0):
+            conversation, error_message = _build_conversation(user_prompt, chat_history)
+        if error_message:
+            yield error_message
+            return
+
+        started = time.perf_counter()
+        upstream = tracing.start_span("upstream.stream", model=model_name)
+        stream, first_chunks, cache_plan = await _open_stream_async(model_name, system_instruction, conversation, stable_prefix)
+        _log_stream_start(model_name, system_instruction, chat_history)
+
+        content_generated = False
+        ttft = usage = None
+        async for chunk in _achain(first_chunks, stream):
+            chunks += 1
+            if ttft is None:
+                ttft = time.perf_counter() - started
+                _first_chunk(upstream, ttft, cache_plan)
+            usage = getattr(chunk, 'usage_metadata', None) or usage
+            texts, stop_message, finish_reason = _process_chunk(chunk)
+            if stop_message:
+                yield stop_message
+                return
+            for text in texts:
+                yield text
+                content_generated = True
+
+        _log_stream_end(content_generated, finish_reason)
+        context_cache.record(cache_plan, ttft, usage, system_instruction, conversation)
+
+    except ValueError as ve:
+        logger.error("ValueError during async generation setup or call: %s", ve)
+        error = ve
+        yield f"[API Configuration Error: {ve}]"
+    except Exception as e:
+        logger.exception("Unexpected error in get_gemini_response_stream_async: %s", e)
+        error = e
+        yield "[Error: An unexpected error occurred. Please check server logs.]"
+    finally:
+        _end_upstream(upstream, chunks, finish_reason, error)
+        if stream is not None and hasattr(stream, 'aclose'):
+            await stream.aclose()
 
 
 # Example usage (optional, for testing chatbot.py directly)
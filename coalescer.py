@@ -0,0 +1,188 @@
+import os
+import re
+import time
+import asyncio
+import threading
+
+# Adaptive SSE chunk coalescing.
+# Vertex often streams many small chunks, and each one used to cost a json.dumps, an SSE frame,
+# a socket write and a full markdown re-render in script.js. The coalescer sits between the
+# answer chunks and the SSE writer and merges them into fewer frames. It flushes when enough
+# bytes are buffered, when the oldest buffered text has waited long enough, or at a sentence or
+# code-fence boundary. The first chunk is always sent on its own so time-to-first-byte is
+# unchanged.
+
+SSE_COALESCE = os.getenv("SSE_COALESCE", "1") != "0"
+SSE_COALESCE_MIN_BYTES = int(os.getenv("SSE_COALESCE_MIN_BYTES", "128"))
+SSE_COALESCE_MAX_DELAY_MS = float(os.getenv("SSE_COALESCE_MAX_DELAY_MS", "50"))
+SSE_COALESCE_BOUNDARIES = os.getenv("SSE_COALESCE_BOUNDARIES", "1") != "0"
+
+# End of a sentence or paragraph, optionally followed by closing quotes/brackets and whitespace.
+_SENTENCE_END = re.compile(r"(?:[.!?:;](?:[\"')\]]*)\s*|\n\n)$")
+
+
+class ChunkCoalescer:
+    """
+    Merges answer chunks into SSE frames according to a flush policy, and counts its effect.
+
+    Args:
+        min_bytes (int): Flush once this many bytes are buffered.
+        max_delay_ms (float): Flush once the oldest buffered text has waited this long.
+        boundaries (bool): Also flush at sentence ends and code fences, once a quarter of
+            min_bytes is buffered.
+        enabled (bool): When False every chunk becomes its own frame (stats are still kept).
+    """
+
+    def __init__(self, min_bytes: int = SSE_COALESCE_MIN_BYTES, max_delay_ms: float = SSE_COALESCE_MAX_DELAY_MS,
+                 boundaries: bool = SSE_COALESCE_BOUNDARIES, enabled: bool = SSE_COALESCE):
+        self.min_bytes = max(1, min_bytes)
+        self.max_delay = max(0.0, max_delay_ms) / 1000.0
+        self.boundaries = boundaries
+        self.enabled = enabled
+        # Held by whoever pushes or flushes when chunks and deadlines are handled on different threads.
+        self.lock = threading.RLock()
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_since = None
+        self.chunks_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.flushes = {}  # reason -> count
+
+    def time_to_deadline(self):
+        """Seconds until buffered text is due, or None when nothing is buffered."""
+        if self._buffered_since is None:
+            return None
+        return max(0.0, self._buffered_since + self.max_delay - time.perf_counter())
+
+    def _at_boundary(self, chunk: str):
+        if "```" in chunk and chunk.endswith("\n"):
+            return True
+        return _SENTENCE_END.search(chunk) is not None
+
+    def push(self, chunk: str, passthrough: bool = False):
+        """
+        Adds one chunk and returns the frames to send now (usually zero or one).
+
+        Args:
+            chunk (str): Answer text from the stream.
+            passthrough (bool): Send the chunk as its own frame after flushing the buffer
+                (used for error and block markers, which the client matches by prefix).
+
+        Returns:
+            list: Texts to send as SSE data frames, in order.
+        """
+        self.chunks_in += 1
+        if passthrough or not self.enabled:
+            frames = self._flush_frames("marker" if passthrough else "disabled")
+            return frames + [self._emit(chunk, "marker" if passthrough else "disabled")]
+        if self.frames_out == 0 and not self._buffer:
+            return [self._emit(chunk, "first")]
+
+        now = time.perf_counter()
+        if self._buffered_since is None:
+            self._buffered_since = now
+        self._buffer.append(chunk)
+        self._buffered_bytes += len(chunk.encode("utf-8"))
+
+        if self._buffered_bytes >= self.min_bytes:
+            return self._flush_frames("bytes")
+        if now - self._buffered_since >= self.max_delay:
+            return self._flush_frames("delay")
+        if self.boundaries and self._buffered_bytes * 4 >= self.min_bytes and self._at_boundary(chunk):
+            return self._flush_frames("boundary")
+        return []
+
+    def flush(self, reason: str = "end"):
+        """Returns the buffered text as one frame, or None if the buffer is empty."""
+        frames = self._flush_frames(reason)
+        return frames[0] if frames else None
+
+    def flush_due(self):
+        """Returns the buffered text as one frame if its max-delay deadline has passed, else None."""
+        due = self.time_to_deadline()
+        if due is None or due > 0:
+            return None
+        return self.flush("delay")
+
+    def _flush_frames(self, reason):
+        if not self._buffer:
+            return []
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_since = None
+        return [self._emit(text, reason)]
+
+    def _emit(self, text, reason):
+        self.frames_out += 1
+        self.bytes_out += len(text.encode("utf-8"))
+        self.flushes[reason] = self.flushes.get(reason, 0) + 1
+        return text
+
+    def stats(self):
+        return {
+            "chunks_in": self.chunks_in,
+            "frames_out": self.frames_out,
+            "bytes_out": self.bytes_out,
+            "coalesce_ratio": round(self.chunks_in / self.frames_out, 2) if self.frames_out else None,
+            "flushes": dict(self.flushes),
+        }
+
+
+def coalesce(chunks, coalescer: ChunkCoalescer, is_marker=None):
+    """
+    Yields coalesced frame texts for a synchronous chunk iterator.
+
+    Buffered text is flushed when a chunk arrives. While the upstream is quiet, the readers of a
+    resumable stream flush it on the max-delay deadline instead (see ChatRequest.flush_due), so
+    the coalescer's lock is held from each push until the caller has handled its frames; a
+    deadline flush can then never overtake text that was pushed before it.
+    """
+    for chunk in chunks:
+        with coalescer.lock:
+            for text in coalescer.push(chunk, passthrough=bool(is_marker and is_marker(chunk))):
+                yield text
+    with coalescer.lock:
+        text = coalescer.flush()
+        if text is not None:
+            yield text
+
+
+async def acoalesce(chunks, coalescer: ChunkCoalescer, is_marker=None):
+    """
+    Async counterpart of coalesce that also flushes on the max-delay deadline while the
+    upstream is quiet, so buffered text never waits longer than max_delay_ms.
+    """
+    iterator = chunks.__aiter__()
+    pending = None
+    try:
+        while True:
+            timeout = coalescer.time_to_deadline()
+            if timeout is None and pending is None:
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    text = coalescer.flush("delay")
+                    if text is not None:
+                        yield text
+                    continue
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+            for text in coalescer.push(chunk, passthrough=bool(is_marker and is_marker(chunk))):
+                yield text
+        text = coalescer.flush()
+        if text is not None:
+            yield text
+    finally:
+        if pending is not None:
+            pending.cancel()
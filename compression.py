@@ -0,0 +1,156 @@
+import os
+import time
+import zlib
+import metrics
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip is offered.
+    brotli = None
+
+# Negotiated response compression that keeps SSE streaming.
+# Answers are markdown and code, which compress several times over, and on slow links transfer
+# time dominates. Stream compressors are flushed after every SSE frame (one coalesced batch),
+# so the client can decode each frame as soon as it arrives and streaming latency is unchanged;
+# the flush only costs a few bytes per frame. JSON bodies are compressed whole once they pass
+# COMPRESS_MIN_BYTES; smaller ones are not worth the CPU or the header.
+
+COMPRESSION = os.getenv("COMPRESSION", "1") != "0"
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+# Low qualities keep brotli's per-frame CPU close to gzip while still compressing better.
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+
+# Server preference when the client weighs several encodings equally.
+_PREFERENCE = ("br", "gzip")
+
+
+def available_encodings():
+    return tuple(encoding for encoding in _PREFERENCE if encoding != "br" or brotli is not None)
+
+
+def accepted_encodings(accept_encoding, candidates=_PREFERENCE):
+    """
+    Returns the candidate encodings an Accept-Encoding header allows, best first.
+
+    Ties keep the order of candidates (the server's preference).
+    """
+    if not accept_encoding:
+        return []
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    wildcard = weights.get("*", 0.0)
+    ranked = [(weights.get(encoding, wildcard), -i, encoding) for i, encoding in enumerate(candidates)]
+    return [encoding for weight, _, encoding in sorted(ranked, reverse=True) if weight > 0]
+
+
+def negotiate(accept_encoding, enabled: bool = COMPRESSION):
+    """
+    Picks the encoding for a response compressed on the fly.
+
+    Returns:
+        str: "br" or "gzip", or None to send the body uncompressed.
+    """
+    if not enabled:
+        return None
+    encodings = accepted_encodings(accept_encoding, available_encodings())
+    return encodings[0] if encodings else None
+
+
+def response_headers(encoding):
+    """Headers for a response compressed with encoding."""
+    return {"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+
+
+class StreamCompressor:
+    """
+    Incremental gzip or brotli compressor whose output is decodable after every compress() call.
+
+    Counts bytes in and out and the CPU time spent, per stream, for metrics and benchmarks.
+    """
+
+    def __init__(self, encoding: str, gzip_level: int = COMPRESS_GZIP_LEVEL,
+                 brotli_quality: int = COMPRESS_BROTLI_QUALITY):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # 31: gzip container
+        elif encoding == "br":
+            if brotli is None:
+                raise ValueError("brotli is not installed")
+            self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=brotli_quality)
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def compress(self, data):
+        """Compresses one frame and flushes, returning bytes the client can decode right away."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        started = time.perf_counter()
+        if self.encoding == "gzip":
+            out = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            out = self._compressor.process(data) + self._compressor.flush()
+        self.cpu_seconds += time.perf_counter() - started
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return out
+
+    def finish(self):
+        """Ends the compressed stream (trailer bytes) and records the stream's totals."""
+        started = time.perf_counter()
+        out = self._compressor.flush() if self.encoding == "gzip" else self._compressor.finish()
+        self.cpu_seconds += time.perf_counter() - started
+        self.bytes_out += len(out)
+        metrics.COMPRESSION_BYTES.labels(self.encoding, "in").inc(self.bytes_in)
+        metrics.COMPRESSION_BYTES.labels(self.encoding, "out").inc(self.bytes_out)
+        metrics.COMPRESSION_SECONDS.labels(self.encoding).inc(self.cpu_seconds)
+        return out
+
+
+def compress_body(data: bytes, encoding: str):
+    """Compresses a complete response body."""
+    compressor = StreamCompressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(frames, encoding: str):
+    """
+    Yields the compressed bytes of a synchronous SSE frame iterator, one flush per frame.
+
+    Closing this generator closes frames as well, so the stream's own cleanup still runs when
+    the client goes away.
+    """
+    compressor = StreamCompressor(encoding)
+    try:
+        for frame in frames:
+            yield compressor.compress(frame)
+        yield compressor.finish()
+    finally:
+        close = getattr(frames, "close", None)
+        if close is not None:
+            close()
+
+
+async def acompress_stream(frames, encoding: str):
+    """Async counterpart of compress_stream."""
+    compressor = StreamCompressor(encoding)
+    try:
+        async for frame in frames:
+            yield compressor.compress(frame)
+        yield compressor.finish()
+    finally:
+        aclose = getattr(frames, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,276 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from context_window import estimate_tokens, content_text
+
+# Vertex context caching for long system instructions and stable conversation prefixes.
+# The default persona is several kilobytes, users paste long custom instructions, and every turn
+# resent all of it plus the unchanged history for the model to process again. Once the system
+# instruction plus history reaches CONTEXT_CACHE_MIN_TOKENS, the registry stores it as cached
+# content in the background; later turns that start with the same prefix send only the turns
+# after it. Prefixes are identified by a hash chain over (model, system instruction, messages),
+# so the longest live cache is found with one dictionary lookup per message. A new, longer cache
+# is only created once the history has grown CONTEXT_CACHE_GROWTH_TOKENS past the one in use.
+# Once context_window trims a conversation, its kept history starts one turn later every turn,
+# so no prefix past the system instruction (and the summary pair, when summaries are on) is ever
+# sent twice. Such turns only look up and create caches for that stable head.
+#
+# Entries expire with their TTL and are refreshed in the background while in use. Creation
+# failures back off per prefix, a cache the backend no longer knows is dropped and the turn is
+# retried without it, and backends without caching (the endpoint pool) are simply bypassed.
+# Input tokens served from cache and time-to-first-token with and without a cache are reported
+# in /healthz and /metrics. CHAT_BACKEND=stub keeps caches in memory and, with
+# STUB_PREFILL_MS_PER_1K_TOKENS, charges TTFT for uncached input, so all of this runs offline.
+
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "1") != "0"
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096"))
+CONTEXT_CACHE_GROWTH_TOKENS = int(os.getenv("CONTEXT_CACHE_GROWTH_TOKENS", "4096"))
+CONTEXT_CACHE_TTL_SECONDS = float(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Entries in use are refreshed once less than this remains of their TTL.
+CONTEXT_CACHE_REFRESH_SECONDS = float(os.getenv("CONTEXT_CACHE_REFRESH_SECONDS", "600"))
+# Entries this close to expiry are no longer used, so a cache cannot expire mid-request.
+CONTEXT_CACHE_MIN_REMAINING_SECONDS = float(os.getenv("CONTEXT_CACHE_MIN_REMAINING_SECONDS", "30"))
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "256"))
+CONTEXT_CACHE_FAILURE_BACKOFF_SECONDS = float(os.getenv("CONTEXT_CACHE_FAILURE_BACKOFF_SECONDS", "300"))
+CONTEXT_CACHE_WORKERS = int(os.getenv("CONTEXT_CACHE_WORKERS", "2"))
+TTFT_EWMA_ALPHA = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+def prefix_keys(model_name: str, system_instruction: str, contents: list):
+    """
+    Hashes every prefix of a conversation.
+
+    Returns:
+        list: (message count, key, estimated tokens) for each prefix, shortest (the system
+            instruction alone) first.
+    """
+    digest = hashlib.sha256(f"{model_name}\x00{system_instruction or ''}".encode("utf-8"))
+    tokens = estimate_tokens(system_instruction or "")
+    keys = [(0, digest.hexdigest(), tokens)]
+    for count, content in enumerate(contents, 1):
+        text = content_text(content)
+        digest.update(f"\x1e{content.role}\x1f{text}".encode("utf-8"))
+        tokens += estimate_tokens(text)
+        keys.append((count, digest.hexdigest(), tokens))
+    return keys
+
+
+class CacheEntry:
+    """One live context cache: the backend's handle plus what it covers."""
+
+    __slots__ = ("key", "model_name", "handle", "contents_count", "tokens", "expires_at", "hits", "refreshing")
+
+    def __init__(self, key, model_name, handle, contents_count, tokens, expires_at):
+        self.key = key
+        self.model_name = model_name
+        self.handle = handle
+        self.contents_count = contents_count
+        self.tokens = tokens
+        self.expires_at = expires_at
+        self.hits = 0
+        self.refreshing = False
+
+
+class CachePlan:
+    """How to send one turn with a cache: the handle, and the contents after the cached prefix."""
+
+    __slots__ = ("entry", "contents")
+
+    def __init__(self, entry: CacheEntry, contents: list):
+        self.entry = entry
+        self.contents = contents
+
+    @property
+    def handle(self):
+        return self.entry.handle
+
+
+class ContextCacheRegistry:
+    """Thread-safe registry of context caches with TTL expiry, background refresh and fallback."""
+
+    def __init__(self, enabled: bool = CONTEXT_CACHE, min_tokens: int = CONTEXT_CACHE_MIN_TOKENS,
+                 growth_tokens: int = CONTEXT_CACHE_GROWTH_TOKENS, ttl_seconds: float = CONTEXT_CACHE_TTL_SECONDS,
+                 refresh_seconds: float = CONTEXT_CACHE_REFRESH_SECONDS, max_entries: int = CONTEXT_CACHE_MAX_ENTRIES):
+        self.enabled = enabled
+        self.min_tokens = max(1, min_tokens)
+        self.growth_tokens = max(1, growth_tokens)
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = min(refresh_seconds, ttl_seconds / 2)
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()  # key -> CacheEntry, least recently used first
+        self._pending = set()
+        self._retry_at = {}  # key -> time before which creation is not retried
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, CONTEXT_CACHE_WORKERS), thread_name_prefix="context-cache")
+        self.counts = {"hits": 0, "misses": 0, "created": 0, "create_failures": 0, "refreshed": 0,
+                       "expired": 0, "evicted": 0, "fallbacks": 0}
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self._ttft = {}  # "hit" / "miss" -> EWMA seconds
+
+    def plan(self, backend, model_name: str, system_instruction: str, conversation: list, stable_prefix: int = None):
+        """
+        Picks the longest live cache for a turn and schedules a longer one when worthwhile.
+
+        Args:
+            backend: The ChatBackend that will serve the turn.
+            conversation (list): Content objects to send, ending with the new user prompt.
+            stable_prefix (int, optional): Leading messages that stay the same across turns when
+                the history was trimmed (ContextReport.stable_prefix); caches cover at most these.
+
+        Returns:
+            CachePlan: The cache to use, or None to send the full conversation.
+        """
+        if not self.enabled or not getattr(backend, "supports_context_cache", False):
+            return None
+        history = conversation[:-1] if stable_prefix is None else conversation[:min(stable_prefix, len(conversation) - 1)]
+        prefixes = prefix_keys(model_name, system_instruction, history)
+        now = time.time()
+        with self._lock:
+            best = None
+            for count, key, tokens in reversed(prefixes):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry.expires_at - now < CONTEXT_CACHE_MIN_REMAINING_SECONDS:
+                    del self._entries[key]
+                    self.counts["expired"] += 1
+                    continue
+                self._entries.move_to_end(key)
+                best = entry
+                break
+            count, key, tokens = prefixes[-1]
+            grown = tokens - best.tokens >= self.growth_tokens if best else True
+            if (tokens >= self.min_tokens and grown and key not in self._entries and key not in self._pending
+                    and self._retry_at.get(key, 0) <= now):
+                self._pending.add(key)
+                self._executor.submit(self._create, backend, key, model_name, system_instruction, conversation[:count], tokens)
+            if best is None:
+                return None
+            best.hits += 1
+            if best.expires_at - now < self.refresh_seconds and not best.refreshing:
+                best.refreshing = True
+                self._executor.submit(self._refresh, backend, best)
+        return CachePlan(best, conversation[best.contents_count:])
+
+    def _create(self, backend, key, model_name, system_instruction, contents, tokens):
+        started = time.perf_counter()
+        try:
+            handle = backend.create_cache(model_name, system_instruction, contents, self.ttl_seconds)
+        except Exception as e:
+            logger.warning("Context cache creation failed for %s: %s", model_name, e, extra={"tokens": tokens})
+            with self._lock:
+                self._pending.discard(key)
+                self._back_off_locked(key)
+                self.counts["create_failures"] += 1
+            return
+        entry = CacheEntry(key, model_name, handle, len(contents), tokens, time.time() + self.ttl_seconds)
+        evicted = []
+        with self._lock:
+            self._pending.discard(key)
+            self._retry_at.pop(key, None)
+            self._entries[key] = entry
+            self.counts["created"] += 1
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+                self.counts["evicted"] += 1
+        logger.info("Context cache created for %s", model_name,
+                    extra={"tokens": tokens, "messages": len(contents), "seconds": round(time.perf_counter() - started, 3)})
+        for old in evicted:
+            self._delete(backend, old)
+
+    def _refresh(self, backend, entry: CacheEntry):
+        try:
+            backend.refresh_cache(entry.handle, self.ttl_seconds)
+        except Exception as e:
+            logger.warning("Context cache refresh failed, dropping it: %s", e)
+            self._drop(entry)
+            return
+        with self._lock:
+            entry.expires_at = time.time() + self.ttl_seconds
+            entry.refreshing = False
+            self.counts["refreshed"] += 1
+
+    def _delete(self, backend, entry: CacheEntry):
+        try:
+            backend.delete_cache(entry.handle)
+        except Exception as e:
+            # It expires on its own at the end of its TTL.
+            logger.debug("Context cache delete failed: %s", e)
+
+    def _drop(self, entry: CacheEntry):
+        with self._lock:
+            if self._entries.get(entry.key) is entry:
+                del self._entries[entry.key]
+            self._back_off_locked(entry.key)
+
+    def _back_off_locked(self, key: str):
+        now = time.time()
+        if len(self._retry_at) >= self.max_entries:
+            self._retry_at = {k: retry_at for k, retry_at in self._retry_at.items() if retry_at > now}
+        self._retry_at[key] = now + CONTEXT_CACHE_FAILURE_BACKOFF_SECONDS
+
+    def fallback(self, plan: CachePlan, error: Exception):
+        """Drops a cache the backend rejected; the caller resends the turn without it."""
+        logger.warning("Context cache rejected, sending the full conversation: %s", error,
+                       extra={"model": plan.entry.model_name, "cached_tokens": plan.entry.tokens})
+        self._drop(plan.entry)
+        with self._lock:
+            self.counts["fallbacks"] += 1
+
+    def record(self, plan: CachePlan, ttft: float, usage, system_instruction: str, conversation: list):
+        """
+        Accounts for one finished call: cache outcome, input tokens served from cache, and TTFT.
+
+        Args:
+            plan (CachePlan): The plan the call used, or None.
+            ttft (float): Seconds to the first chunk, or None if nothing arrived.
+            usage: The response's usage metadata; without it tokens are estimated locally.
+            conversation (list): The full conversation of the call.
+        """
+        if not self.enabled:
+            return
+        outcome = "hit" if plan is not None else "miss"
+        if getattr(usage, "prompt_token_count", 0):
+            input_tokens = usage.prompt_token_count
+            cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+        else:
+            input_tokens = estimate_tokens(system_instruction or "") + sum(estimate_tokens(content_text(c)) for c in conversation)
+            cached_tokens = plan.entry.tokens if plan is not None else 0
+        metrics.CONTEXT_CACHE_REQUESTS.labels(outcome).inc()
+        metrics.CONTEXT_CACHE_INPUT_TOKENS.labels("cached").inc(cached_tokens)
+        metrics.CONTEXT_CACHE_INPUT_TOKENS.labels("uncached").inc(max(0, input_tokens - cached_tokens))
+        if ttft is not None:
+            metrics.CONTEXT_CACHE_TTFT.labels(outcome).observe(ttft)
+        with self._lock:
+            self.counts["hits" if plan is not None else "misses"] += 1
+            self.input_tokens += input_tokens
+            self.cached_input_tokens += cached_tokens
+            if ttft is not None:
+                previous = self._ttft.get(outcome)
+                self._ttft[outcome] = ttft if previous is None else previous + TTFT_EWMA_ALPHA * (ttft - previous)
+
+    def stats(self):
+        with self._lock:
+            ttft = {outcome: round(value, 4) for outcome, value in self._ttft.items()}
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "pending": len(self._pending),
+                **self.counts,
+                "input_tokens": self.input_tokens,
+                "cached_input_tokens": self.cached_input_tokens,
+                "cached_input_ratio": round(self.cached_input_tokens / self.input_tokens, 4) if self.input_tokens else 0.0,
+                "ttft_seconds": ttft,
+                "ttft_saved_seconds": round(ttft["miss"] - ttft["hit"], 4) if "hit" in ttft and "miss" in ttft else None,
+            }
+
+
+context_cache = ContextCacheRegistry()
@@ -0,0 +1,230 @@
+import os
+import hashlib
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from model_pool import model_pool
+from backends import get_backend
+from vertex_runtime import make_content
+
+# Token-budgeted context window.
+# Sits between app.chat and the model call: trims the oldest turns so system instruction,
+# history and prompt fit a per-model token budget, and optionally replaces the evicted turns
+# with a rolling summary that is refreshed in the background.
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "32000"))
+# Per-model overrides, e.g. "gemini-2.0-flash-001=100000,gemini-2.0-flash-lite-001=50000"
+CONTEXT_TOKEN_BUDGETS = os.getenv("CONTEXT_TOKEN_BUDGETS", "")
+# "estimate" (about 4 characters per token, no network) or "vertex" (count_tokens, cached per message)
+CONTEXT_TOKEN_COUNTER = os.getenv("CONTEXT_TOKEN_COUNTER", "estimate")
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY", "0") == "1"
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", os.getenv("DEFAULT_CHAT_NAME_MODEL", "gemini-2.0-flash-lite-001"))
+CONTEXT_SUMMARY_MAX_CONVERSATIONS = int(os.getenv("CONTEXT_SUMMARY_MAX_CONVERSATIONS", "1000"))
+
+SUMMARY_SYSTEM_INSTRUCTION = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the previous summary with the new messages into one concise summary that keeps names, "
+    "facts, decisions, code identifiers and open questions. Output only the summary."
+)
+SUMMARY_GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "max_output_tokens": 512,
+}
+SUMMARY_SAFETY_SETTINGS = []
+# Rough per-message overhead for role and framing tokens.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_budgets(spec: str):
+    budgets = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip().isdigit():
+            budgets[name.strip()] = int(value)
+    return budgets
+
+
+def estimate_tokens(text: str):
+    """Cheap local token estimate (about 4 characters per token)."""
+    return len(text) // 4 + 1 if text else 0
+
+
+def content_text(content):
+    return "".join(part.text for part in content.parts if getattr(part, 'text', None))
+
+
+class ContextReport:
+    """Per-request accounting of what the context manager sent and dropped."""
+
+    def __init__(self, budget: int, tokens_sent: int, tokens_saved: int, messages_dropped: int, summarized: bool):
+        self.budget = budget
+        self.tokens_sent = tokens_sent
+        self.tokens_saved = tokens_saved
+        self.messages_dropped = messages_dropped
+        self.summarized = summarized
+
+    def stable_prefix(self):
+        """
+        Number of leading history messages that stay the same from one turn to the next.
+
+        Returns:
+            int: 0 (only the system instruction) or 2 (the summary pair) when turns were dropped,
+                since the start of the kept history then moves every turn; None when nothing was
+                dropped and the whole history is a stable prefix.
+        """
+        if not self.messages_dropped:
+            return None
+        return 2 if self.summarized else 0
+
+    def headers(self):
+        return {
+            "X-Context-Tokens-Sent": str(self.tokens_sent),
+            "X-Context-Tokens-Saved": str(self.tokens_saved),
+        }
+
+    def __str__(self):
+        return (f"budget={self.budget} sent={self.tokens_sent} saved={self.tokens_saved} "
+                f"dropped={self.messages_dropped} summarized={self.summarized}")
+
+
+class ContextWindowManager:
+    """Fits conversations into a per-model token budget, caching token counts per message."""
+
+    def __init__(self, default_budget: int = CONTEXT_TOKEN_BUDGET, budgets: dict = None,
+                 counter: str = CONTEXT_TOKEN_COUNTER, summarize: bool = CONTEXT_SUMMARY_ENABLED):
+        self.default_budget = default_budget
+        self.budgets = budgets if budgets is not None else _parse_budgets(CONTEXT_TOKEN_BUDGETS)
+        self.counter = counter
+        self.summarize = summarize
+        # Content objects live as long as their session, so counts are cached on the object itself.
+        self._counts = weakref.WeakKeyDictionary()
+        self._text_counts = {}
+        self._summaries = {}  # conversation key -> (messages summarized, summary text)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-summary") if summarize else None
+
+    def budget_for(self, model_name: str):
+        return self.budgets.get(model_name, self.default_budget)
+
+    def count_text(self, model_name: str, text: str):
+        if self.counter != "vertex":
+            return estimate_tokens(text)
+        key = (model_name, hashlib.sha1(text.encode("utf-8")).hexdigest())
+        count = self._text_counts.get(key)
+        if count is None:
+            try:
+                count = model_pool.get_model(model_name).count_tokens(text).total_tokens
+            except Exception as e:
+                logger.warning("count_tokens failed, falling back to estimate: %s", e)
+                return estimate_tokens(text)
+            if len(self._text_counts) > 10000:
+                self._text_counts.clear()
+            self._text_counts[key] = count
+        return count
+
+    def count_content(self, model_name: str, content):
+        try:
+            count = self._counts.get(content)
+        except TypeError:
+            count = None
+        if count is None:
+            count = self.count_text(model_name, content_text(content)) + MESSAGE_OVERHEAD_TOKENS
+            try:
+                self._counts[content] = count
+            except TypeError:
+                pass
+        return count
+
+    def fit(self, model_name: str, system_instruction: str, chat_history: list, user_prompt: str, conversation_key: str = None):
+        """
+        Trims chat_history so the whole request fits the model's token budget.
+
+        Oldest turns are dropped first, in whole user/model pairs so the kept history still starts
+        with a user turn. With summaries enabled, the dropped prefix is represented by a rolling
+        summary that a background worker keeps up to date.
+
+        Args:
+            model_name (str): Model the request is sent to.
+            system_instruction (str): System instruction text.
+            chat_history (list): Content objects, oldest first.
+            user_prompt (str): The new prompt.
+            conversation_key (str, optional): Stable id used to cache the rolling summary.
+
+        Returns:
+            tuple: (history to send, ContextReport)
+        """
+        budget = self.budget_for(model_name)
+        fixed = self.count_text(model_name, system_instruction or "") + self.count_text(model_name, user_prompt) + MESSAGE_OVERHEAD_TOKENS
+        counts = [self.count_content(model_name, content) for content in chat_history]
+        total = fixed + sum(counts)
+        if total <= budget or not chat_history:
+            return chat_history, ContextReport(budget, total, 0, 0, False)
+
+        summary_text = None
+        summary_tokens = 0
+        if self.summarize and conversation_key:
+            summary_text = self._cached_summary(conversation_key)
+            summary_tokens = self.count_text(model_name, summary_text) + 2 * MESSAGE_OVERHEAD_TOKENS if summary_text else 0
+
+        start = 0
+        kept = total + summary_tokens
+        while start < len(chat_history) and kept > budget:
+            kept -= counts[start]
+            start += 1
+            # Drop the paired reply too so the kept history starts with a user turn.
+            while start < len(chat_history) and chat_history[start].role != "user":
+                kept -= counts[start]
+                start += 1
+
+        trimmed = chat_history[start:]
+        if self.summarize and conversation_key and start:
+            self._schedule_summary(conversation_key, chat_history[:start])
+        if summary_text and start:
+            trimmed = [
+                make_content("user", f"Summary of our earlier conversation:\n{summary_text}"),
+                make_content("model", "Understood, I'll keep that context in mind."),
+            ] + trimmed
+        else:
+            kept -= summary_tokens
+        report = ContextReport(budget, kept, total - kept if kept < total else 0, start, bool(summary_text and start))
+        logger.info("Context window trimmed for %s: %s", model_name, report)
+        return trimmed, report
+
+    def _cached_summary(self, conversation_key: str):
+        entry = self._summaries.get(conversation_key)
+        return entry[1] if entry else None
+
+    def _schedule_summary(self, conversation_key: str, evicted: list):
+        """Queues a background refresh when more turns were evicted than the summary covers."""
+        with self._lock:
+            covered = self._summaries.get(conversation_key, (0, None))[0]
+            if len(evicted) <= covered or conversation_key in self._pending:
+                return
+            self._pending.add(conversation_key)
+        self._executor.submit(self._refresh_summary, conversation_key, evicted)
+
+    def _refresh_summary(self, conversation_key: str, evicted: list):
+        try:
+            covered, previous = self._summaries.get(conversation_key, (0, None))
+            new_lines = "\n".join(f"{content.role.capitalize()}: {content_text(content)}" for content in evicted[covered:])
+            prompt = f"Previous summary:\n{previous or '(none)'}\n\nNew messages:\n{new_lines}\n\nUpdated summary:"
+            result = get_backend().generate(CONTEXT_SUMMARY_MODEL, SUMMARY_SYSTEM_INSTRUCTION, [make_content("user", prompt)],
+                                            SUMMARY_GENERATION_CONFIG, SUMMARY_SAFETY_SETTINGS)
+            summary = result.candidates[0].content.parts[0].text.strip() if result and result.candidates else None
+            if summary:
+                with self._lock:
+                    self._summaries[conversation_key] = (len(evicted), summary)
+                    while len(self._summaries) > CONTEXT_SUMMARY_MAX_CONVERSATIONS:
+                        self._summaries.pop(next(iter(self._summaries)))
+        except Exception as e:
+            logger.exception("Error generating context summary: %s", e)
+        finally:
+            with self._lock:
+                self._pending.discard(conversation_key)
+
+
+context_manager = ContextWindowManager()
@@ -0,0 +1,177 @@
+import os
+import time
+import select
+import socket
+import asyncio
+import threading
+import metrics
+
+# Client-disconnect detection for /chat streams.
+# When the browser aborts a fetch, the server used to keep pulling the Vertex stream until the
+# answer was complete, spending output tokens, a worker and quota on text nobody reads. Streams
+# now notice a closed connection between chunks and close the generator chain, which drops
+# (and so cancels) the upstream call. Cancelled streams and an estimate of the output tokens
+# they saved are counted.
+
+DISCONNECT_CHECK_INTERVAL_MS = float(os.getenv("DISCONNECT_CHECK_INTERVAL_MS", "100"))
+# Weight of the newest completed answer in the per-model average answer length.
+TOKENS_EWMA_ALPHA = 0.1
+
+
+class ClientDisconnectProbe:
+    """
+    Detects a closed client connection by peeking at the request socket.
+
+    A peer that has closed its end makes the socket readable with nothing to read. Checks are
+    throttled to one non-blocking select() every DISCONNECT_CHECK_INTERVAL_MS.
+    """
+
+    def __init__(self, sock, interval_ms: float = DISCONNECT_CHECK_INTERVAL_MS):
+        self.sock = sock
+        self.interval = interval_ms / 1000.0
+        self._next_check = 0.0
+        self._gone = False
+
+    @classmethod
+    def from_environ(cls, environ):
+        """Returns a probe for the WSGI request's socket, or None if the server does not expose it."""
+        sock = environ.get("werkzeug.socket") or environ.get("gunicorn.socket")
+        return cls(sock) if isinstance(sock, socket.socket) else None
+
+    def disconnected(self):
+        if self._gone:
+            return True
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.interval
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable and self.sock.recv(1, socket.MSG_PEEK) == b"":
+                self._gone = True
+        except (OSError, ValueError):
+            # ValueError: TLS sockets do not support MSG_PEEK; rely on write errors there.
+            pass
+        return self._gone
+
+
+class StreamCancellation:
+    """Cancellation flag shared by a stream's producer and whoever watches the client."""
+
+    def __init__(self):
+        self.reason = None
+        self._event = None  # asyncio.Event, created on first wait() inside the event loop
+        self._loop = None
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason: str = "client_disconnected"):
+        if self.reason is None:
+            self.reason = reason
+            if self._event is not None:
+                self._set_event()
+
+    def _set_event(self):
+        # cancel() may come from another thread (a resume grace timer, a request thread).
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._event.set()
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self):
+        if self._event is None:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            if self.cancelled:
+                self._event.set()
+        await self._event.wait()
+
+
+async def watch_disconnect(receive, cancellation: StreamCancellation):
+    """Cancels the stream when the ASGI server reports http.disconnect."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            cancellation.cancel("client_disconnected")
+            return
+
+
+async def cancellable(stream, cancellation: StreamCancellation):
+    """
+    Iterates an async stream until it ends or the cancellation fires.
+
+    On cancellation the in-flight read is cancelled, which cancels the upstream call even while
+    it is still waiting for its next chunk.
+    """
+    iterator = stream.__aiter__()
+    cancelled = asyncio.ensure_future(cancellation.wait())
+    pending = None
+    try:
+        while not cancellation.cancelled:
+            pending = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait({pending, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                break
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            yield chunk
+    finally:
+        cancelled.cancel()
+        if pending is not None and not pending.done():
+            pending.cancel()
+            await asyncio.wait({pending})
+
+
+class CancellationStats:
+    """Counts cancelled streams and estimates the output tokens each one saved."""
+
+    def __init__(self, alpha: float = TOKENS_EWMA_ALPHA):
+        self.alpha = alpha
+        self._average_tokens = {}  # model -> EWMA of completed answer length in tokens
+        self._lock = threading.Lock()
+        self.cancelled = 0
+        self.tokens_saved = 0
+
+    def record_completed(self, model_name: str, tokens: int):
+        with self._lock:
+            average = self._average_tokens.get(model_name)
+            self._average_tokens[model_name] = tokens if average is None else average + self.alpha * (tokens - average)
+
+    def record_cancelled(self, model_name: str, tokens_generated: int, upstream: bool = True):
+        """
+        Records one cancelled stream.
+
+        Args:
+            model_name (str): Model the stream was generated with.
+            tokens_generated (int): Output tokens produced before the cancel.
+            upstream (bool): False for cache replays, which cost no model tokens.
+
+        Returns:
+            int: Estimated output tokens saved (the typical answer length minus what was generated).
+        """
+        with self._lock:
+            average = self._average_tokens.get(model_name, 0) if upstream else 0
+            saved = max(0, int(average - tokens_generated))
+            self.cancelled += 1
+            self.tokens_saved += saved
+        label = metrics.model_label(model_name)
+        metrics.CANCELLED_STREAMS.labels(label).inc()
+        metrics.CANCELLED_TOKENS_SAVED.labels(label).inc(saved)
+        return saved
+
+    def stats(self):
+        with self._lock:
+            return {"cancelled": self.cancelled, "tokens_saved": self.tokens_saved,
+                    "average_answer_tokens": {model: round(tokens) for model, tokens in self._average_tokens.items()}}
+
+
+cancellation_stats = CancellationStats()
@@ -0,0 +1,434 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+from backends import ChatBackend, StubBackend, VertexBackend
+
+# Multi-region / multi-project endpoint pool.
+# A single GOOGLE_PROJECT_ID/GOOGLE_LOCATION pair caps throughput at one region's latency and
+# quota. VERTEX_ENDPOINTS lists several project:location pairs; every call is routed to the
+# healthy endpoint with the best time-to-first-token, failed-over to another endpoint when it
+# errors before the first chunk, and (with ENDPOINT_HEDGING=1) hedged: if the first chunk has
+# not arrived by the pool's TTFT percentile, a second request goes to the next-best endpoint
+# and whichever answers first wins while the other is cancelled.
+#
+# Endpoints address models by full resource name
+# (projects/{project}/locations/{location}/publishers/google/models/{model}), which is how
+# the SDK picks the regional client. With CHAT_BACKEND=stub each endpoint gets its own
+# StubBackend, configured from query parameters on its entry, so pool behaviour can be
+# exercised offline, e.g.
+#   VERTEX_ENDPOINTS="p:us-central1,p:europe-west4?first_token_delay_ms=900&error_rate=0.2"
+
+VERTEX_ENDPOINTS = os.getenv("VERTEX_ENDPOINTS", "")
+ENDPOINT_HEDGING = os.getenv("ENDPOINT_HEDGING", "0") == "1"
+ENDPOINT_HEDGE_PERCENTILE = float(os.getenv("ENDPOINT_HEDGE_PERCENTILE", "90"))
+ENDPOINT_HEDGE_MIN_DELAY_MS = float(os.getenv("ENDPOINT_HEDGE_MIN_DELAY_MS", "250"))
+ENDPOINT_HEDGE_MIN_SAMPLES = int(os.getenv("ENDPOINT_HEDGE_MIN_SAMPLES", "20"))
+ENDPOINT_HEDGE_WORKERS = int(os.getenv("ENDPOINT_HEDGE_WORKERS", "32"))
+# Endpoints whose error-rate average exceeds this are benched for ENDPOINT_COOLDOWN_SECONDS.
+ENDPOINT_ERROR_THRESHOLD = float(os.getenv("ENDPOINT_ERROR_THRESHOLD", "0.5"))
+ENDPOINT_COOLDOWN_SECONDS = float(os.getenv("ENDPOINT_COOLDOWN_SECONDS", "30"))
+ENDPOINT_MAX_ATTEMPTS = int(os.getenv("ENDPOINT_MAX_ATTEMPTS", "2"))
+ENDPOINT_EWMA_ALPHA = 0.2
+# Samples kept per endpoint for the hedge-delay percentile.
+TTFT_WINDOW = 200
+
+_STUB_OPTION_TYPES = {
+    "tokens_per_second": float, "chunk_tokens": int, "first_token_delay_ms": float,
+    "first_token_jitter_ms": float, "response_tokens": int, "block_rate": float, "error_rate": float,
+}
+
+logger = logging.getLogger(__name__)
+_END = object()
+
+
+class Endpoint:
+    """One project/location pair plus its routing statistics."""
+
+    def __init__(self, project: str, location: str, options: dict = None):
+        self.project = project
+        self.location = location
+        self.options = options or {}
+        self.name = f"{project}/{location}"
+        self.ttft_ewma = None
+        self.error_rate = 0.0
+        self.samples = deque(maxlen=TTFT_WINDOW)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.hedges_won = 0
+        self.benched_until = 0.0
+
+    def resource_name(self, model_name: str):
+        if model_name.startswith("projects/"):
+            return model_name
+        return f"projects/{self.project}/locations/{self.location}/publishers/google/models/{model_name}"
+
+    def healthy(self, now: float):
+        return now >= self.benched_until
+
+    def score(self, unknown_ttft: float):
+        """Expected time to first token, inflated by recent errors and current load."""
+        ttft = self.ttft_ewma if self.ttft_ewma is not None else unknown_ttft
+        return ttft * (1.0 + 2.0 * self.error_rate) * (1.0 + 0.05 * self.in_flight)
+
+    def to_dict(self):
+        return {
+            "ttft_ms": round(self.ttft_ewma * 1000, 1) if self.ttft_ewma is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "hedges_won": self.hedges_won,
+            "benched": self.benched_until > time.monotonic(),
+        }
+
+
+def parse_endpoints(spec: str):
+    """Parses "project:location[?stub options],..." into Endpoint objects."""
+    endpoints = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        target, _, query = item.partition("?")
+        project, _, location = target.partition(":")
+        if not project or not location:
+            logger.warning("Ignoring malformed VERTEX_ENDPOINTS entry: %s", item)
+            continue
+        options = {}
+        for key, value in parse_qsl(query):
+            if key in _STUB_OPTION_TYPES:
+                options[key] = _STUB_OPTION_TYPES[key](value)
+        endpoints.append(Endpoint(project.strip(), location.strip(), options))
+    return endpoints
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct / 100.0 * len(values)))]
+
+
+class EndpointPool:
+    """Tracks per-endpoint TTFT and error rate and picks where the next call goes."""
+
+    def __init__(self, endpoints: list, hedging: bool = ENDPOINT_HEDGING,
+                 hedge_percentile: float = ENDPOINT_HEDGE_PERCENTILE, hedge_min_delay_ms: float = ENDPOINT_HEDGE_MIN_DELAY_MS,
+                 error_threshold: float = ENDPOINT_ERROR_THRESHOLD, cooldown_seconds: float = ENDPOINT_COOLDOWN_SECONDS):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.endpoints = list(endpoints)
+        self.hedging = hedging and len(self.endpoints) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay_ms / 1000.0
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown_seconds
+        self.hedged = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def choose(self, exclude=()):
+        """Returns the best endpoint not in exclude; benched endpoints are used only as a last resort."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep not in exclude] or list(self.endpoints)
+            healthy = [ep for ep in candidates if ep.healthy(now)] or candidates
+            # Endpoints without samples score zero, so each one is tried before it is judged.
+            return min(healthy, key=lambda ep: ep.score(0.0))
+
+    def begin(self, endpoint: Endpoint):
+        with self._lock:
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+
+    def first_chunk(self, endpoint: Endpoint, seconds: float):
+        with self._lock:
+            endpoint.samples.append(seconds)
+            endpoint.ttft_ewma = seconds if endpoint.ttft_ewma is None else \
+                endpoint.ttft_ewma + ENDPOINT_EWMA_ALPHA * (seconds - endpoint.ttft_ewma)
+        metrics.ENDPOINT_TTFT.labels(endpoint.name).observe(seconds)
+
+    def end(self, endpoint: Endpoint, ok: bool = None):
+        """Closes one call; ok=None means it was cancelled and says nothing about health."""
+        with self._lock:
+            endpoint.in_flight -= 1
+            if ok is None:
+                return
+            endpoint.error_rate += ENDPOINT_EWMA_ALPHA * ((0.0 if ok else 1.0) - endpoint.error_rate)
+            if not ok:
+                endpoint.errors += 1
+                if endpoint.error_rate > self.error_threshold:
+                    endpoint.benched_until = time.monotonic() + self.cooldown
+                    # Let it back in on probation rather than with its full error history.
+                    endpoint.error_rate = self.error_threshold / 2
+                    logger.warning("Endpoint %s benched for %ss after repeated errors", endpoint.name, self.cooldown)
+        if not ok:
+            metrics.ENDPOINT_ERRORS.labels(endpoint.name).inc()
+
+    def hedge_delay(self):
+        """Seconds to wait for a first chunk before hedging, or None when hedging is off or unproven."""
+        if not self.hedging:
+            return None
+        with self._lock:
+            samples = [s for ep in self.endpoints for s in ep.samples]
+        if len(samples) < ENDPOINT_HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.hedge_min_delay, _percentile(samples, self.hedge_percentile))
+
+    def record_hedge(self, winner: Endpoint, hedge_won: bool):
+        with self._lock:
+            self.hedged += 1
+            if hedge_won:
+                winner.hedges_won += 1
+        metrics.HEDGED_REQUESTS.labels("hedge_won" if hedge_won else "primary_won").inc()
+
+    def stats(self):
+        with self._lock:
+            return {"hedging": self.hedging, "hedged": self.hedged,
+                    "endpoints": {ep.name: ep.to_dict() for ep in self.endpoints}}
+
+
+class _Opened:
+    """A stream whose first chunk has arrived (or that ended without one)."""
+
+    def __init__(self, endpoint, first, iterator):
+        self.endpoint = endpoint
+        self.first = first
+        self.iterator = iterator
+
+
+class EndpointPoolBackend(ChatBackend):
+    """
+    Routes every call of an underlying backend across an EndpointPool.
+
+    Failures before the first chunk are retried on the next-best endpoint (up to
+    ENDPOINT_MAX_ATTEMPTS); failures after it are surfaced as usual, since part of the
+    answer has already been streamed.
+    """
+
+    name = "endpoint-pool"
+
+    def __init__(self, pool: EndpointPool, backend_for):
+        self.pool = pool
+        self._backends = {ep.name: backend_for(ep) for ep in pool.endpoints}
+        self._executor = ThreadPoolExecutor(max_workers=ENDPOINT_HEDGE_WORKERS, thread_name_prefix="endpoint-hedge") \
+            if pool.hedging else None
+
+    # --- Sync -----------------------------------------------------------------------------
+
+    def _open(self, endpoint, model_name, system_instruction, contents, generation_config, safety_settings):
+        """Starts a stream on one endpoint and blocks until its first chunk."""
+        started = time.perf_counter()
+        self.pool.begin(endpoint)
+        iterator = None
+        try:
+            stream = self._backends[endpoint.name].stream(endpoint.resource_name(model_name), system_instruction,
+                                                          contents, generation_config, safety_settings)
+            iterator = iter(stream)
+            first = next(iterator, _END)
+        except Exception:
+            self.pool.end(endpoint, ok=False)
+            raise
+        self.pool.first_chunk(endpoint, time.perf_counter() - started)
+        return _Opened(endpoint, first, iterator)
+
+    def _submit(self, *args):
+        return self._executor.submit(contextvars.copy_context().run, self._open, *args)
+
+    def _abandon(self, future):
+        """Cancels the losing hedge once its blocking first read returns."""
+        def close(f):
+            if f.exception() is not None:
+                return  # _open already recorded the failure.
+            opened = f.result()
+            if hasattr(opened.iterator, 'close'):
+                opened.iterator.close()
+            self.pool.end(opened.endpoint, ok=None)
+        future.add_done_callback(close)
+
+    def _open_hedged(self, primary, args):
+        delay = self.pool.hedge_delay()
+        if delay is None:
+            return self._open(primary, *args)
+        first = self._submit(primary, *args)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        secondary = self.pool.choose(exclude=[primary])
+        second = self._submit(secondary, *args)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for loser in pending:
+                    self._abandon(loser)
+                for loser in done - {future}:
+                    self._abandon(loser)
+                self.pool.record_hedge(future.result().endpoint, hedge_won=future is second)
+                return future.result()
+        raise error
+
+    def stream(self, model_name, system_instruction, contents, generation_config, safety_settings=None):
+        args = (model_name, system_instruction, contents, generation_config, safety_settings)
+        tried = []
+        for attempt in range(max(1, ENDPOINT_MAX_ATTEMPTS)):
+            endpoint = self.pool.choose(exclude=tried)
+            try:
+                opened = self._open_hedged(endpoint, args) if self._executor else self._open(endpoint, *args)
+                break
+            except Exception as e:
+                tried.append(endpoint)
+                if attempt + 1 >= ENDPOINT_MAX_ATTEMPTS or len(tried) >= len(self.pool):
+                    raise
+                logger.warning("Endpoint %s failed before the first chunk, retrying elsewhere: %s", endpoint.name, e)
+        return self._drain(opened)
+
+    def _drain(self, opened):
+        ok = None
+        try:
+            if opened.first is not _END:
+                yield opened.first
+                for chunk in opened.iterator:
+                    yield chunk
+            ok = True
+        except Exception:
+            ok = False
+            raise
+        finally:
+            if hasattr(opened.iterator, 'close'):
+                opened.iterator.close()
+            self.pool.end(opened.endpoint, ok)
+
+    # --- Async ----------------------------------------------------------------------------
+
+    async def _aopen(self, endpoint, model_name, system_instruction, contents, generation_config, safety_settings):
+        started = time.perf_counter()
+        self.pool.begin(endpoint)
+        try:
+            stream = await self._backends[endpoint.name].stream_async(endpoint.resource_name(model_name), system_instruction,
+                                                                      contents, generation_config, safety_settings)
+            iterator = stream.__aiter__()
+            try:
+                first = await iterator.__anext__()
+            except StopAsyncIteration:
+                first = _END
+        except asyncio.CancelledError:
+            # Lost a hedge: cancelling the await cancels the upstream call.
+            self.pool.end(endpoint, ok=None)
+            raise
+        except Exception:
+            self.pool.end(endpoint, ok=False)
+            raise
+        self.pool.first_chunk(endpoint, time.perf_counter() - started)
+        return _Opened(endpoint, first, iterator)
+
+    async def _aopen_hedged(self, primary, args):
+        delay = self.pool.hedge_delay()
+        if delay is None:
+            return await self._aopen(primary, *args)
+        first = asyncio.ensure_future(self._aopen(primary, *args))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        second = asyncio.ensure_future(self._aopen(self.pool.choose(exclude=[primary]), *args))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    for loser in done - {task}:
+                        if loser.exception() is None:
+                            await self._aclose(loser.result(), ok=None)
+                    self.pool.record_hedge(task.result().endpoint, hedge_won=task is second)
+                    return task.result()
+            raise error
+        finally:
+            for loser in pending:
+                loser.cancel()
+
+    async def _aclose(self, opened, ok):
+        if hasattr(opened.iterator, 'aclose'):
+            await opened.iterator.aclose()
+        self.pool.end(opened.endpoint, ok)
+
+    async def _astream(self, args):
+        tried = []
+        for attempt in range(max(1, ENDPOINT_MAX_ATTEMPTS)):
+            endpoint = self.pool.choose(exclude=tried)
+            try:
+                opened = await (self._aopen_hedged(endpoint, args) if self.pool.hedging else self._aopen(endpoint, *args))
+                break
+            except Exception as e:
+                tried.append(endpoint)
+                if attempt + 1 >= ENDPOINT_MAX_ATTEMPTS or len(tried) >= len(self.pool):
+                    raise
+                logger.warning("Endpoint %s failed before the first chunk, retrying elsewhere: %s", endpoint.name, e)
+        ok = None
+        try:
+            if opened.first is not _END:
+                yield opened.first
+                async for chunk in opened.iterator:
+                    yield chunk
+            ok = True
+        except Exception:
+            ok = False
+            raise
+        finally:
+            await self._aclose(opened, ok)
+
+    async def stream_async(self, model_name, system_instruction, contents, generation_config, safety_settings=None):
+        return self._astream((model_name, system_instruction, contents, generation_config, safety_settings))
+
+    # --- Unary ----------------------------------------------------------------------------
+
+    def generate(self, model_name, system_instruction, contents, generation_config, safety_settings=None):
+        tried = []
+        for attempt in range(max(1, ENDPOINT_MAX_ATTEMPTS)):
+            endpoint = self.pool.choose(exclude=tried)
+            self.pool.begin(endpoint)
+            try:
+                result = self._backends[endpoint.name].generate(endpoint.resource_name(model_name), system_instruction,
+                                                                contents, generation_config, safety_settings)
+            except Exception as e:
+                self.pool.end(endpoint, ok=False)
+                tried.append(endpoint)
+                if attempt + 1 >= ENDPOINT_MAX_ATTEMPTS or len(tried) >= len(self.pool):
+                    raise
+                logger.warning("Endpoint %s failed, retrying elsewhere: %s", endpoint.name, e)
+                continue
+            self.pool.end(endpoint, ok=True)
+            return result
+
+    def warmup(self, model_name, system_instruction, generation_config, safety_settings=None):
+        results = [self._backends[ep.name].warmup(ep.resource_name(model_name), system_instruction,
+                                                  generation_config, safety_settings)
+                   for ep in self.pool.endpoints]
+        return any(results)
+
+
+def build_pool_backend(backend_name: str, spec: str = VERTEX_ENDPOINTS):
+    """Returns an EndpointPoolBackend for VERTEX_ENDPOINTS, or None if fewer than two endpoints are configured."""
+    endpoints = parse_endpoints(spec)
+    if len(endpoints) < 2:
+        return None
+    pool = EndpointPool(endpoints)
+    if backend_name == "stub":
+        return EndpointPoolBackend(pool, lambda ep: StubBackend(**ep.options))
+    vertex = VertexBackend()
+    return EndpointPoolBackend(pool, lambda ep: vertex)
@@ -0,0 +1,109 @@
+import os
+import glob
+import resource
+import logging
+import tempfile
+import multiprocessing
+from dotenv import load_dotenv
+
+# Production launch: N pre-forked worker processes.
+# `python app.py` runs Flask's single-process development server, where the GIL serializes SSE
+# framing and JSON work across every stream. Run instead:
+#
+#     gunicorn -c gunicorn.conf.py app:app                                          # threaded WSGI workers
+#     WEB_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py asgi:app
+#
+# Nothing in the parent touches the Vertex SDK: app.py skips its import-time warmup when
+# WEB_PREFORK is set, and each worker initializes the SDK and warms its model connections after
+# the fork. Caches, sessions and rate-limit buckets are shared between workers through
+# shared_state, which turns itself on when WEB_WORKERS > 1. WEB_WORKERS defaults to one per CPU
+# (at most 8). Resumable streams, single-flight joins and batch jobs stay in the worker that
+# started them, and the workers share one listening socket, so nothing in front of them can pin a
+# reconnect to the right one: with several workers SSE_RESUME therefore defaults to off, and each
+# stream is tied to its request as without resume. Setting SSE_RESUME=1 explicitly keeps it on;
+# a DELETE still reaches a stream's worker through shared_state, but a resume that lands on
+# another worker gets a 409 and the client retries it, possibly on the right one. For reliable
+# resume, run single-worker instances (WEB_WORKERS=1) behind a load balancer with sticky sessions.
+# Prometheus metrics are aggregated across workers through PROMETHEUS_MULTIPROC_DIR (a fresh
+# temporary directory unless set). Workers are recycled gracefully after WEB_MAX_REQUESTS
+# requests (jittered so they do not all restart at once) or once their resident memory passes
+# WEB_MAX_RSS_MB; in-flight streams get WEB_GRACEFUL_TIMEOUT_SECONDS to finish.
+
+load_dotenv()
+
+bind = os.getenv("WEB_BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers = int(os.getenv("WEB_WORKERS", str(min(multiprocessing.cpu_count(), 8))))
+worker_class = os.getenv("WEB_WORKER_CLASS", "gthread")
+# Each open SSE stream holds a thread in a gthread worker.
+threads = int(os.getenv("WEB_THREADS", "32"))
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", "5000"))
+max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT_SECONDS", "120"))
+# Heartbeat timeout; the worker's main loop keeps beating while its threads stream.
+timeout = int(os.getenv("WEB_TIMEOUT_SECONDS", "60"))
+keepalive = int(os.getenv("WEB_KEEPALIVE_SECONDS", "5"))
+# Import the app once in the parent so workers share its pages copy-on-write and start fast.
+preload_app = os.getenv("WEB_PRELOAD", "1") != "0"
+WEB_MAX_RSS_MB = int(os.getenv("WEB_MAX_RSS_MB", "0"))  # 0: recycle on request count only
+
+# Read by the app modules at import, which happens after this file is loaded.
+os.environ["WEB_PREFORK"] = "1"
+os.environ["WEB_WORKERS"] = str(workers)
+if workers > 1:
+    # A resume is only served by the worker holding the stream (see the note above).
+    os.environ.setdefault("SSE_RESUME", "0")
+    # Chosen by prometheus_client when the first metric is created, so it is set before the app loads.
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prometheus-"))
+# Model-call concurrency is limited per worker; split the host-wide default between them.
+os.environ.setdefault("ADMISSION_MAX_CONCURRENT", str(max(1, 64 // workers)))
+
+logger = logging.getLogger("gunicorn.error")
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Peak, in KiB on Linux.
+
+
+def on_starting(server):
+    if workers > 1 and os.getenv("SSE_RESUME") != "0":
+        logger.warning("SSE_RESUME=1 with %s workers: resumes that reach another worker get a 409", workers)
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        # Samples left by a previous run's workers would be summed into this one's.
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, "*.db")):
+            os.remove(path)
+
+
+def post_fork(server, worker):
+    logger.info("Worker %s forked", worker.pid)
+
+
+def post_worker_init(worker):
+    """Runs in each worker once the app is loaded: initialize the SDK and warm the models here."""
+    if os.getenv("MODEL_WARMUP", "1") == "0":
+        return
+    import app
+    app.start_model_warmup()
+
+
+def post_request(worker, req, environ, resp):
+    """Asks a threaded worker to exit gracefully once it outgrows WEB_MAX_RSS_MB."""
+    if WEB_MAX_RSS_MB and worker.alive and _rss_mb() > WEB_MAX_RSS_MB:
+        logger.info("Worker %s over %s MB resident, recycling", worker.pid, WEB_MAX_RSS_MB)
+        worker.alive = False
+
+
+def worker_exit(server, worker):
+    logger.info("Worker %s exited", worker.pid)
+
+
+def child_exit(server, worker):
+    """Runs in the master once a worker is gone: drop its live gauge samples from /metrics."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,213 @@
+import os
+import re
+import time
+import metrics
+
+try:
+    from markdown_it import MarkdownIt
+except ImportError:  # Optional: without it block_final carries no html and the client renders the block.
+    MarkdownIt = None
+
+# Server-side incremental markdown for /chat streams.
+# script.js used to re-run marked over the whole accumulated answer on every frame, so rendering
+# cost grew quadratically with answer length and long code answers stuttered. In block mode
+# ("render": "blocks" in the /chat payload) the server splits the answer into markdown blocks as
+# chunks arrive, tracking open code fences, and streams typed SSE events instead of text frames:
+#
+#     event: block        {"index": 3, "text": "..."}   text appended to the open (last) block
+#     event: block_final  {"index": 3, "html": "..."}   block 3 is complete; html is its final rendering
+#
+# The client re-renders only the open block and swaps in the stable html once it is final, so
+# earlier blocks are never touched again. A block ends at its closing code fence, or when the
+# first line after a blank line starts something new; indented continuations and further items
+# of a loose list stay in the same block. Only the first few characters of a line are ever held
+# back, while they could still open a fence or a list item.
+
+MARKDOWN_BLOCKS = os.getenv("MARKDOWN_BLOCKS", "1") != "0"
+RENDER_MODES = ("text", "blocks")
+
+_FENCE_OPEN = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+_LIST_ITEM = re.compile(r"^(?:[-*+]|\d{1,9}[.)])(?:[ \t]|$)")
+_LIST_MARKER_PREFIX = re.compile(r"^(?:[-*+]|\d{1,9}[.)]?)$")
+_PIECES = re.compile(r"[^\n]*\n|[^\n]+")
+
+_markdown = MarkdownIt("commonmark").enable(["table", "strikethrough"]) if MarkdownIt is not None else None
+
+
+def render_block(source: str):
+    """
+    Renders one finalized markdown block to HTML.
+
+    Returns:
+        str: The HTML, or None when markdown-it-py is not installed.
+    """
+    if _markdown is None:
+        return None
+    started = time.perf_counter()
+    html = _markdown.render(source)
+    metrics.MARKDOWN_RENDER_SECONDS.inc(time.perf_counter() - started)
+    return html
+
+
+def classify_line(line: str, complete: bool):
+    """
+    Classifies how a line starts, for block splitting.
+
+    Args:
+        line (str): The line received so far, including its newline once complete.
+        complete (bool): Whether the whole line has been received.
+
+    Returns:
+        str: 'blank', 'fence', 'list', 'indent' or 'text', or None while the characters received
+            so far could still start more than one of them.
+    """
+    stripped = line.lstrip(" \t")
+    body = stripped.rstrip("\n")
+    if not body.strip():
+        return "blank" if complete else None
+    indented = len(stripped) != len(line)
+    if body[0] in "`~":
+        if _FENCE_OPEN.match(line):
+            return "fence"
+        if not complete and body == body[0] * len(body):
+            return None
+    if indented:
+        return "indent"
+    if _LIST_ITEM.match(body):
+        return "list"
+    if not complete and _LIST_MARKER_PREFIX.match(body):
+        return None
+    return "text"
+
+
+class BlockStream:
+    """
+    Splits one streamed markdown answer into blocks and turns text into block events.
+
+    feed() and finish() return (event name, payload) pairs, in order, ready for format_sse().
+    Consecutive appends to the same block within one call are merged into one event.
+    """
+
+    def __init__(self, renderer=render_block):
+        self.renderer = renderer
+        self.index = -1  # Index of the last block started.
+        self.blocks_final = 0
+        self._open = False
+        self._list = False
+        self._after_blank = False
+        self._fence = None  # (marker char, length) while inside a code fence.
+        self._fence_block = False  # The open block is a fenced code block that ends with its fence.
+        self._fence_opening = False  # The current line opened the fence.
+        self._source = []
+        self._line = ""
+        self._placed = False  # Whether the current line has been assigned to a block yet.
+        self._leading = ""  # Blank lines waiting for the next block.
+
+    def feed(self, text: str):
+        """Consumes streamed answer text and returns the block events it completes."""
+        events = []
+        for piece in _PIECES.findall(text):
+            self._line += piece
+            complete = piece.endswith("\n")
+            if self._placed:
+                self._append(piece, events)
+            else:
+                self._place(complete, events)
+            if complete:
+                self._end_line(events)
+        return events
+
+    def finish(self):
+        """Flushes held text and finalizes the open block at the end of the stream."""
+        events = []
+        if self._line and not self._placed:
+            self._place(True, events)
+        self._line = ""
+        self._placed = False
+        self._fence = None
+        self._finalize(events)
+        self._leading = ""
+        return events
+
+    def _place(self, complete, events):
+        """Assigns the current line to the open block or a new one, once its start is known."""
+        if self._fence is not None:
+            kind = "code"
+        else:
+            kind = classify_line(self._line, complete)
+            if kind is None:
+                return
+        self._placed = True
+        if kind == "blank" and not self._open:
+            self._leading += self._line
+            return
+        if kind == "fence":
+            # A fence indented inside a list item belongs to the item; any other fence starts its own block.
+            nested = self._open and self._list and self._line[:1] in " \t"
+            if not nested:
+                self._finalize(events)
+                self._begin(events)
+                self._fence_block = True
+            marker = _FENCE_OPEN.match(self._line).group(1)
+            self._fence = (marker[0], len(marker))
+            self._fence_opening = True
+            self._after_blank = False
+        elif kind != "code":
+            if not self._open:
+                self._begin(events)
+            elif self._after_blank and kind != "blank" and not (kind == "indent" or (kind == "list" and self._list)):
+                self._finalize(events)
+                self._begin(events)
+            if kind == "list":
+                self._list = True
+        self._append(self._line, events)
+
+    def _end_line(self, events):
+        line = self._line
+        self._line = ""
+        self._placed = False
+        if self._fence is not None:
+            if self._fence_opening:
+                self._fence_opening = False
+            elif self._closes_fence(line):
+                self._fence = None
+                if self._fence_block:
+                    self._finalize(events)
+            return
+        if self._open:
+            self._after_blank = not line.strip()
+
+    def _closes_fence(self, line):
+        char, length = self._fence
+        body = line.strip()
+        return (len(line) - len(line.lstrip(" ")) <= 3 and len(body) >= length
+                and body == char * len(body))
+
+    def _begin(self, events):
+        self.index += 1
+        self._open = True
+        self._list = False
+        self._after_blank = False
+        self._fence_block = False
+        self._source = []
+        if self._leading:
+            leading, self._leading = self._leading, ""
+            self._append(leading, events)
+
+    def _append(self, text, events):
+        if not text:
+            return
+        self._source.append(text)
+        if events and events[-1][0] == "block" and events[-1][1]["index"] == self.index:
+            events[-1][1]["text"] += text
+        else:
+            events.append(("block", {"index": self.index, "text": text}))
+
+    def _finalize(self, events):
+        if not self._open:
+            return
+        self._open = False
+        self.blocks_final += 1
+        metrics.MARKDOWN_BLOCKS.inc()
+        events.append(("block_final", {"index": self.index, "html": self.renderer("".join(self._source))}))
+        self._source = []
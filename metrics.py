@@ -0,0 +1,126 @@
+import os
+import threading
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest
+
+# Prometheus metrics for the streaming hot path, served at /metrics.
+# Every observation is a lock-protected in-memory update, cheap enough to stay on at full load.
+# Under several worker processes (gunicorn.conf.py) each worker writes its samples to files in
+# PROMETHEUS_MULTIPROC_DIR and /metrics adds up all workers, whichever one serves the scrape;
+# gauges report the sum over live workers.
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 21, 34, 60, 120)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+BYTE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+# Model names come from clients, so cap the number of distinct label values.
+MAX_MODEL_LABELS = 20
+BLOCKED_MARKER_PREFIXES = ("[Content Blocked", "[Prompt Blocked")
+
+CHAT_REQUESTS = Counter(
+    "chat_requests_total", "Finished /chat streams by model and outcome.", ["model", "outcome"])
+CANCELLED_STREAMS = Counter(
+    "chat_cancelled_streams_total", "/chat streams cancelled because the client went away.", ["model"])
+CANCELLED_TOKENS_SAVED = Counter(
+    "chat_cancelled_tokens_saved_total", "Estimated output tokens not generated thanks to cancelled streams.", ["model"])
+TIME_TO_FIRST_CHUNK = Histogram(
+    "chat_time_to_first_chunk_seconds", "Time from stream start to the first answer chunk.", ["model"],
+    buckets=LATENCY_BUCKETS)
+STREAM_DURATION = Histogram(
+    "chat_stream_duration_seconds", "Total /chat stream duration.", ["model"], buckets=LATENCY_BUCKETS)
+STREAM_CHUNKS = Histogram(
+    "chat_stream_chunks", "Answer chunks per /chat stream.", buckets=SIZE_BUCKETS)
+STREAM_FRAMES = Histogram(
+    "chat_stream_frames", "SSE data frames per /chat stream after chunk coalescing.", buckets=SIZE_BUCKETS)
+STREAM_BYTES = Histogram(
+    "chat_stream_bytes", "Answer bytes per /chat stream.", buckets=BYTE_BUCKETS)
+HISTORY_LENGTH = Histogram(
+    "chat_history_messages", "History messages per /chat request (before context trimming).", buckets=SIZE_BUCKETS)
+PROMPT_BYTES = Histogram(
+    "chat_prompt_bytes", "Prompt size per /chat request.", buckets=BYTE_BUCKETS)
+OPEN_STREAMS = Gauge(
+    "chat_open_streams", "Currently open /chat streams.", multiprocess_mode="livesum")
+NAME_CHAT_LATENCY = Histogram(
+    "name_chat_duration_seconds", "/name_chat request latency.", buckets=LATENCY_BUCKETS)
+ENDPOINT_TTFT = Histogram(
+    "endpoint_time_to_first_chunk_seconds", "Time to first chunk per Vertex endpoint.", ["endpoint"],
+    buckets=LATENCY_BUCKETS)
+ENDPOINT_ERRORS = Counter(
+    "endpoint_errors_total", "Failed calls per Vertex endpoint.", ["endpoint"])
+HEDGED_REQUESTS = Counter(
+    "endpoint_hedged_requests_total", "Hedged streams by which request produced the first chunk.", ["outcome"])
+BUFFERED_STREAMS = Gauge(
+    "chat_buffered_streams", "/chat streams held in resumable buffers (running or recently finished).",
+    multiprocess_mode="livesum")
+STREAM_RESUMES = Counter(
+    "chat_stream_resumes_total", "Reconnects to a buffered /chat stream by outcome.", ["outcome"])
+SINGLE_FLIGHT_JOINS = Counter(
+    "chat_single_flight_joins_total", "/chat requests served by joining an identical in-flight generation.")
+COMPRESSION_BYTES = Counter(
+    "http_compression_bytes_total", "Response bytes before (in) and after (out) compression.", ["encoding", "direction"])
+COMPRESSION_SECONDS = Counter(
+    "http_compression_cpu_seconds_total", "Time spent compressing responses.", ["encoding"])
+MARKDOWN_BLOCKS = Counter(
+    "chat_markdown_blocks_total", "Markdown blocks finalized by block-mode /chat streams.")
+MARKDOWN_RENDER_SECONDS = Counter(
+    "chat_markdown_render_seconds_total", "Time spent rendering finalized markdown blocks to HTML.")
+BATCH_ITEMS = Counter(
+    "batch_items_total", "Finished batch items by type and outcome.", ["type", "outcome"])
+BATCH_ITEM_SECONDS = Histogram(
+    "batch_item_duration_seconds", "Batch item latency, retries included.", ["type"], buckets=LATENCY_BUCKETS)
+BATCH_RETRIES = Counter(
+    "batch_retries_total", "Batch item attempts that failed and were retried.", ["type"])
+CONTEXT_CACHE_REQUESTS = Counter(
+    "context_cache_requests_total", "Chat model calls by whether a context cache covered their prefix.", ["outcome"])
+CONTEXT_CACHE_INPUT_TOKENS = Counter(
+    "context_cache_input_tokens_total", "Input tokens of chat model calls, served from a context cache or not.", ["kind"])
+CONTEXT_CACHE_TTFT = Histogram(
+    "context_cache_time_to_first_chunk_seconds", "Model time to first chunk with and without a context cache.",
+    ["outcome"], buckets=LATENCY_BUCKETS)
+MODEL_ROUTES = Counter(
+    "chat_model_routes_total", "\"auto\" /chat requests by the model picked and why.", ["model", "reason"])
+ADMISSION_IN_FLIGHT = Gauge(
+    "admission_in_flight", "Admitted model calls currently running.", multiprocess_mode="livesum")
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "admission_queue_depth", "Requests waiting for admission.", multiprocess_mode="livesum")
+ADMISSION_WAIT = Histogram(
+    "admission_wait_seconds", "Time spent queued before admission.", ["priority"],
+    buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 15, 30))
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Requests rejected with 429 by admission control.", ["reason"])
+
+_model_labels = set()
+_model_labels_lock = threading.Lock()
+
+
+def model_label(model_name: str):
+    """Returns the label value for a model, folding unseen names into 'other' past the cap."""
+    if model_name in _model_labels:
+        return model_name
+    with _model_labels_lock:
+        if len(_model_labels) < MAX_MODEL_LABELS:
+            _model_labels.add(model_name)
+            return model_name
+    return "other"
+
+
+def stream_outcome(parts: list, failed: bool, is_error_marker, completed: bool = True):
+    """Classifies a finished stream as ok, blocked, error or cancelled from its yielded chunks."""
+    if failed:
+        return "error"
+    for part in parts:
+        if part.startswith(BLOCKED_MARKER_PREFIXES):
+            return "blocked"
+        if is_error_marker(part):
+            return "error"
+    return "ok" if completed else "cancelled"
+
+
+def render_metrics():
+    """Returns (body, content type) for the /metrics endpoint."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,157 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+import tracing
+from vertex_runtime import generative_models
+
+# Process-wide cache of GenerativeModel handles.
+# Building a GenerativeModel validates its parameters and creates a fresh gRPC client on
+# first use, so doing it per request adds setup cost and a cold TLS handshake to every
+# time-to-first-token. Handles are cached by (model name, system instruction, config) and
+# all handles for the same location share one warm prediction client.
+
+MODEL_POOL_SIZE = int(os.getenv("MODEL_POOL_SIZE", "32"))
+
+logger = logging.getLogger(__name__)
+
+
+class ModelPool:
+    """Thread-safe LRU cache of GenerativeModel handles with shared transport clients."""
+
+    def __init__(self, max_size: int = MODEL_POOL_SIZE):
+        self.max_size = max(1, max_size)
+        self._models = OrderedDict()
+        self._configs = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _config_key(generation_config):
+        return tuple(sorted(generation_config.items())) if generation_config else ()
+
+    def _generation_config(self, config_key):
+        # GenerationConfig objects are immutable once built, so one instance per distinct config is enough.
+        config = self._configs.get(config_key)
+        if config is None and config_key:
+            config = generative_models().GenerationConfig(**dict(config_key))
+            self._configs[config_key] = config
+        return config
+
+    def _share_client(self, model, attribute):
+        """Points a handle at the pooled client for its location, creating it on first use."""
+        key = (attribute, getattr(model, '_location', None))
+        client = self._clients.get(key)
+        if client is None:
+            # cached_property: first access builds the client and stores it on the instance.
+            self._clients[key] = getattr(model, attribute)
+        else:
+            model.__dict__[attribute] = client
+
+    def get_model(self, model_name: str, system_instruction: str = None, generation_config: dict = None, safety_settings: list = None):
+        """
+        Returns a cached GenerativeModel, creating it on a miss.
+
+        Args:
+            model_name (str): Model name or full resource name.
+            system_instruction (str, optional): System instruction text baked into the handle.
+            generation_config (dict, optional): Keyword arguments for GenerationConfig.
+            safety_settings (list, optional): Safety settings; keyed by identity, so pass a module-level constant.
+
+        Returns:
+            GenerativeModel: A handle whose defaults already carry the config and safety settings.
+        """
+        config_key = self._config_key(generation_config)
+        key = (model_name, system_instruction or "", config_key, id(safety_settings) if safety_settings is not None else None)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+            # A miss pays for SDK setup and a fresh client; the span shows it in the request's trace.
+            with tracing.span("model.build", model=model_name):
+                gm = generative_models()
+                model = gm.GenerativeModel(
+                    model_name,
+                    system_instruction=[gm.Part.from_text(system_instruction)] if system_instruction else None,
+                    generation_config=self._generation_config(config_key),
+                    safety_settings=safety_settings,
+                )
+                try:
+                    self._share_client(model, '_prediction_client')
+                except Exception as e:
+                    logger.warning("Could not attach pooled prediction client for %s: %s", model_name, e)
+            self._models[key] = model
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+            return model
+
+    def get_cached_model(self, cached_content, generation_config: dict = None, safety_settings: list = None):
+        """
+        Returns a cached handle bound to a context cache (see context_cache.py).
+
+        The cache carries the model, system instruction and conversation prefix, so handles are
+        keyed by the cache's resource name.
+        """
+        config_key = self._config_key(generation_config)
+        key = ("cachedContents", cached_content.name, config_key, id(safety_settings) if safety_settings is not None else None)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+            with tracing.span("model.build", cached_content=cached_content.name):
+                generative_models()
+                from vertexai.preview.generative_models import GenerativeModel
+                model = GenerativeModel.from_cached_content(
+                    cached_content=cached_content,
+                    generation_config=self._generation_config(config_key),
+                    safety_settings=safety_settings,
+                )
+                try:
+                    self._share_client(model, '_prediction_client')
+                except Exception as e:
+                    logger.warning("Could not attach pooled prediction client for %s: %s", cached_content.name, e)
+            self._models[key] = model
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+            return model
+
+    def share_async_client(self, model):
+        """Attaches the pooled async client; call from the event loop that serves the stream."""
+        with self._lock:
+            try:
+                self._share_client(model, '_prediction_async_client')
+            except Exception as e:
+                logger.warning("Could not attach pooled async prediction client: %s", e)
+
+    def warmup(self, model_name: str, system_instruction: str = None, generation_config: dict = None, safety_settings: list = None):
+        """
+        Creates a handle and opens its channel so the first real request skips the handshake.
+
+        Returns:
+            bool: True if the backend answered the warmup probe.
+        """
+        try:
+            model = self.get_model(model_name, system_instruction, generation_config, safety_settings)
+            # count_tokens is a cheap unary call that forces the gRPC channel to connect.
+            model.count_tokens("ping")
+            logger.info("Model pool warmed up: %s", model_name)
+            return True
+        except Exception as e:
+            logger.warning("Model warmup failed for %s: %s", model_name, e, exc_info=True)
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._models), "max_size": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "clients": len(self._clients)}
+
+
+model_pool = ModelPool()
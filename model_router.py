@@ -0,0 +1,200 @@
+import os
+import string
+import time
+import logging
+import threading
+import metrics
+
+# Latency-aware "auto" model routing.
+# The UI's model picker used to be passed through unchanged, so one-line questions often went to
+# the heaviest model. A request may now ask for model "auto": a local classifier scores the prompt
+# and the size of the history between 0 (trivial) and 1 (complex), and requests scoring below
+# ROUTER_COMPLEXITY_THRESHOLD go to ROUTER_LITE_MODEL, the rest to ROUTER_LARGE_MODEL.
+#
+# Live health feeds in from finished streams: a per-model EWMA of time-to-first-token and of the
+# error rate. A model whose error rate is above ROUTER_ERROR_THRESHOLD hands its traffic to the
+# other one until ROUTER_ERROR_COOLDOWN_SECONDS pass without a new error, and a borderline request
+# (within ROUTER_MARGIN of the threshold) goes to the other model when the preferred one's first
+# token is currently ROUTER_SLOW_FACTOR times slower.
+# The classifier is a few length checks and a keyword-set lookup over at most ROUTER_SCAN_CHARS
+# characters (a regex with this many alternatives took close to a millisecond on long plain
+# prompts), so a decision costs tens of microseconds; /healthz reports the average and maximum.
+# Statistics are per worker process. With MODEL_ROUTER=0, "auto" means ROUTER_LARGE_MODEL.
+
+AUTO_MODEL = "auto"
+MODEL_ROUTER = os.getenv("MODEL_ROUTER", "1") != "0"
+ROUTER_LITE_MODEL = os.getenv("ROUTER_LITE_MODEL", "gemini-2.0-flash-lite-001")
+ROUTER_LARGE_MODEL = os.getenv("ROUTER_LARGE_MODEL", os.getenv("DEFAULT_GEMINI_MODEL", "gemini-2.0-flash-001"))
+ROUTER_COMPLEXITY_THRESHOLD = float(os.getenv("ROUTER_COMPLEXITY_THRESHOLD", "0.4"))
+ROUTER_MARGIN = float(os.getenv("ROUTER_MARGIN", "0.15"))
+ROUTER_SLOW_FACTOR = float(os.getenv("ROUTER_SLOW_FACTOR", "2.0"))
+ROUTER_ERROR_THRESHOLD = float(os.getenv("ROUTER_ERROR_THRESHOLD", "0.3"))
+ROUTER_ERROR_COOLDOWN_SECONDS = float(os.getenv("ROUTER_ERROR_COOLDOWN_SECONDS", "30"))
+# Prompt and history sizes at which their part of the score is maxed out.
+ROUTER_LONG_PROMPT_CHARS = int(os.getenv("ROUTER_LONG_PROMPT_CHARS", "1500"))
+ROUTER_LONG_HISTORY_CHARS = int(os.getenv("ROUTER_LONG_HISTORY_CHARS", "20000"))
+ROUTER_SCAN_CHARS = 4000
+ROUTER_EWMA_ALPHA = 0.2
+
+# Words and phrases that tend to come with multi-step, reasoning or code-writing requests.
+_COMPLEX_WORDS = frozenset((
+    "explain", "analyze", "analyse", "compare", "contrast", "design", "architecture", "implement", "refactor",
+    "debug", "optimize", "optimise", "prove", "derive", "detailed", "tradeoffs", "essay", "report", "summarize",
+    "summarise", "translate", "algorithm", "function", "class", "code", "script", "sql", "regex", "equation",
+    "calculate",
+))
+_COMPLEX_PHRASES = ("step by step", "step-by-step", "in detail", "pros and cons", "trade-off")
+_PUNCTUATION_TO_SPACE = str.maketrans({c: " " for c in string.punctuation if c != "-"})
+
+logger = logging.getLogger(__name__)
+
+
+class ModelHealth:
+    """EWMA of one model's time to first token and error rate."""
+
+    __slots__ = ("ttft_ewma", "error_rate", "requests", "errors", "routed", "last_error_at")
+
+    def __init__(self):
+        self.ttft_ewma = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.routed = 0
+        self.last_error_at = float("-inf")
+
+    def failing(self, now: float):
+        # Once the cooldown passes traffic returns, and successes bring the rate back down.
+        return self.error_rate > ROUTER_ERROR_THRESHOLD and now - self.last_error_at < ROUTER_ERROR_COOLDOWN_SECONDS
+
+    def to_dict(self):
+        return {
+            "ttft_ms": round(self.ttft_ewma * 1000, 1) if self.ttft_ewma is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "routed": self.routed,
+        }
+
+
+class RouteDecision:
+    """The model picked for one "auto" request and why."""
+
+    __slots__ = ("model", "score", "reason")
+
+    def __init__(self, model: str, score: float, reason: str):
+        self.model = model
+        self.score = score
+        self.reason = reason
+
+    def to_dict(self):
+        return {"model": self.model, "requested": AUTO_MODEL, "score": round(self.score, 3), "reason": self.reason}
+
+
+def complexity(prompt: str, messages: list = None):
+    """
+    Scores how demanding a request is, from 0 (trivial) to 1 (complex).
+
+    Args:
+        prompt (str): The new user prompt.
+        messages (list, optional): Client-format history ({"role", "text"} dicts).
+
+    Returns:
+        float: The score.
+    """
+    head = prompt[:ROUTER_SCAN_CHARS]
+    lowered = head.lower()
+    keywords = len(_COMPLEX_WORDS.intersection(lowered.translate(_PUNCTUATION_TO_SPACE).split()))
+    keywords += sum(1 for phrase in _COMPLEX_PHRASES if phrase in lowered)
+    score = 0.45 * min(len(prompt) / ROUTER_LONG_PROMPT_CHARS, 1.0)
+    score += 0.15 * min(keywords, 3)
+    if "```" in head or head.count("\n") >= 4:
+        score += 0.2
+    if messages:
+        history_chars = sum(len(message["text"]) for message in messages
+                            if isinstance(message, dict) and isinstance(message.get("text"), str))
+        score += 0.25 * min(history_chars / ROUTER_LONG_HISTORY_CHARS, 1.0)
+    return min(score, 1.0)
+
+
+class ModelRouter:
+    """Picks the lite or the large model for "auto" requests and tracks both models' health."""
+
+    def __init__(self, lite_model: str = ROUTER_LITE_MODEL, large_model: str = ROUTER_LARGE_MODEL,
+                 threshold: float = ROUTER_COMPLEXITY_THRESHOLD, enabled: bool = MODEL_ROUTER):
+        self.lite_model = lite_model
+        self.large_model = large_model
+        self.threshold = threshold
+        self.enabled = enabled
+        self._health = {lite_model: ModelHealth(), large_model: ModelHealth()}
+        self._lock = threading.Lock()
+        self.decisions = 0
+        self.routing_seconds = 0.0
+        self.max_routing_seconds = 0.0
+
+    def route(self, prompt: str, messages: list = None):
+        """
+        Chooses the model for an "auto" request.
+
+        Returns:
+            RouteDecision: The model, the complexity score and the reason: "simple" or "complex"
+            from the classifier, "errors" or "latency" when live health overrode it, or
+            "disabled" when MODEL_ROUTER is off and the large model is used.
+        """
+        started = time.perf_counter()
+        if not self.enabled:
+            return RouteDecision(self.large_model, 0.0, "disabled")
+        score = complexity(prompt, messages)
+        complex_request = score >= self.threshold
+        preferred, other = (self.large_model, self.lite_model) if complex_request else (self.lite_model, self.large_model)
+        reason = "complex" if complex_request else "simple"
+        now = time.monotonic()
+        with self._lock:
+            health, other_health = self._health[preferred], self._health[other]
+            if health.failing(now) and other_health.error_rate < health.error_rate:
+                preferred, reason = other, "errors"
+            elif (abs(score - self.threshold) <= ROUTER_MARGIN and health.ttft_ewma is not None
+                  and other_health.ttft_ewma is not None
+                  and health.ttft_ewma > ROUTER_SLOW_FACTOR * other_health.ttft_ewma):
+                preferred, reason = other, "latency"
+            self._health[preferred].routed += 1
+            elapsed = time.perf_counter() - started
+            self.decisions += 1
+            self.routing_seconds += elapsed
+            self.max_routing_seconds = max(self.max_routing_seconds, elapsed)
+        metrics.MODEL_ROUTES.labels(metrics.model_label(preferred), reason).inc()
+        return RouteDecision(preferred, score, reason)
+
+    def record(self, model_name: str, ttft: float = None, ok: bool = None):
+        """
+        Feeds one finished upstream stream into its model's health.
+
+        Args:
+            ttft (float, optional): Seconds to the first chunk, if one arrived.
+            ok (bool, optional): Whether the stream succeeded; None (cancelled) says nothing about health.
+        """
+        health = self._health.get(model_name)
+        if health is None:
+            return
+        with self._lock:
+            if ttft is not None:
+                health.ttft_ewma = ttft if health.ttft_ewma is None else \
+                    health.ttft_ewma + ROUTER_EWMA_ALPHA * (ttft - health.ttft_ewma)
+            if ok is None:
+                return
+            health.requests += 1
+            health.error_rate += ROUTER_EWMA_ALPHA * ((0.0 if ok else 1.0) - health.error_rate)
+            if not ok:
+                health.errors += 1
+                health.last_error_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled, "threshold": self.threshold, "decisions": self.decisions,
+                "avg_routing_us": round(self.routing_seconds / self.decisions * 1e6, 1) if self.decisions else None,
+                "max_routing_us": round(self.max_routing_seconds * 1e6, 1),
+                "models": {name: health.to_dict() for name, health in self._health.items()},
+            }
+
+
+model_router = ModelRouter()
@@ -1,29 +1,42 @@
 #!/usr/bin/env python
 import os
-import traceback
+import logging
 from dotenv import load_dotenv
-import vertexai
-from vertexai.generative_models import (
-    GenerativeModel,
-    Part,
-    Content,
-    GenerationConfig
-)
+import tracing
+from backends import get_backend
+from chat_titles import build_title_prompt
+from vertex_runtime import make_content
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize Vertex AI SDK
-try:
-    project_id = os.getenv("GOOGLE_PROJECT_ID")
-    location = os.getenv("GOOGLE_LOCATION")
-    if not project_id or not location:
-        raise ValueError("GOOGLE_PROJECT_ID and GOOGLE_LOCATION must be set in the .env file")
-    vertexai.init(project=project_id, location=location)
-    print(f"Vertex AI initialized for project: {project_id} in location: {location}")
-except Exception as e:
-    print(f"Error initializing Vertex AI: {e}")
-    raise
+logger = logging.getLogger(__name__)
+
+# The Vertex AI SDK is initialized lazily (once per process) by vertex_runtime.
+
+SYSTEM_INSTRUCTION = (
+    "You are an AI chat name generator. Your role is to produce a short, creative, and descriptive title "
+    "based on the conversation provided. The title must be in title case and contain between 2 to 5 words. "
+    "It should uniquely capture the main topic or essence of the conversation. Do not include any extra explanation "
+    "or punctuation—output only the title."
+)
+GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "top_p": 0.8,
+    "max_output_tokens": 20,
+}
+SAFETY_SETTINGS = []
+
+
+def _chat_name_model_name():
+    # Use the model name from .env or default to "chat-name-model-001"
+    return os.getenv("DEFAULT_CHAT_NAME_MODEL", "gemini-2.0-flash-lite-001")
+
+
+def warmup_chat_name_model():
+    """Pre-opens the pooled connection used for title generation (DEFAULT_CHAT_NAME_MODEL)."""
+    return get_backend().warmup(_chat_name_model_name(), SYSTEM_INSTRUCTION, GENERATION_CONFIG, SAFETY_SETTINGS)
+
 
 def generate_chat_name(chat_history):
     """
@@ -35,48 +48,24 @@ def generate_chat_name(chat_history):
     Returns:
         str: A title (in title case, between 2-5 words) or a fallback name.
     """
-    conversation_text = ""
-    for msg in chat_history:
-        role = msg.get('role', '')
-        text = msg.get('text', '')
-        conversation_text += f"{role.capitalize()}: {text}\n"
-    
-    system_instruction = (
-        "You are an AI chat name generator. Your role is to produce a short, creative, and descriptive title "
-        "based on the conversation provided. The title must be in title case and contain between 2 to 5 words. "
-        "It should uniquely capture the main topic or essence of the conversation. Do not include any extra explanation "
-        "or punctuation—output only the title."
-    )
-    
-    system_content = Part.from_text(system_instruction)
-    user_prompt = f"Conversation:\n{conversation_text}\n\nGenerate a title for this conversation:"
+    with tracing.span("title.prompt", history_length=len(chat_history)):
+        user_prompt = build_title_prompt(chat_history)
     
     try:
-        # Use the model name from .env or default to "chat-name-model-001"
-        model_name = os.getenv("DEFAULT_CHAT_NAME_MODEL", "gemini-2.0-flash-lite-001")
-        model = GenerativeModel(model_name, system_instruction=[system_content])
-        generation_config = GenerationConfig(
-            temperature=0.2,
-            top_p=0.8,
-            max_output_tokens=20
-        )
-        content = [Content(role="user", parts=[Part.from_text(user_prompt)])]
-        result = model.generate_content(
-            contents=content,
-            generation_config=generation_config,
-            safety_settings=[],
-            stream=False
-        )
+        content = [make_content("user", user_prompt)]
+        with tracing.span("upstream.generate", model=_chat_name_model_name()):
+            result = get_backend().generate(
+                _chat_name_model_name(), SYSTEM_INSTRUCTION, content, GENERATION_CONFIG, SAFETY_SETTINGS
+            )
         if result and result.candidates:
             candidate = result.candidates[0]
             chat_name = candidate.content.parts[0].text.strip()
             return chat_name
         else:
-            print("No candidates generated for chat name.")
+            logger.warning("No candidates generated for chat name")
             return "Untitled Chat"
     except Exception as e:
-        print(f"Error generating chat name: {e}")
-        print(traceback.format_exc())
+        logger.exception("Error generating chat name: %s", e)
         # Fallback if the model is not found or any other error occurs
         return "Untitled Chat"
 
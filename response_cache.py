@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from shared_state import shared_state
+
+# Response cache with stream replay.
+# Identical requests (gallery prompts, onboarding questions, retries after a reload) are served
+# from the chunks of an earlier generation instead of a new Vertex call. Hits are replayed
+# chunk by chunk through the normal SSE path, optionally paced to look like a live stream.
+# With several worker processes the cache also reads and writes through to shared_state, so a
+# response generated by one worker is a hit in all of them.
+
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_REPLAY_DELAY_MS = float(os.getenv("RESPONSE_CACHE_REPLAY_DELAY_MS", "0"))
+
+
+def make_cache_key(model_name: str, system_instruction: str, history: list, user_prompt: str, generation_config: dict):
+    """
+    Builds the cache key for one request.
+
+    Args:
+        history (list): (role, text) pairs of the history actually sent to the model.
+
+    Returns:
+        str: A hex digest; whitespace around messages is ignored.
+    """
+    normalized = {
+        "model": model_name,
+        "system": (system_instruction or "").strip(),
+        "history": [[role.lower(), text.strip()] for role, text in history],
+        "prompt": user_prompt.strip(),
+        "config": generation_config,
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of streamed responses with a byte-size cap and TTL."""
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+                 replay_delay_ms: float = RESPONSE_CACHE_REPLAY_DELAY_MS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.replay_delay = max(0.0, replay_delay_ms) / 1000.0
+        self._entries = OrderedDict()  # key -> (stored_at, size, chunks)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key: str):
+        """Returns the cached chunks for a key, or None on a miss or expired entry."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, size, chunks = entry
+                if self.ttl_seconds > 0 and time.time() - stored_at > self.ttl_seconds:
+                    del self._entries[key]
+                    self._bytes -= size
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return chunks
+        chunks = shared_state.get("response", key)
+        with self._lock:
+            if not chunks:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.shared_hits += 1
+        chunks = tuple(chunks)
+        self._store(key, chunks)
+        return chunks
+
+    def put(self, key: str, chunks: list):
+        """Stores a completed response; entries larger than a quarter of the cap are skipped."""
+        if not self.enabled or not chunks:
+            return
+        chunks = tuple(chunks)
+        if self._store(key, chunks):
+            shared_state.put("response", key, chunks, self.ttl_seconds)
+
+    def _store(self, key: str, chunks: tuple):
+        size = sum(len(chunk.encode("utf-8")) for chunk in chunks)
+        if size > self.max_bytes // 4:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[1]
+            self._entries[key] = (time.time(), size, chunks)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+        return True
+
+    def replay(self, chunks):
+        """Yields cached chunks, sleeping between them when replay pacing is configured."""
+        for i, chunk in enumerate(chunks):
+            if i and self.replay_delay:
+                time.sleep(self.replay_delay)
+            yield chunk
+
+    async def replay_async(self, chunks):
+        for i, chunk in enumerate(chunks):
+            if i and self.replay_delay:
+                await asyncio.sleep(self.replay_delay)
+            yield chunk
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "shared_hits": self.shared_hits, "misses": self.misses}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from vertex_runtime import make_content
+from shared_state import shared_state
+
+# Server-held conversation sessions.
+# Clients that opt in send only the new prompt plus a conversation id; the server keeps the
+# history (and its already-built Content objects) so each turn costs O(1) to parse and convert.
+# Sessions live in a bounded in-memory LRU with a TTL; evicted sessions can optionally spill
+# to disk as JSON and are reloaded transparently on the next request. With several worker
+# processes every write also goes to shared_state, and a worker whose copy is older than the
+# shared one (the last turn ran in another worker) rebuilds it before use.
+
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600"))
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", "")
+
+logger = logging.getLogger(__name__)
+
+
+def is_valid_conversation_id(conversation_id):
+    """Conversation ids are opaque alphanumeric tokens (uuid4 hex when issued by the server)."""
+    return isinstance(conversation_id, str) and 0 < len(conversation_id) <= 64 and conversation_id.isalnum()
+
+
+class Session:
+    """One conversation: the client-format messages plus their cached Content objects."""
+
+    def __init__(self, conversation_id: str, messages: list = None, contents: list = None, last_access: float = None):
+        self.conversation_id = conversation_id
+        self.messages = list(messages or [])
+        if contents is None:
+            contents = [make_content(msg['role'], msg['text']) for msg in self.messages]
+        self.contents = list(contents)
+        self.last_access = last_access or time.time()
+        self.version = None  # Version token of the shared copy this session matches.
+
+    def append(self, role: str, text: str):
+        self.messages.append({"role": role, "text": text})
+        self.contents.append(make_content(role, text))
+
+    def to_dict(self):
+        return {"conversation_id": self.conversation_id, "messages": self.messages, "last_access": self.last_access}
+
+
+class SessionStore:
+    """Thread-safe session store with TTL, LRU eviction and optional on-disk spill."""
+
+    def __init__(self, max_sessions: int = SESSION_MAX, ttl_seconds: float = SESSION_TTL_SECONDS, spill_dir: str = SESSION_SPILL_DIR):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl_seconds = ttl_seconds
+        self.spill_dir = spill_dir or None
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def _expired(self, last_access: float, now: float):
+        return self.ttl_seconds > 0 and now - last_access > self.ttl_seconds
+
+    def _spill_path(self, conversation_id: str):
+        # Ids are generated as uuid4 hex, but reject anything else so a client cannot escape spill_dir.
+        if not conversation_id.isalnum():
+            return None
+        return os.path.join(self.spill_dir, f"{conversation_id}.json")
+
+    def _spill(self, session: Session):
+        path = self._spill_path(session.conversation_id) if self.spill_dir else None
+        if not path:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(session.to_dict(), f)
+        except Exception as e:
+            logger.warning("Could not spill session %s: %s", session.conversation_id, e)
+
+    def _load_spilled(self, conversation_id: str, now: float):
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(conversation_id)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            os.remove(path)
+        except Exception as e:
+            logger.warning("Could not load spilled session %s: %s", conversation_id, e, exc_info=True)
+            return None
+        if self._expired(data.get("last_access", 0), now):
+            return None
+        return Session(conversation_id, data.get("messages", []))
+
+    def _sweep(self, now: float):
+        """Drops expired sessions from memory and disk; runs at most once a minute."""
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for conversation_id in [cid for cid, s in self._sessions.items() if self._expired(s.last_access, now)]:
+            del self._sessions[conversation_id]
+        if self.spill_dir:
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                try:
+                    if self._expired(os.path.getmtime(path), now):
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def _put(self, session: Session):
+        self._sessions[session.conversation_id] = session
+        self._sessions.move_to_end(session.conversation_id)
+        while len(self._sessions) > self.max_sessions:
+            _, evicted = self._sessions.popitem(last=False)
+            self._spill(evicted)
+
+    def _publish(self, conversation_id: str, messages: list):
+        """Writes a session's history to the shared store and records the new version locally."""
+        if not shared_state.enabled:
+            return
+        version = shared_state.put("session", conversation_id, {"messages": messages}, self.ttl_seconds)
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is not None and len(session.messages) == len(messages):
+                session.version = version
+
+    def _fetch_shared(self, conversation_id: str, now: float):
+        """Returns the shared copy of a session when it differs from the local one, else None."""
+        if not shared_state.enabled:
+            return None
+        version = shared_state.version("session", conversation_id)
+        if version is None:
+            return None
+        with self._lock:
+            local = self._sessions.get(conversation_id)
+            if local is not None and local.version == version:
+                return None
+        entry = shared_state.get_entry("session", conversation_id)
+        if entry is None:
+            return None
+        session = Session(conversation_id, entry[0].get("messages", []), last_access=now)
+        session.version = entry[1]
+        return session
+
+    def create(self, messages: list = None, contents: list = None):
+        """Starts a new session seeded with an existing history and returns it."""
+        now = time.time()
+        session = Session(uuid.uuid4().hex, messages, contents, now)
+        with self._lock:
+            self._sweep(now)
+            self._put(session)
+        self._publish(session.conversation_id, list(session.messages))
+        return session
+
+    def get(self, conversation_id: str):
+        """Returns the live session for an id, or None if it is unknown or expired."""
+        if not is_valid_conversation_id(conversation_id):
+            return None
+        now = time.time()
+        shared = self._fetch_shared(conversation_id, now)
+        with self._lock:
+            session = shared or self._sessions.get(conversation_id)
+            if session is None:
+                session = self._load_spilled(conversation_id, now)
+            elif shared is None and self._expired(session.last_access, now):
+                del self._sessions[conversation_id]
+                return None
+            if session is None:
+                return None
+            session.last_access = now
+            self._put(session)
+            return session
+
+    def reset(self, conversation_id: str, messages: list, contents: list = None):
+        """Replaces a session's history with one resent by the client, keeping its id."""
+        now = time.time()
+        session = Session(conversation_id, messages, contents, now)
+        with self._lock:
+            self._put(session)
+        self._publish(conversation_id, list(session.messages))
+        return session
+
+    def record_turn(self, conversation_id: str, user_prompt: str, response_text: str):
+        """Appends a completed user/model exchange to a session."""
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                return
+            session.append("user", user_prompt)
+            session.append("model", response_text)
+            session.last_access = time.time()
+            messages = list(session.messages)
+        self._publish(conversation_id, messages)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "max_sessions": self.max_sessions, "ttl_seconds": self.ttl_seconds}
+
+
+session_store = SessionStore()
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+# State shared by the worker processes of one host.
+# Under the pre-fork server (gunicorn.conf.py) each worker is its own process, so the response
+# cache, title cache, sessions and per-client token buckets kept in per-process dicts would split
+# into N partial copies: a session created by one worker would be unknown to the next, and a
+# client could spend N rate budgets. With SHARED_STATE on, those modules keep their in-process
+# dicts as a first level and read through and write through to one SQLite file in WAL mode, so
+# readers never wait on the writer. Entries carry a TTL and a version token, so a worker can
+# check whether its local copy is stale with one indexed lookup. Errors here are logged and
+# treated as misses: the shared level only ever makes a worker better informed.
+
+# "auto" turns the shared level on when more than one worker process is configured.
+SHARED_STATE = os.getenv("SHARED_STATE", "auto")
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "shared_state.sqlite3"))
+SHARED_STATE_BUSY_TIMEOUT_SECONDS = float(os.getenv("SHARED_STATE_BUSY_TIMEOUT_SECONDS", "2"))
+SHARED_STATE_MAX_VALUE_BYTES = int(os.getenv("SHARED_STATE_MAX_VALUE_BYTES", str(4 * 1024 * 1024)))
+SHARED_STATE_SWEEP_SECONDS = float(os.getenv("SHARED_STATE_SWEEP_SECONDS", "60"))
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    version TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires_at);
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    full_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS buckets_full ON buckets (full_at);
+"""
+
+
+def is_enabled(setting: str = SHARED_STATE, workers: int = WEB_WORKERS):
+    """The shared level is on when forced with "1", or with "auto" when several workers run."""
+    if setting == "auto":
+        return workers > 1
+    return setting == "1"
+
+
+class SharedState:
+    """
+    Versioned key/value entries and token buckets in one SQLite file, shared across processes.
+
+    Each thread keeps its own connection; connections and locks are dropped in a forked child,
+    since an SQLite connection must not be used on both sides of a fork.
+    """
+
+    def __init__(self, path: str = SHARED_STATE_PATH, enabled: bool = None):
+        self.path = path
+        self.enabled = is_enabled() if enabled is None else enabled
+        self.errors = 0
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._last_sweep = time.time()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=SHARED_STATE_BUSY_TIMEOUT_SECONDS, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # Caches and buckets may lose the last writes on power loss.
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(_SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _failed(self, action: str, error: Exception):
+        self.errors += 1
+        logger.warning("Shared state %s failed: %s", action, error, extra={"path": self.path})
+
+    def get_entry(self, namespace: str, key: str):
+        """
+        Reads one entry.
+
+        Returns:
+            tuple: (value, version), or None if the entry is missing, expired or unreadable.
+        """
+        if not self.enabled:
+            return None
+        try:
+            row = self._conn().execute(
+                "SELECT value, version FROM entries WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, key, time.time())).fetchone()
+            return (json.loads(row[0]), row[1]) if row else None
+        except (sqlite3.Error, ValueError) as e:
+            self._failed("read", e)
+            return None
+
+    def get(self, namespace: str, key: str):
+        """Returns an entry's value, or None."""
+        entry = self.get_entry(namespace, key)
+        return entry[0] if entry else None
+
+    def version(self, namespace: str, key: str):
+        """Returns an entry's version token without reading its value, or None."""
+        if not self.enabled:
+            return None
+        try:
+            row = self._conn().execute(
+                "SELECT version FROM entries WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, key, time.time())).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            self._failed("read", e)
+            return None
+
+    def put(self, namespace: str, key: str, value, ttl_seconds: float = 0):
+        """
+        Writes one entry, replacing any previous value.
+
+        Args:
+            value: Any JSON-serializable value; values over SHARED_STATE_MAX_VALUE_BYTES are skipped.
+            ttl_seconds (float): Lifetime of the entry; 0 keeps it until it is replaced or deleted.
+
+        Returns:
+            str: The entry's new version token, or None if it was not written.
+        """
+        if not self.enabled:
+            return None
+        encoded = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        if len(encoded) > SHARED_STATE_MAX_VALUE_BYTES:
+            return None
+        now = time.time()
+        version = uuid.uuid4().hex[:16]
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (namespace, key, value, version, expires_at) VALUES (?, ?, ?, ?, ?)",
+                    (namespace, key, encoded, version, now + ttl_seconds if ttl_seconds > 0 else None))
+                self._sweep_locked(conn, now)
+            return version
+        except sqlite3.Error as e:
+            self._failed("write", e)
+            return None
+
+    def delete(self, namespace: str, key: str):
+        if not self.enabled:
+            return
+        try:
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+        except sqlite3.Error as e:
+            self._failed("delete", e)
+
+    def take_token(self, key: str, rate: float, burst: int):
+        """
+        Takes one token from a token bucket shared by every worker process.
+
+        Returns:
+            float: 0 on success, or the seconds until a token is available. A store error
+                admits the request; the per-worker concurrency limits still apply.
+        """
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = float(burst) if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                retry_after = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    retry_after = (1 - tokens) / rate
+                # full_at: when the bucket will have refilled, after which its row carries no information.
+                conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+                             (key, tokens, now, now + (burst - tokens) / rate))
+                self._sweep_locked(conn, now)
+            return retry_after
+        except sqlite3.Error as e:
+            self._failed("token bucket", e)
+            return 0.0
+
+    def _sweep_locked(self, conn, now: float):
+        """Drops expired entries and refilled buckets; runs at most once per SHARED_STATE_SWEEP_SECONDS."""
+        if now - self._last_sweep < SHARED_STATE_SWEEP_SECONDS:
+            return
+        self._last_sweep = now
+        conn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+        conn.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+
+    def stats(self):
+        if not self.enabled:
+            return {"enabled": False}
+        try:
+            conn = self._conn()
+            namespaces = dict(conn.execute("SELECT namespace, COUNT(*) FROM entries GROUP BY namespace").fetchall())
+            buckets = conn.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+        except sqlite3.Error as e:
+            self._failed("stats", e)
+            namespaces, buckets = {}, None
+        return {"enabled": True, "path": self.path, "entries": namespaces, "buckets": buckets, "errors": self.errors}
+
+
+shared_state = SharedState()
@@ -0,0 +1,102 @@
+import os
+import logging
+import threading
+import metrics
+
+# Single-flight de-duplication of identical /chat generations.
+# Double-submits, retries after a timeout and several open tabs often send the same /chat
+# payload while the first answer is still streaming, and each used to start its own model call.
+# Requests are keyed on the normalized payload (the response-cache key plus the conversation and
+# title flag). An identical request that arrives while a generation is running subscribes to
+# that stream's resumable buffer: it gets the frames produced so far, then the live tail.
+# Subscribers only detach when they leave; the upstream call is cancelled only once every
+# request sharing it has cancelled or the stream's grace window runs out with no readers.
+
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") != "0"
+
+logger = logging.getLogger(__name__)
+
+
+def flight_key(request_key: str, conversation_id, want_title: bool, render_mode: str = "text"):
+    """Combines the normalized request key with the parts of the request that shape its frames."""
+    return f"{request_key}:{conversation_id or ''}:{int(bool(want_title))}:{render_mode}"
+
+
+class SingleFlight:
+    """Thread-safe map of flight key -> StreamBuffer of the generation currently running for it."""
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT):
+        self.enabled = enabled
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.joined = 0
+
+    def join(self, key):
+        """
+        Attaches to the running stream for key.
+
+        Returns:
+            StreamBuffer: The shared stream (held for the caller), or None if nothing is running.
+        """
+        if not self.enabled or key is None:
+            return None
+        with self._lock:
+            buffer = self._join_locked(key)
+        if buffer is not None:
+            self._log_join(buffer)
+        return buffer
+
+    def acquire(self, key, create):
+        """
+        Joins the running stream for key, or starts a new one.
+
+        Closes the race between two identical requests that both missed join() while queued
+        for admission.
+
+        Args:
+            key (str): Flight key, or None to always start a new stream.
+            create (callable): Builds the StreamBuffer for a new stream; called under the lock.
+
+        Returns:
+            tuple: (StreamBuffer, True if the caller leads the flight and must produce it).
+        """
+        if not self.enabled or key is None:
+            return create(), True
+        with self._lock:
+            buffer = self._join_locked(key)
+            if buffer is None:
+                self._flights[key] = create()
+                self.started += 1
+                return self._flights[key], True
+        self._log_join(buffer)
+        return buffer, False
+
+    def _join_locked(self, key):
+        buffer = self._flights.get(key)
+        if buffer is None or buffer.done or buffer.cancel_reason is not None:
+            return None
+        buffer.hold()
+        self.joined += 1
+        return buffer
+
+    def _log_join(self, buffer):
+        metrics.SINGLE_FLIGHT_JOINS.inc()
+        logger.info("Joined in-flight generation", extra={"stream_id": buffer.stream_id,
+                                                          "last_event_id": buffer.last_event_id})
+
+    def forget(self, key, buffer):
+        """Drops a finished flight, unless a newer stream already took its key."""
+        if key is None:
+            return
+        with self._lock:
+            if self._flights.get(key) is buffer:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "in_flight": len(self._flights), "started": self.started,
+                    "joined": self.joined}
+
+
+single_flight = SingleFlight()
@@ -15,12 +15,18 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // --- Theme Selection Setup ---
     const themeSelect = document.getElementById('theme-select');
+    // Only the unbundled page links a single theme file; the bundle carries every theme.
+    const themeLink = document.getElementById('theme-style');
+    function applyTheme(theme) {
+        document.documentElement.dataset.theme = theme;
+        if (themeLink) themeLink.href = `/static/themes/${theme}.css`;
+    }
     const savedTheme = localStorage.getItem('theme') || "dark";
     themeSelect.value = savedTheme;
-    document.getElementById('theme-style').href = `/static/themes/${savedTheme}.css`;
+    applyTheme(savedTheme);
     themeSelect.addEventListener('change', () => {
         const selectedTheme = themeSelect.value;
-        document.getElementById('theme-style').href = `/static/themes/${selectedTheme}.css`;
+        applyTheme(selectedTheme);
         localStorage.setItem('theme', selectedTheme);
     });
     
@@ -41,6 +47,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const conversationModeSelector = document.getElementById('conversation-mode');
     const chatTitle = document.getElementById('chat-title');
     const currentModelDisplay = document.getElementById('current-model');
+    const chatSearchInput = document.getElementById('chat-search');
     
     // --- State Variables ---
     let chatHistory = [];
@@ -50,6 +57,11 @@ document.addEventListener('DOMContentLoaded', () => {
     let controller = null;
     let activeSession = true;
     let currentChatName = "";
+    let conversationId = null; // Server-held session id; lets us send only the new prompt.
+    // A dropped /chat connection is resumed from the last SSE id instead of regenerated.
+    const MAX_RESUME_ATTEMPTS = 5;
+    const RESUME_BACKOFF_MS = 500;
+    const CHAT_PAGE_SIZE = 50;
     
     // --- Config (Defaults from Flask/HTML) ---
     const defaultConfig = window.appConfig || {
@@ -100,6 +112,16 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Renders one markdown block of a block-mode stream (the server already split the answer).
+    function renderBlock(text) {
+        try {
+            return marked.parse(parseWithFences(text));
+        } catch (e) {
+            console.error("Markdown parsing failed:", e);
+            return text.replace(/</g, "&lt;").replace(/>/g, "&gt;").replace(/\n/g, '<br>');
+        }
+    }
+
     // --- Chat Naming Functions ---
     async function getChatName(history) {
         try {
@@ -123,136 +145,240 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
-    // --- Chat Saving Functions ---
-    async function saveChatSession() {
-        if (chatHistory.length > 0) {
-            let savedChats = [];
-            try {
-                savedChats = JSON.parse(localStorage.getItem('savedChats')) || [];
-            } catch (e) {
-                savedChats = [];
-            }
-            // Preserve the unread flag if it exists.
-            let nameToUse = currentChatName || chatTitle.textContent.trim() || "Untitled Chat";
-            let chatCounter = parseInt(localStorage.getItem('chatCounter') || "0", 10);
-            chatCounter++;
-            localStorage.setItem('chatCounter', chatCounter);
-            let newChat = { id: chatCounter, name: nameToUse, history: chatHistory };
-            // If the current chat was marked unread, add that property.
-            if (chatHistory.some(msg => msg.role === 'model')) {
-                newChat.unread = newChat.unread || false;
+    // --- Chat Library (server-side, see /api/chats) ---
+    // Chats are stored by the server under a random library id kept in this browser. Messages
+    // are appended one at a time and the chat list is fetched a page at a time, so nothing
+    // rewrites the whole library.
+    let libraryId = localStorage.getItem('libraryId');
+    if (!libraryId) {
+        libraryId = Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+        localStorage.setItem('libraryId', libraryId);
+    }
+    // The chat new messages are appended to; a fresh object per chat so late writes cannot cross chats.
+    let currentChat = { id: localStorage.getItem('currentChatId') };
+    let persistQueue = Promise.resolve();
+    let chatListCursor = null;
+    let chatListQuery = "";
+    let chatListRequest = 0;
+
+    async function libraryFetch(path, options = {}) {
+        const headers = Object.assign({ 'X-Library-Id': libraryId }, options.headers || {});
+        const response = await fetch(path, Object.assign({}, options, { headers: headers }));
+        if (!response.ok) throw new Error(`Chat library returned ${response.status}`);
+        return response.status === 204 ? null : response.json();
+    }
+
+    function libraryJSON(method, path, body) {
+        return libraryFetch(path, { method: method, headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) });
+    }
+
+    function setCurrentChat(chatId) {
+        currentChat = { id: chatId };
+        if (chatId) {
+            localStorage.setItem('currentChatId', chatId);
+        } else {
+            localStorage.removeItem('currentChatId');
+        }
+    }
+
+    // Appends one message to the current chat, creating the chat with its first message.
+    // Writes are queued so messages keep their order.
+    function persistMessage(role, text, chat = currentChat) {
+        persistQueue = persistQueue.then(async () => {
+            if (chat.id) {
+                await libraryJSON('POST', `/api/chats/${encodeURIComponent(chat.id)}/messages`, { messages: [{ role: role, text: text }] });
+                return;
             }
-            savedChats.push(newChat);
-            localStorage.setItem('savedChats', JSON.stringify(savedChats));
+            const created = await libraryJSON('POST', '/api/chats', { name: currentChatName, messages: [{ role: role, text: text }] });
+            chat.id = created.id;
+            if (chat === currentChat) localStorage.setItem('currentChatId', created.id);
             renderSavedChats();
+        }).catch(e => console.error("Failed to save message to the chat library", e));
+        return persistQueue;
+    }
+
+    // --- Chat Saving Functions ---
+    async function saveChatSession() {
+        await persistQueue;
+        const chat = currentChat;
+        if (!chat.id || chatHistory.length === 0) return;
+        const nameToUse = currentChatName || chatTitle.textContent.trim() || "Untitled Chat";
+        const unread = Boolean(chatHistory[chatHistory.length - 1].unread);
+        try {
+            await libraryJSON('PATCH', `/api/chats/${encodeURIComponent(chat.id)}`, { name: nameToUse, unread: unread });
+        } catch (e) {
+            console.error("Failed to update saved chat", e);
         }
+        renderSavedChats();
     }
-    
-    // --- Modify renderSavedChats() to show an unread indicator ---
-    function renderSavedChats() {
+
+    function savedChatItem(chat) {
+        const li = document.createElement('li');
+        li.classList.add('saved-chat');
+        if (chat.id === currentChat.id) li.classList.add('active-chat');
+        li.innerHTML = `<i class="far fa-comment-dots"></i><span></span>${chat.unread ? '<span class="unread-indicator"></span>' : ''}<button class="delete-chat-btn" title="Delete Chat"><i class="fas fa-trash-alt"></i></button>`;
+        li.querySelector('span').textContent = chat.name || "Untitled Chat";
+        if (chat.snippet) li.title = chat.snippet;
+        li.addEventListener('click', () => {
+            // Mark as read when chat is opened.
+            if (chat.unread) {
+                chat.unread = false;
+                libraryJSON('PATCH', `/api/chats/${encodeURIComponent(chat.id)}`, { unread: false })
+                    .then(() => renderSavedChats())
+                    .catch(e => console.error("Failed to mark chat as read", e));
+            }
+            loadChatSession(chat.id);
+        });
+        li.querySelector('.delete-chat-btn').addEventListener('click', (e) => {
+            e.stopPropagation();
+            deleteChatSession(chat.id);
+        });
+        return li;
+    }
+
+    // Shows the first page of saved chats (or search results), or appends the next page.
+    async function renderSavedChats(loadMore = false) {
         const chatListUl = document.querySelector('.chat-list ul');
         if (!chatListUl) return;
-        chatListUl.innerHTML = "";
-        let savedChats = [];
+        const request = ++chatListRequest;
+        const params = new URLSearchParams({ limit: String(CHAT_PAGE_SIZE) });
+        if (chatListQuery) params.set('q', chatListQuery);
+        if (loadMore && chatListCursor) params.set('cursor', chatListCursor);
+        let page;
         try {
-            savedChats = JSON.parse(localStorage.getItem('savedChats')) || [];
+            page = await libraryFetch(`/api/chats?${params}`);
         } catch (e) {
-            savedChats = [];
+            console.error("Failed to load saved chats", e);
+            return;
         }
-        savedChats.forEach(chat => {
-            // If chat has unread property true, include a blue bubble indicator.
-            const unreadIndicator = chat.unread ? '<span class="unread-indicator"></span>' : '';
+        if (request !== chatListRequest) return; // A newer listing or search replaced this one.
+        if (!loadMore) chatListUl.innerHTML = "";
+        const moreItem = chatListUl.querySelector('.load-more-chats');
+        if (moreItem) moreItem.remove();
+        page.chats.forEach(chat => chatListUl.appendChild(savedChatItem(chat)));
+        chatListCursor = page.next_cursor;
+        if (chatListCursor) {
             const li = document.createElement('li');
-            li.classList.add('saved-chat');
-            li.innerHTML = `<i class="far fa-comment-dots"></i><span>${chat.name}</span>${unreadIndicator}<button class="delete-chat-btn" title="Delete Chat"><i class="fas fa-trash-alt"></i></button>`;
-            li.addEventListener('click', () => {
-                // Mark as read when chat is opened.
-                if (chat.unread) {
-                    chat.unread = false;
-                    saveSavedChats(); // A helper to update saved chats in localStorage.
-                }
-                loadChatSession(chat.id);
-            });
-            li.querySelector('.delete-chat-btn').addEventListener('click', (e) => {
-                e.stopPropagation();
-                deleteChatSession(chat.id);
-            });
+            li.classList.add('load-more-chats');
+            li.innerHTML = '<i class="fas fa-ellipsis-h"></i><span>Load more</span>';
+            li.addEventListener('click', () => renderSavedChats(true));
             chatListUl.appendChild(li);
-        });
+        }
     }
-    
-    // Helper to update saved chats after marking as read.
-    function saveSavedChats() {
-        let savedChats = [];
+
+    // Fetches a saved chat with all of its messages, page by page.
+    async function fetchChat(chatId) {
+        let chat = null;
+        let start = 0;
+        const messages = [];
+        while (start !== null) {
+            chat = await libraryFetch(`/api/chats/${encodeURIComponent(chatId)}?start=${start}`);
+            chat.messages.forEach(msg => messages.push({ role: msg.role, text: msg.text }));
+            start = chat.next_start;
+        }
+        chat.messages = messages;
+        return chat;
+    }
+
+    async function loadChatSession(chatId) {
+        let chatSession;
         try {
-            savedChats = JSON.parse(localStorage.getItem('savedChats')) || [];
+            chatSession = await fetchChat(chatId);
         } catch (e) {
-            savedChats = [];
+            console.error("Failed to load saved chat", e);
+            return;
         }
-        localStorage.setItem('savedChats', JSON.stringify(savedChats));
+        chatHistory = chatSession.messages;
+        setCurrentChat(chatId);
+        conversationId = null;
+        renderChatHistory();
+        chatTitle.textContent = chatSession.name;
+        activeSession = false;
+        currentChatName = chatSession.name;
         renderSavedChats();
     }
-    
-    function loadChatSession(chatId) {
-        let savedChats = [];
+
+    async function deleteChatSession(chatId) {
         try {
-            savedChats = JSON.parse(localStorage.getItem('savedChats')) || [];
+            await libraryFetch(`/api/chats/${encodeURIComponent(chatId)}`, { method: 'DELETE' });
         } catch (e) {
-            savedChats = [];
-        }
-        const chatSession = savedChats.find(chat => chat.id === chatId);
-        if (chatSession) {
-            chatHistory = chatSession.history;
-            renderChatHistory();
-            chatTitle.textContent = chatSession.name;
-            activeSession = false;
-            currentChatName = chatSession.name;
+            console.error("Failed to delete saved chat", e);
         }
+        if (chatId === currentChat.id) setCurrentChat(null);
+        renderSavedChats();
     }
-    
-    function deleteChatSession(chatId) {
-        let savedChats = [];
+
+    // One-time move of chats kept in localStorage by older versions of this page.
+    async function migrateLocalChats() {
+        let savedChats = null;
+        let localHistory = null;
         try {
-            savedChats = JSON.parse(localStorage.getItem('savedChats')) || [];
+            savedChats = JSON.parse(localStorage.getItem('savedChats'));
+            localHistory = JSON.parse(localStorage.getItem('currentChatHistory'));
         } catch (e) {
-            savedChats = [];
+            console.warn("Unreadable local chats left in place", e);
+        }
+        if (Array.isArray(savedChats) && savedChats.length > 0) {
+            try {
+                const result = await libraryFetch('/api/chats/import', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/x-ndjson' },
+                    body: savedChats.map(chat => JSON.stringify(chat)).join('\n')
+                });
+                console.log("Moved saved chats to the chat library:", result);
+                localStorage.removeItem('savedChats');
+            } catch (e) {
+                console.error("Failed to move saved chats to the chat library; will retry on next load", e);
+            }
+        }
+        if (Array.isArray(localHistory)) {
+            const messages = localHistory
+                .filter(msg => msg && (msg.role === 'user' || msg.role === 'model') && typeof msg.text === 'string' && msg.text)
+                .map(msg => ({ role: msg.role, text: msg.text }));
+            try {
+                if (messages.length > 0 && !currentChat.id) {
+                    const chat = await libraryJSON('POST', '/api/chats', { messages: messages });
+                    setCurrentChat(chat.id);
+                }
+                localStorage.removeItem('currentChatHistory');
+            } catch (e) {
+                console.error("Failed to move the current chat to the chat library", e);
+            }
         }
-        savedChats = savedChats.filter(chat => chat.id !== chatId);
-        localStorage.setItem('savedChats', JSON.stringify(savedChats));
-        renderSavedChats();
     }
-    
-    function saveCurrentChatHistory() {
+
+    // Restores the chat that was open when the page was last closed.
+    async function loadCurrentChat() {
+        if (!currentChat.id) return;
+        const chatId = currentChat.id;
         try {
-            localStorage.setItem('currentChatHistory', JSON.stringify(chatHistory));
+            const chat = await fetchChat(chatId);
+            if (chatId !== currentChat.id) return;
+            chatHistory = chat.messages;
+            currentChatName = chat.name;
+            chatTitle.textContent = chat.name;
+            if (chat.name) activeSession = false;
         } catch (e) {
-            console.error("Failed to save chat history to localStorage", e);
+            console.warn("Could not restore the current chat; starting a new one", e);
+            setCurrentChat(null);
+            chatHistory = [];
         }
+        renderChatHistory();
     }
     
     function loadSettings() {
         const savedModel = localStorage.getItem('geminiModel');
         const savedInstruction = localStorage.getItem('geminiSystemInstruction');
-        const savedHistory = localStorage.getItem('currentChatHistory');
         if (modelSelect && modelSelect.options.length > 0) {
             modelSelect.value = savedModel || defaultConfig.defaultModel || modelSelect.options[0].value;
         } else if (modelSelect) {
             modelSelect.value = savedModel || defaultConfig.defaultModel;
         }
         systemInstructionTextarea.value = savedInstruction || defaultConfig.defaultSystemInstruction;
-        try {
-            chatHistory = JSON.parse(savedHistory || '[]');
-            if (!Array.isArray(chatHistory)) {
-                console.warn("Loaded chat history was not an array, resetting.");
-                chatHistory = [];
-            }
-        } catch (e) {
-            console.error("Failed to parse saved chat history, resetting.", e);
-            chatHistory = [];
-        }
+        chatHistory = [];
         renderChatHistory();
-        renderSavedChats();
         updateCurrentModelDisplay();
+        migrateLocalChats().then(loadCurrentChat).then(() => renderSavedChats());
     }
     
     function saveSettings() {
@@ -338,6 +464,14 @@ document.addEventListener('DOMContentLoaded', () => {
     });
     
     modelSelect.addEventListener('change', saveSettings);
+    let chatSearchTimer = null;
+    chatSearchInput.addEventListener('input', () => {
+        clearTimeout(chatSearchTimer);
+        chatSearchTimer = setTimeout(() => {
+            chatListQuery = chatSearchInput.value.trim();
+            renderSavedChats();
+        }, 250);
+    });
     systemInstructionTextarea.addEventListener('input', saveSettings);
     userInput.addEventListener('input', adjustTextareaHeight);
     
@@ -491,7 +625,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const lastHistMsg = chatHistory.length > 0 ? chatHistory[chatHistory.length - 1] : null;
             if (!lastHistMsg || !(lastHistMsg.role === (role.toLowerCase() === 'ai' ? 'model' : 'user') && lastHistMsg.text === text)) {
                 chatHistory.push({ role: role.toLowerCase() === 'ai' ? 'model' : 'user', text: text });
-                saveCurrentChatHistory();
+                persistMessage(chatHistory[chatHistory.length - 1].role, text);
             }
         }
         updateConversationModeVisibility();
@@ -530,7 +664,8 @@ document.addEventListener('DOMContentLoaded', () => {
             // Now abort any ongoing generation and clear the active session.
             if (controller) controller.abort();
             chatHistory = [];
-            saveCurrentChatHistory();
+            conversationId = null;
+            setCurrentChat(null);
             chatBox.innerHTML = '';
             chatBox.classList.add('fade-in');
             setTimeout(() => chatBox.classList.remove('fade-in'), 600);
@@ -574,10 +709,18 @@ document.addEventListener('DOMContentLoaded', () => {
         const historyForAPI = chatHistory.slice(0, -1);
         const requestData = {
             prompt: prompt,
-            history: historyForAPI,
             system_instruction: systemInstructionTextarea.value,
-            model: modelSelect.value
+            model: modelSelect.value,
+            conversation_id: conversationId,
+            // Ask the server to title the chat in the background while it answers.
+            title: activeSession && !currentChatName,
+            // Stream markdown blocks so only the last block is re-rendered per frame.
+            render: 'blocks'
         };
+        // With a live server session only the new prompt is sent.
+        if (!conversationId) {
+            requestData.history = historyForAPI;
+        }
         let accumulatedResponse = "";
         let currentStreamedHTML = "";
         let streamingMessageContainer = currentAIMessageContainer;
@@ -585,26 +728,97 @@ document.addEventListener('DOMContentLoaded', () => {
         // Ensure the active chat has a model entry for updating (even if empty).
         if (!chatHistory.length || chatHistory[chatHistory.length - 1].role !== 'model') {
             chatHistory.push({ role: 'model', text: "" });
-            saveCurrentChatHistory();
         }
-        try {
-            const response = await fetch('/chat', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
-                body: JSON.stringify(requestData),
-                signal: signal
-            });
-            if (!response.ok) {
-                let errorText = `Error: ${response.status} - ${response.statusText}`;
-                try {
-                    const errorJson = await response.json();
-                    errorText = `Error: ${response.status} - ${errorJson.error || response.statusText}`;
-                } catch (e) {}
-                throw new Error(errorText);
+        // The answer is stored once, in the chat the prompt was sent from, when it ends or is cancelled.
+        const answerChat = currentChat;
+        let answerSaved = false;
+        let titleStreamed = false;
+        let streamId = null;
+        // Quoted in error reports so the server's trace of this request can be found.
+        let requestId = null;
+        let lastEventId = 0;
+        let resumeAttempts = 0;
+        // Block mode state: one element and source per markdown block; only the open block is re-rendered.
+        let blockMode = false;
+        let blockElements = [];
+        let blockSources = [];
+        let finalizedBlocks = [];
+        let dirtyBlock = -1;
+        function blockElement(index) {
+            if (!blockElements[index]) {
+                if (!blockElements.length && streamingContentElement) {
+                    streamingContentElement.innerHTML = ''; // Replaces the typing indicator.
+                }
+                const element = document.createElement('div');
+                element.className = 'md-block';
+                blockElements[index] = element;
+                if (streamingContentElement) streamingContentElement.appendChild(element);
             }
+            return blockElements[index];
+        }
+        function finalizeBlock(index, html) {
+            const element = blockElement(index);
+            element.innerHTML = (typeof html === 'string') ? html : renderBlock(blockSources[index] || '');
+            finalizedBlocks[index] = true;
+            if (dirtyBlock === index) dirtyBlock = -1;
+            enhanceCodeBlocksInElement(element);
+            if (typeof Prism !== 'undefined' && typeof Prism.highlightAllUnder === 'function') {
+                Prism.highlightAllUnder(element);
+            }
+            if (chatHistory.length > 0 && chatHistory[chatHistory.length - 1].role === 'model') {
+                chatHistory[chatHistory.length - 1].text = accumulatedResponse;
+            }
+            scrollToBottom();
+        }
+        // Error and block markers arrive as plain text frames and get a block of their own.
+        function appendTextBlock(text) {
+            accumulatedResponse += text;
+            const index = blockElements.length;
+            blockSources[index] = text;
+            blockElement(index).innerHTML = renderMarkdown(text);
+            finalizedBlocks[index] = true;
+        }
+        // Applies one parsed SSE frame; plain data frames carry answer text.
+        function handleStreamEvent(eventName, payload) {
+            if (eventName === 'conversation') {
+                conversationId = payload.conversation_id || null;
+            } else if (eventName === 'model') {
+                // "auto" mode: show which model the server picked for this answer.
+                const option = Array.from(modelSelect.options).find(opt => opt.value === payload.model);
+                currentModelDisplay.textContent = "Model: Auto \u2192 " + (option ? option.text : payload.model);
+            } else if (eventName === 'request') {
+                requestId = payload.request_id || requestId;
+            } else if (eventName === 'title') {
+                if (payload.title && !currentChatName) {
+                    currentChatName = payload.title.trim();
+                    titleStreamed = true;
+                    typeOut(chatTitle, currentChatName, 100);
+                }
+            } else if (eventName === 'block') {
+                accumulatedResponse += payload.text;
+                blockSources[payload.index] = (blockSources[payload.index] || '') + payload.text;
+                dirtyBlock = payload.index;
+            } else if (eventName === 'block_final') {
+                finalizeBlock(payload.index, payload.html);
+            } else if (eventName === 'error') {
+                if (blockMode) {
+                    appendTextBlock(`[${payload.error || 'Stream Error'}]`);
+                } else {
+                    accumulatedResponse += `[${payload.error || 'Stream Error'}]`;
+                }
+            } else if (typeof payload === 'string' && blockMode) {
+                appendTextBlock(payload);
+            } else if (typeof payload === 'string') {
+                accumulatedResponse += payload;
+            }
+        }
+        // Reads one SSE response into the message until the server ends it.
+        async function readStream(response) {
             if (!response.body) throw new Error("Response body is missing.");
             const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
             let buffer = "";
+            let currentEvent = "message";
+            let pendingEventId = null;
             while (true) {
                 const { done, value } = await reader.read();
                 console.log("Chunk received:", value);
@@ -620,20 +834,36 @@ document.addEventListener('DOMContentLoaded', () => {
                 const lines = buffer.split('\n');
                 buffer = lines.pop();
                 lines.forEach(line => {
-                    if (line.startsWith('data: ')) {
+                    if (line === '') {
+                        currentEvent = "message"; // Blank line ends an SSE frame.
+                    } else if (line.startsWith('id: ')) {
+                        pendingEventId = parseInt(line.substring(4), 10);
+                    } else if (line.startsWith('event: ')) {
+                        currentEvent = line.substring(7).trim();
+                    } else if (line.startsWith('data: ')) {
                         const jsonData = line.substring(6).trim();
                         if (jsonData) {
                             try {
                                 const chunk = JSON.parse(jsonData);
-                                accumulatedResponse += chunk;
+                                handleStreamEvent(currentEvent, chunk);
                             } catch (e) {
                                 console.error("Failed to parse JSON chunk:", jsonData, e);
                                 accumulatedResponse += jsonData;
                             }
                         }
+                        // The frame is applied, so a resume should start after it.
+                        if (Number.isInteger(pendingEventId)) lastEventId = pendingEventId;
                     }
                 });
                 console.log("Accumulated length so far:", accumulatedResponse.length);
+                if (blockMode) {
+                    if (dirtyBlock >= 0) {
+                        blockElement(dirtyBlock).innerHTML = renderBlock(blockSources[dirtyBlock]);
+                        dirtyBlock = -1;
+                        scrollToBottom();
+                    }
+                    continue;
+                }
                 currentStreamedHTML = renderMarkdown(accumulatedResponse);
                 if (streamingContentElement) {
                     streamingContentElement.innerHTML = currentStreamedHTML;
@@ -642,10 +872,69 @@ document.addEventListener('DOMContentLoaded', () => {
                 // Update the model message in chatHistory
                 if (chatHistory.length > 0 && chatHistory[chatHistory.length - 1].role === 'model') {
                     chatHistory[chatHistory.length - 1].text = accumulatedResponse;
-                    saveCurrentChatHistory();
                 }
             }
-            if (accumulatedResponse && streamingMessageContainer && streamingContentElement) {
+        }
+        // Reconnects to the still-running generation; rethrows the original error when it is gone.
+        async function resumeStream(cause) {
+            while (resumeAttempts < MAX_RESUME_ATTEMPTS) {
+                resumeAttempts += 1;
+                await new Promise(resolve => setTimeout(resolve, RESUME_BACKOFF_MS * resumeAttempts));
+                try {
+                    const response = await fetch(`/chat/stream/${encodeURIComponent(streamId)}`, {
+                        headers: { 'Accept': 'text/event-stream', 'Last-Event-ID': String(lastEventId) },
+                        signal: signal
+                    });
+                    if (response.ok) return response;
+                    if (response.status === 404 || response.status === 410) break;
+                } catch (e) {
+                    if (e.name === 'AbortError') throw e;
+                }
+            }
+            throw cause;
+        }
+        try {
+            const postChat = () => fetch('/chat', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+                body: JSON.stringify(requestData),
+                signal: signal
+            });
+            let response = await postChat();
+            if (response.status === 404 && conversationId) {
+                // The server session expired; start a new one from the full local history.
+                conversationId = null;
+                requestData.conversation_id = null;
+                requestData.history = historyForAPI;
+                response = await postChat();
+            }
+            if (!response.ok) {
+                let errorText = `Error: ${response.status} - ${response.statusText}`;
+                try {
+                    const errorJson = await response.json();
+                    errorText = `Error: ${response.status} - ${errorJson.error || response.statusText}`;
+                } catch (e) {}
+                throw new Error(errorText);
+            }
+            streamId = response.headers.get('X-Stream-Id');
+            requestId = response.headers.get('X-Request-Id') || requestId;
+            blockMode = response.headers.get('X-Render-Mode') === 'blocks';
+            while (true) {
+                try {
+                    await readStream(response);
+                    break;
+                } catch (error) {
+                    if (error.name === 'AbortError' || !streamId) throw error;
+                    console.warn("Stream interrupted, resuming after event", lastEventId, error);
+                    response = await resumeStream(error);
+                }
+            }
+            if (blockMode) {
+                // Blocks left open by an error or early end are rendered here.
+                blockSources.forEach((source, index) => {
+                    if (!finalizedBlocks[index]) finalizeBlock(index, null);
+                });
+            } else if (accumulatedResponse && streamingMessageContainer && streamingContentElement) {
                 streamingContentElement.innerHTML = renderMarkdown(accumulatedResponse);
                 enhanceCodeBlocksInElement(streamingContentElement);
                 if (typeof Prism !== 'undefined' && typeof Prism.highlightAllUnder === 'function') {
@@ -657,15 +946,16 @@ document.addEventListener('DOMContentLoaded', () => {
                 const lastMsg = chatHistory.length > 0 ? chatHistory[chatHistory.length - 1] : null;
                 if (!lastMsg || !(lastMsg.role === 'model' && lastMsg.text === accumulatedResponse)) {
                     chatHistory.push({ role: 'model', text: accumulatedResponse });
-                    saveCurrentChatHistory();
                 }
+                persistMessage('model', accumulatedResponse, answerChat);
+                answerSaved = true;
             }
             // Chat titler: if active, generate title once.
             if (activeSession && chatHistory.some(msg => msg.role === 'model')) {
                 if (!currentChatName) {
                     currentChatName = await getChatName(chatHistory);
                     typeOut(chatTitle, currentChatName, 100);
-                } else {
+                } else if (!titleStreamed) {
                     chatTitle.textContent = currentChatName;
                 }
                 await saveChatSession();
@@ -674,17 +964,24 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (error) {
             if (error.name === 'AbortError') {
                 console.log('Fetch aborted.');
+                // The server would otherwise keep generating through its reconnect grace window.
+                if (streamId) {
+                    fetch(`/chat/stream/${encodeURIComponent(streamId)}`, { method: 'DELETE', keepalive: true }).catch(() => {});
+                }
                 if (currentAIMessageContainer && currentAIMessageContainer.id === 'typing-indicator') {
                     currentAIMessageContainer.id = "";
                 }
             } else {
-                console.error("Error sending/receiving message:", error);
+                console.error("Error sending/receiving message:", error, requestId ? `(request ${requestId})` : '');
                 if (currentAIMessageContainer && currentAIMessageContainer.id === 'typing-indicator') {
                     currentAIMessageContainer.id = "";
                 }
                 appendMessage('error', `${error.message || 'An unknown error occurred.'}`, false);
             }
         } finally {
+            if (accumulatedResponse && !answerSaved) {
+                persistMessage('model', accumulatedResponse, answerChat); // Keep what was shown before the cancel.
+            }
             streamingMessageContainer = null;
             streamingContentElement = null;
             if (currentAIMessageContainer && currentAIMessageContainer.id === 'typing-indicator') {
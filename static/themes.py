@@ -1,10 +1,15 @@
 import os
 
+# Theme definitions: CSS custom properties per theme.
+# The asset build (assets.py) bundles every theme into one stylesheet scoped by
+# [data-theme="<name>"]. Running this file still writes the standalone per-theme files under
+# static/themes/ for pages that link a single theme.
+
 # Get the directory of this file (inside static)
 current_dir = os.path.dirname(os.path.abspath(__file__))
-# Create a "themes" folder inside the static folder
+# The standalone files go to the "themes" folder inside the static folder
 output_dir = os.path.join(current_dir, "themes")
-os.makedirs(output_dir, exist_ok=True)
+DEFAULT_THEME = "dark"
 
 # Define multiple themes (original plus extra 15 themes)
 themes = {
@@ -370,11 +375,19 @@ themes = {
     }
 }
 
-for theme_name, variables in themes.items():
-    file_path = os.path.join(output_dir, f"{theme_name}.css")
-    with open(file_path, "w") as f:
-        f.write(":root {\n")
-        for var, value in variables.items():
-            f.write(f"    --{var}: {value};\n")
-        f.write("}\n")
-    print(f"Generated {file_path}")
+
+
+def write_theme_files():
+    os.makedirs(output_dir, exist_ok=True)
+    for theme_name, variables in themes.items():
+        file_path = os.path.join(output_dir, f"{theme_name}.css")
+        with open(file_path, "w") as f:
+            f.write(":root {\n")
+            for var, value in variables.items():
+                f.write(f"    --{var}: {value};\n")
+            f.write("}\n")
+        print(f"Generated {file_path}")
+
+
+if __name__ == "__main__":
+    write_theme_files()
@@ -0,0 +1,486 @@
+import os
+import sys
+import time
+import asyncio
+import secrets
+import logging
+import threading
+from itertools import islice
+from collections import deque, OrderedDict
+import metrics
+from disconnect import DISCONNECT_CHECK_INTERVAL_MS
+from shared_state import shared_state
+
+# Resumable /chat streams.
+# A dropped connection (a phone switching networks, a laptop waking from sleep) used to lose the
+# whole answer, and the retry paid for a second generation. Each /chat stream now runs in a
+# background producer that writes its SSE frames into a bounded ring buffer, and the HTTP
+# response is one subscriber reading from it. Frames carry SSE ids, so a client that reconnects
+# with the stream id and its Last-Event-ID continues from the next frame while the original
+# upstream call keeps generating. A stream nobody reads for RESUME_GRACE_SECONDS is cancelled,
+# and finished streams stay resumable for RESUME_RETENTION_SECONDS.
+# When the last reader leaves because its client disconnected (the socket probe, the ASGI
+# disconnect watcher, or the server closing the response mid-stream), the window shrinks to
+# RESUME_DISCONNECT_GRACE_SECONDS: long enough for a client that retries right away to resume,
+# short enough that an abandoned answer stops spending tokens. 0 cancels on disconnect.
+#
+# Buffers live in the worker process that runs the producer. Under several workers resume is off
+# unless SSE_RESUME=1 is set explicitly (see gunicorn.conf.py); then each stream's owner pid is
+# recorded in shared_state: a DELETE that lands on another worker leaves a cancel flag that the
+# owner polls every RESUME_CANCEL_POLL_SECONDS, and a resume that lands there is answered 409
+# stream_on_other_worker, since only the owner holds the frames. Resuming across workers needs sticky routing by X-Stream-Id at the load balancer.
+
+SSE_RESUME = os.getenv("SSE_RESUME", "1") != "0"
+RESUME_BUFFER_EVENTS = int(os.getenv("RESUME_BUFFER_EVENTS", "1024"))
+RESUME_GRACE_SECONDS = float(os.getenv("RESUME_GRACE_SECONDS", "15"))
+RESUME_DISCONNECT_GRACE_SECONDS = float(os.getenv("RESUME_DISCONNECT_GRACE_SECONDS", "3"))
+RESUME_RETENTION_SECONDS = float(os.getenv("RESUME_RETENTION_SECONDS", "120"))
+RESUME_MAX_STREAMS = int(os.getenv("RESUME_MAX_STREAMS", "512"))
+RESUME_CANCEL_POLL_SECONDS = float(os.getenv("RESUME_CANCEL_POLL_SECONDS", "0.5"))
+# Lifetime of an ownership record: longer than any stream runs, plus RESUME_RETENTION_SECONDS.
+_OWNER_TTL_SECONDS = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class ResumeError(LookupError):
+    """Raised when a stream cannot be resumed; carries the HTTP status to return."""
+
+    def __init__(self, message, status_code, code):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+    def to_dict(self):
+        return {"error": str(self), "code": self.code}
+
+
+def parse_last_event_id(value):
+    """
+    Parses a Last-Event-ID value.
+
+    Returns:
+        int: The id (0 when the value is missing, meaning "from the start").
+
+    Raises:
+        ResumeError: If the value is not a non-negative integer.
+    """
+    if value is None or value == "":
+        return 0
+    try:
+        event_id = int(value)
+    except (TypeError, ValueError):
+        event_id = -1
+    if event_id < 0:
+        raise ResumeError("Last-Event-ID must be a non-negative integer", 400, "invalid_last_event_id")
+    return event_id
+
+
+def format_event(event_id: int, frame: str):
+    """Prefixes an SSE frame with its id field."""
+    return f"id: {event_id}\n{frame}"
+
+
+def _shortest(*timeouts):
+    """The shortest of some wait timeouts, where None means no limit."""
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class StreamBuffer:
+    """
+    The SSE frames of one /chat stream, numbered from 1, with the newest max_events kept.
+
+    Sync subscribers wait on a condition variable; async subscribers park a future that the
+    producer resolves through its loop, so one buffer can feed both serving modes.
+
+    Args:
+        stream_id (str): Unguessable id handed to the client in X-Stream-Id.
+        max_events (int): Ring buffer size; older frames can no longer be resumed from.
+        grace_seconds (float): How long the stream may run without subscribers.
+        cancel (callable): Called with a reason to stop the producer.
+        disconnect_grace_seconds (float): The shorter window once the last subscriber's client
+            disconnected.
+
+    A sync producer may set flusher to a callable that sends any text whose coalescing deadline
+    has passed and returns the seconds until it should be called again (None for never); sync
+    subscribers call it while they wait, since the producer itself is blocked on the upstream.
+    """
+
+    def __init__(self, stream_id: str, max_events: int = RESUME_BUFFER_EVENTS,
+                 grace_seconds: float = RESUME_GRACE_SECONDS, cancel=None,
+                 disconnect_grace_seconds: float = RESUME_DISCONNECT_GRACE_SECONDS):
+        self.stream_id = stream_id
+        self.grace_seconds = max(0.0, grace_seconds)
+        self.disconnect_grace_seconds = min(self.grace_seconds, max(0.0, disconnect_grace_seconds))
+        self._cancel = cancel
+        self._events = deque(maxlen=max(1, max_events))  # (event_id, frame)
+        self.last_event_id = 0
+        self.done = False
+        self.abandoned = False
+        self.cancel_reason = None
+        self.finished_at = None
+        self.subscribers = 0
+        self.holders = 1  # requests sharing the stream (see single_flight)
+        self._cond = threading.Condition()
+        self._waiters = []  # futures of parked async subscribers
+        self._idle_timer = None
+        self.flusher = None
+
+    def append(self, frame: str):
+        """Adds the producer's next frame and wakes the subscribers; returns its event id."""
+        with self._cond:
+            self.last_event_id += 1
+            self._events.append((self.last_event_id, frame))
+            self._wake_locked()
+            return self.last_event_id
+
+    def close(self):
+        """Marks the stream as finished; subscribers drain what is left and end."""
+        with self._cond:
+            self.done = True
+            self.flusher = None
+            self.finished_at = time.monotonic()
+            self._stop_idle_timer_locked()
+            self._wake_locked()
+
+    def cancel(self, reason: str):
+        """Stops the producer (the buffered frames stay readable)."""
+        with self._cond:
+            if self.done or self.cancel_reason is not None:
+                return
+            self.cancel_reason = reason
+        if self._cancel is not None:
+            self._cancel(reason)
+
+    def hold(self):
+        """Registers one more request sharing this stream."""
+        with self._cond:
+            self.holders += 1
+
+    def release(self, reason: str = "client_cancelled"):
+        """
+        Withdraws one request's interest; the producer is cancelled when none is left.
+
+        Returns:
+            bool: True if this cancelled the stream.
+        """
+        with self._cond:
+            self.holders = max(0, self.holders - 1)
+            if self.holders:
+                return False
+        self.cancel(reason)
+        return True
+
+    def _wake_locked(self):
+        self._cond.notify_all()
+        waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            loop = future.get_loop()
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_resolve, future)
+
+    def events_after(self, last_event_id: int):
+        """
+        Returns the buffered (event_id, frame) pairs after last_event_id.
+
+        Raises:
+            ResumeError: If frames after last_event_id were already dropped from the ring.
+        """
+        with self._cond:
+            return self._events_after_locked(last_event_id)
+
+    def _events_after_locked(self, last_event_id):
+        if last_event_id >= self.last_event_id:
+            return []
+        first_id = self._events[0][0]
+        if last_event_id + 1 < first_id:
+            raise ResumeError("The stream has moved past Last-Event-ID; resend the request", 410, "resume_gap")
+        return list(islice(self._events, last_event_id + 1 - first_id, None))
+
+    # --- Subscribers and the grace window ---
+
+    def attach(self):
+        with self._cond:
+            self.subscribers += 1
+            self._stop_idle_timer_locked()
+
+    def detach(self, disconnected: bool = False):
+        with self._cond:
+            self.subscribers -= 1
+            idle = self.subscribers == 0
+        if idle:
+            self.start_grace(self.disconnect_grace_seconds if disconnected else self.grace_seconds)
+
+    def start_grace(self, seconds: float = None):
+        """Cancels the stream unless a subscriber (re)attaches within seconds (default grace_seconds)."""
+        seconds = self.grace_seconds if seconds is None else seconds
+        with self._cond:
+            # Generators closed during interpreter shutdown land here too; no new threads then.
+            if self.done or self.subscribers or self._idle_timer is not None or sys.is_finalizing():
+                return
+            timer = threading.Timer(seconds, self._expire, (seconds,))
+            timer.daemon = True
+            self._idle_timer = timer
+        timer.start()
+
+    def _stop_idle_timer_locked(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _expire(self, seconds):
+        with self._cond:
+            if self.done or self.subscribers or self._idle_timer is None:
+                return
+            self._idle_timer = None
+            self.abandoned = True
+        logger.info("Stream abandoned after grace window", extra={"stream_id": self.stream_id,
+                                                                  "grace_seconds": seconds})
+        self.cancel("client_disconnected")
+
+    def iter_frames(self, last_event_id: int = 0, disconnected=None):
+        """
+        Yields the SSE frames after last_event_id, then the live tail, until the stream ends.
+
+        Args:
+            last_event_id (int): Id of the last frame the client has.
+            disconnected (callable, optional): Polled while waiting; ends this subscriber (not
+                the stream) once it returns True.
+        """
+        poll = DISCONNECT_CHECK_INTERVAL_MS / 1000.0 if disconnected else None
+        gone = False
+        self.attach()
+        try:
+            cursor = last_event_id
+            while True:
+                # Called outside the condition: the flusher appends to this buffer.
+                flusher = self.flusher
+                due = flusher() if flusher is not None else None
+                with self._cond:
+                    events = self._events_after_locked(cursor)
+                    if not events:
+                        if self.done:
+                            return
+                        self._cond.wait(_shortest(poll, due))
+                for event_id, frame in events:
+                    yield format_event(event_id, frame)
+                    cursor = event_id
+                if disconnected and disconnected():
+                    gone = True
+                    return
+        except ResumeError:
+            # A stalled reader fell a whole ring behind; it gets a 410 when it reconnects.
+            logger.warning("Subscriber fell behind the stream buffer", extra={"stream_id": self.stream_id})
+        except GeneratorExit:
+            # The server closed the response before the stream ended: its client went away.
+            gone = True
+            raise
+        finally:
+            self.detach(gone)
+
+    async def aiter_frames(self, last_event_id: int = 0, cancellation=None):
+        """Async counterpart of iter_frames; ends this subscriber once cancellation fires."""
+        loop = asyncio.get_running_loop()
+        cancelled = asyncio.ensure_future(cancellation.wait()) if cancellation is not None else None
+        gone = False
+        self.attach()
+        try:
+            cursor = last_event_id
+            while True:
+                with self._cond:
+                    events = self._events_after_locked(cursor)
+                    if not events:
+                        if self.done:
+                            return
+                        waiter = loop.create_future()
+                        self._waiters.append(waiter)
+                if events:
+                    for event_id, frame in events:
+                        yield format_event(event_id, frame)
+                        cursor = event_id
+                    continue
+                await asyncio.wait({waiter, cancelled} - {None}, return_when=asyncio.FIRST_COMPLETED)
+                if cancellation is not None and cancellation.cancelled:
+                    gone = True
+                    return
+        except ResumeError:
+            logger.warning("Subscriber fell behind the stream buffer", extra={"stream_id": self.stream_id})
+        except (GeneratorExit, asyncio.CancelledError):
+            gone = True
+            raise
+        finally:
+            if cancelled is not None:
+                cancelled.cancel()
+            self.detach(gone)
+
+    def to_dict(self):
+        with self._cond:
+            return {"stream_id": self.stream_id, "last_event_id": self.last_event_id, "done": self.done,
+                    "subscribers": self.subscribers, "holders": self.holders}
+
+
+class StreamRegistry:
+    """
+    Thread-safe map of stream id -> StreamBuffer.
+
+    Finished streams expire after retention_seconds, and the oldest finished ones are evicted
+    past max_streams. Running streams are never evicted; admission control bounds them.
+    """
+
+    def __init__(self, max_streams: int = RESUME_MAX_STREAMS, retention_seconds: float = RESUME_RETENTION_SECONDS,
+                 max_events: int = RESUME_BUFFER_EVENTS, grace_seconds: float = RESUME_GRACE_SECONDS,
+                 disconnect_grace_seconds: float = RESUME_DISCONNECT_GRACE_SECONDS):
+        self.max_streams = max_streams
+        self.retention_seconds = retention_seconds
+        self.max_events = max_events
+        self.grace_seconds = grace_seconds
+        self.disconnect_grace_seconds = disconnect_grace_seconds
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+        self._cancel_watcher = None
+        self.created = 0
+        self.resumed = 0
+        self.remote_cancels = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The cancel watcher thread does not survive fork(); a worker starts its own on first use.
+        self._lock = threading.Lock()
+        self._cancel_watcher = None
+
+    def create(self, cancel=None):
+        """
+        Registers a new stream buffer.
+
+        The grace window starts right away, so a response that is never read still gets its
+        producer cancelled.
+        """
+        buffer = StreamBuffer(secrets.token_urlsafe(16), self.max_events, self.grace_seconds, cancel,
+                              self.disconnect_grace_seconds)
+        with self._lock:
+            self._purge_locked(time.monotonic())
+            self._streams[buffer.stream_id] = buffer
+            self.created += 1
+            metrics.BUFFERED_STREAMS.set(len(self._streams))
+            start_watcher = shared_state.enabled and self._cancel_watcher is None
+            if start_watcher:
+                self._cancel_watcher = threading.Thread(target=self._watch_remote_cancels,
+                                                        name="stream-cancel-watcher", daemon=True)
+        if shared_state.enabled:
+            shared_state.put("stream", buffer.stream_id, {"pid": os.getpid()},
+                             _OWNER_TTL_SECONDS + self.retention_seconds)
+        if start_watcher:
+            self._cancel_watcher.start()
+        buffer.start_grace()
+        return buffer
+
+    def get(self, stream_id: str):
+        """Returns the buffer for a stream id, or None if it is unknown or expired."""
+        with self._lock:
+            self._purge_locked(time.monotonic())
+            return self._streams.get(stream_id)
+
+    def resume(self, stream_id: str, last_event_id):
+        """
+        Looks up a stream for a reconnect.
+
+        Args:
+            stream_id (str): The X-Stream-Id of the original response.
+            last_event_id: Raw Last-Event-ID header or query value.
+
+        Returns:
+            tuple: (StreamBuffer, last event id as int).
+
+        Raises:
+            ResumeError: If the id is malformed, the stream is unknown or expired, runs in
+                another worker process, or the frames after last_event_id are no longer buffered.
+        """
+        try:
+            event_id = parse_last_event_id(last_event_id)
+            buffer = self.get(stream_id)
+            if buffer is None:
+                if self._remote_owner(stream_id) is not None:
+                    raise ResumeError("The stream runs in another worker; resumes need sticky routing",
+                                      409, "stream_on_other_worker")
+                raise ResumeError("Unknown or expired stream", 404, "stream_not_found")
+            buffer.events_after(event_id)
+        except ResumeError as e:
+            metrics.STREAM_RESUMES.labels(e.code).inc()
+            raise
+        with self._lock:
+            self.resumed += 1
+        metrics.STREAM_RESUMES.labels("resumed").inc()
+        logger.info("Stream resumed", extra={"stream_id": stream_id, "last_event_id": event_id,
+                                             "buffered_last_event_id": buffer.last_event_id, "done": buffer.done})
+        return buffer, event_id
+
+    def cancel(self, stream_id: str):
+        """
+        Cancels a stream for its client, in whichever worker process runs it.
+
+        A stream shared by identical requests keeps running until all of them have cancelled.
+
+        Returns:
+            bool: True if the stream was released here, False if its owner was asked to.
+
+        Raises:
+            ResumeError: If no worker knows the stream (404).
+        """
+        buffer = self.get(stream_id)
+        if buffer is not None:
+            buffer.release("client_cancelled")
+            return True
+        if self._remote_owner(stream_id) is None:
+            raise ResumeError("Unknown or expired stream", 404, "stream_not_found")
+        shared_state.put("stream_cancel", stream_id, True, self.retention_seconds)
+        logger.info("Stream cancel forwarded to its worker", extra={"stream_id": stream_id})
+        return False
+
+    def _remote_owner(self, stream_id: str):
+        """The pid of the other worker process running a stream, or None."""
+        owner = shared_state.get("stream", stream_id)
+        pid = owner.get("pid") if isinstance(owner, dict) else None
+        return pid if pid is not None and pid != os.getpid() else None
+
+    def _watch_remote_cancels(self):
+        """Applies cancel flags left by DELETEs that landed on other workers."""
+        while True:
+            time.sleep(RESUME_CANCEL_POLL_SECONDS)
+            if not shared_state.enabled:
+                continue
+            with self._lock:
+                running = [buffer for buffer in self._streams.values() if not buffer.done]
+            for buffer in running:
+                if shared_state.get("stream_cancel", buffer.stream_id):
+                    shared_state.delete("stream_cancel", buffer.stream_id)
+                    with self._lock:
+                        self.remote_cancels += 1
+                    buffer.release("client_cancelled")
+
+    def _purge_locked(self, now):
+        expired = [stream_id for stream_id, buffer in self._streams.items()
+                   if buffer.done and now - buffer.finished_at > self.retention_seconds]
+        for stream_id in expired:
+            del self._streams[stream_id]
+        if len(self._streams) > self.max_streams:
+            for stream_id in [stream_id for stream_id, buffer in self._streams.items() if buffer.done]:
+                del self._streams[stream_id]
+                if len(self._streams) <= self.max_streams:
+                    break
+        metrics.BUFFERED_STREAMS.set(len(self._streams))
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for buffer in self._streams.values() if not buffer.done)
+            return {"buffered": len(self._streams), "running": running, "created": self.created,
+                    "resumed": self.resumed, "remote_cancels": self.remote_cancels}
+
+
+stream_registry = StreamRegistry()
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import pytest
+
+# The suite runs against the stub backend, so no Vertex credentials or network are needed.
+# Settings are read by the app modules at import, so they are set before anything imports app.
+_data_dir = tempfile.mkdtemp(prefix="chat-tests-")
+for name, value in {
+    "CHAT_BACKEND": "stub",
+    "MODEL_WARMUP": "0",
+    "ASSETS_AUTO_BUILD": "0",
+    "LOG_LEVEL": "WARNING",
+    "SHARED_STATE": "0",
+    "TRACING": "0",
+    # The suite sends every request from one address; tests that need a rate limit set their own.
+    "ADMISSION_CLIENT_RATE": "0",
+    "CHAT_STORE_PATH": os.path.join(_data_dir, "chats.sqlite3"),
+    "SHARED_STATE_PATH": os.path.join(_data_dir, "shared_state.sqlite3"),
+    "TRACE_FILE": os.path.join(_data_dir, "traces.jsonl"),
+    "STUB_FIRST_TOKEN_DELAY_MS": "0",
+    "STUB_TOKENS_PER_SECOND": "100000",
+    "STUB_RESPONSE_TOKENS": "60",
+    "STUB_PREFILL_MS_PER_1K_TOKENS": "0",
+    "CHAT_TITLE_STREAM_WAIT_SECONDS": "0",
+}.items():
+    os.environ[name] = value
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def stub(app_module):
+    """The stub backend; tests may slow it down, and its timing is restored afterwards."""
+    backend = app_module.get_backend()
+    saved = dict(vars(backend))
+    yield backend
+    for name in ("tokens_per_second", "chunk_tokens", "first_token_delay", "response_tokens"):
+        setattr(backend, name, saved[name])
+
+
+def parse_sse(body):
+    """Splits an SSE body into (id, event, data) tuples, with data JSON-decoded."""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    frames = []
+    for block in body.split("\n\n"):
+        if not block.strip():
+            continue
+        event_id, event, data = None, "message", None
+        for line in block.split("\n"):
+            field, _, value = line.partition(": ")
+            if field == "id":
+                event_id = int(value)
+            elif field == "event":
+                event = value
+            elif field == "data":
+                data = json.loads(value)
+        frames.append((event_id, event, data))
+    return frames
+
+
+def wait_for(predicate, timeout=5.0):
+    """Polls predicate until it is true; returns its last value."""
+    deadline = time.monotonic() + timeout
+    while True:
+        value = predicate()
+        if value or time.monotonic() > deadline:
+            return value
+        time.sleep(0.01)
@@ -0,0 +1,97 @@
+import ipaddress
+import pytest
+from conftest import parse_sse, wait_for
+
+
+@pytest.fixture
+def admission(app_module, monkeypatch):
+    controller = app_module.admission
+    # Streams from earlier tests release their tickets when their producers finish.
+    assert wait_for(lambda: controller.stats()["in_flight"] == 0)
+    monkeypatch.setattr(controller, "_buckets", type(controller._buckets)())
+    return controller
+
+
+def post_chat(client, prompt, remote_addr="8.8.4.4"):
+    return client.post("/chat", json={"prompt": prompt, "history": [], "cache": False},
+                       environ_base={"REMOTE_ADDR": remote_addr})
+
+
+def test_client_over_its_rate_gets_429_with_retry_after(client, admission, monkeypatch):
+    monkeypatch.setattr(admission, "client_rate", 0.01)
+    monkeypatch.setattr(admission, "client_burst", 2)
+    for i in range(2):
+        response = post_chat(client, f"Rate limited request {i}")
+        assert response.status_code == 200
+        parse_sse(response.data)
+
+    rejected = post_chat(client, "Rate limited request 2")
+    assert rejected.status_code == 429
+    assert rejected.get_json()["code"] == "client_rate_limited"
+    assert int(rejected.headers["Retry-After"]) >= 1
+
+    # Other clients keep their own budget.
+    other = post_chat(client, "Another client", remote_addr="1.1.1.1")
+    assert other.status_code == 200
+    parse_sse(other.data)
+
+
+def test_full_queue_gets_429(client, admission, monkeypatch, app_module):
+    monkeypatch.setattr(admission, "max_concurrent", 1)
+    monkeypatch.setattr(admission, "queue_max", 0)
+    ticket = admission.acquire("someone-else", app_module.DEFAULT_MODEL, consume=False)
+    try:
+        rejected = post_chat(client, "Queued behind a full house")
+        assert rejected.status_code == 429
+        assert rejected.get_json()["code"] == "queue_full"
+        assert "Retry-After" in rejected.headers
+    finally:
+        ticket.release()
+    response = post_chat(client, "Room again")
+    assert response.status_code == 200
+    parse_sse(response.data)
+
+
+def test_untrusted_peer_is_limited_whatever_it_forwards(client, admission, monkeypatch):
+    monkeypatch.setattr(admission, "client_rate", 0.01)
+    monkeypatch.setattr(admission, "client_burst", 1)
+    statuses = []
+    for i in range(2):
+        response = client.post("/chat", json={"prompt": f"Spoofed {i}", "history": [], "cache": False},
+                               headers={"X-Forwarded-For": f"9.9.9.{i}"}, environ_base={"REMOTE_ADDR": "10.0.0.5"})
+        statuses.append(response.status_code)
+        if response.status_code == 200:
+            parse_sse(response.data)
+    assert statuses == [200, 429]
+
+
+def test_trusted_proxy_gives_each_forwarded_client_a_bucket(client, admission, monkeypatch):
+    import admission as admission_module
+    monkeypatch.setattr(admission_module, "_trusted_proxies", [ipaddress.ip_network("10.0.0.0/8")])
+    monkeypatch.setattr(admission, "client_rate", 0.01)
+    monkeypatch.setattr(admission, "client_burst", 1)
+
+    def through_proxy(prompt, forwarded_for):
+        response = client.post("/chat", json={"prompt": prompt, "history": [], "cache": False},
+                               headers={"X-Forwarded-For": forwarded_for}, environ_base={"REMOTE_ADDR": "10.0.0.5"})
+        if response.status_code == 200:
+            parse_sse(response.data)
+        return response.status_code
+
+    assert through_proxy("First user", "9.9.9.9") == 200
+    assert through_proxy("Second user", "1.1.1.1") == 200
+    assert through_proxy("First user again", "9.9.9.9") == 429
+
+
+def test_client_id_from():
+    from admission import client_id_from
+    proxies = [ipaddress.ip_network("10.0.0.0/8"), ipaddress.ip_network("127.0.0.1")]
+    headers = {"X-Forwarded-For": "1.2.3.4, 9.9.9.9, 10.0.0.7"}
+    assert client_id_from(headers, "8.8.4.4", proxies) == "8.8.4.4"
+    assert client_id_from(headers, "192.168.1.20", proxies) == "192.168.1.20"
+    # The left-most hop is whatever the client sent; the right-most untrusted hop is the real peer.
+    assert client_id_from(headers, "10.0.0.5", proxies) == "9.9.9.9"
+    assert client_id_from({"X-Forwarded-For": "10.0.0.9"}, "127.0.0.1", proxies) == "10.0.0.9"
+    assert client_id_from({}, "10.0.0.5", proxies) == "10.0.0.5"
+    assert client_id_from({}, None, proxies) == "unknown"
+    assert client_id_from(headers, "10.0.0.5", []) == "10.0.0.5"
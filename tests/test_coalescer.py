@@ -0,0 +1,46 @@
+import time
+import pytest
+from conftest import parse_sse
+from coalescer import ChunkCoalescer, coalesce
+
+
+def test_flush_due_waits_for_the_max_delay_deadline():
+    coalescer = ChunkCoalescer(min_bytes=1024, max_delay_ms=50, boundaries=False)
+    assert coalescer.push("First chunk. ") == ["First chunk. "]
+    assert coalescer.push("buffered") == []
+
+    assert coalescer.flush_due() is None
+    assert 0 < coalescer.time_to_deadline() <= 0.05
+    time.sleep(0.06)
+    assert coalescer.flush_due() == "buffered"
+    assert coalescer.time_to_deadline() is None
+    assert coalescer.flushes == {"first": 1, "delay": 1}
+
+
+def test_sync_coalesce_reraises_upstream_errors_and_closes_the_iterator():
+    closed = []
+
+    def failing():
+        try:
+            yield "one"
+            raise RuntimeError("upstream failed")
+        finally:
+            closed.append(True)
+
+    with pytest.raises(RuntimeError, match="upstream failed"):
+        list(coalesce(failing(), ChunkCoalescer()))
+    assert closed == [True]
+
+
+def test_stream_readers_flush_on_the_deadline_while_upstream_is_quiet(client, stub):
+    # One token per chunk, 125ms apart: well past the 50ms max delay, but far below min_bytes.
+    stub.chunk_tokens = 1
+    stub.tokens_per_second = 8
+    stub.response_tokens = 4
+    response = client.post("/chat", json={"prompt": "Trickle out slowly", "history": [], "cache": False})
+    frames = parse_sse(response.data)
+
+    answer = [data for _, event, data in frames if event == "message"]
+    # Flushing only when the next chunk arrives would merge every later chunk with its successor.
+    # The stub adds a five-line code block to every answer.
+    assert len(answer) == stub.response_tokens + 5
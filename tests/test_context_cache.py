@@ -0,0 +1,63 @@
+import pytest
+from conftest import parse_sse, wait_for
+
+LONG_INSTRUCTIONS = " ".join(f"Rule {i}: answer precisely and cite the relevant section." for i in range(120))
+
+
+@pytest.fixture
+def context_cache(app_module, monkeypatch):
+    registry = app_module.context_cache
+    monkeypatch.setattr(registry, "min_tokens", 500)
+    return registry
+
+
+def test_later_turns_reuse_the_context_cache(client, context_cache):
+    before = context_cache.stats()
+    first = client.post("/chat", json={"prompt": "First question", "conversation_id": None, "cache": False,
+                                       "system_instruction": LONG_INSTRUCTIONS})
+    conversation_id = first.headers["X-Conversation-Id"]
+    parse_sse(first.data)
+    assert wait_for(lambda: context_cache.stats()["created"] > before["created"])
+
+    for i in range(3):
+        response = client.post("/chat", json={"prompt": f"Follow-up {i}", "conversation_id": conversation_id,
+                                              "cache": False, "system_instruction": LONG_INSTRUCTIONS})
+        assert response.status_code == 200
+        parse_sse(response.data)
+
+    after = context_cache.stats()
+    assert after["hits"] - before["hits"] >= 3
+    assert after["created"] - before["created"] == 1
+    assert after["cached_input_tokens"] > before["cached_input_tokens"]
+
+
+def test_trimmed_session_stops_creating_caches(client, context_cache, app_module, stub, monkeypatch):
+    # The kept history starts one turn later every turn once the budget is reached.
+    monkeypatch.setattr(app_module.context_manager, "default_budget", 3000)
+    monkeypatch.setattr(context_cache, "min_tokens", 1000)
+    stub.response_tokens = 300
+    padding = " ".join(["Some more detail about the question."] * 40)
+
+    def turn(i, conversation_id):
+        response = client.post("/chat", json={"prompt": f"Question {i}: {padding}", "conversation_id": conversation_id,
+                                              "cache": False, "system_instruction": "Be concise."})
+        assert response.status_code == 200
+        parse_sse(response.data)
+        assert wait_for(lambda: context_cache.stats()["pending"] == 0)
+        return response.headers["X-Conversation-Id"], int(response.headers["X-Context-Tokens-Saved"])
+
+    conversation_id, saved = turn(0, None)
+    trimmed_turns = 0
+    for i in range(1, 20):
+        conversation_id, saved = turn(i, conversation_id)
+        trimmed_turns = trimmed_turns + 1 if saved else 0
+        if trimmed_turns == 2:
+            break
+    assert trimmed_turns == 2
+
+    before = context_cache.stats()
+    for i in range(20, 25):
+        turn(i, conversation_id)
+    after = context_cache.stats()
+    assert after["created"] == before["created"]
+    assert after["entries"] == before["entries"]
@@ -0,0 +1,118 @@
+import time
+import asyncio
+import pytest
+from types import SimpleNamespace
+from conftest import wait_for
+
+import endpoints
+from backends import ChatBackend, StubBackend
+from endpoints import Endpoint, EndpointPool, EndpointPoolBackend
+
+CONTENTS = [SimpleNamespace(role="user", parts=[SimpleNamespace(text="Which endpoint answers?")])]
+
+
+class FailingBackend(ChatBackend):
+    """An endpoint that errors before its first chunk."""
+
+    name = "failing"
+
+    def stream(self, model_name, system_instruction, contents, generation_config, safety_settings=None,
+               cached_content=None):
+        raise ConnectionError("endpoint unavailable")
+
+
+def stub_endpoint(name, first_token_delay_ms):
+    return Endpoint("proj", name, {"first_token_delay_ms": first_token_delay_ms, "first_token_jitter_ms": 0,
+                                   "tokens_per_second": 100000, "response_tokens": 20})
+
+
+def pool_backend(pool, backend_for=None):
+    return EndpointPoolBackend(pool, backend_for or (lambda ep: StubBackend(**ep.options)))
+
+
+def answer(backend):
+    return "".join(chunk.text for chunk in backend.stream("gemini-2.0-flash-001", "", CONTENTS, {}))
+
+
+async def aanswer(backend):
+    stream = await backend.stream_async("gemini-2.0-flash-001", "", CONTENTS, {})
+    return "".join([chunk.text async for chunk in stream])
+
+
+def test_routes_to_the_endpoint_with_the_fastest_first_token():
+    slow, fast = stub_endpoint("slow", 80), stub_endpoint("fast", 5)
+    backend = pool_backend(EndpointPool([slow, fast], hedging=False))
+    for _ in range(6):
+        assert answer(backend)
+
+    # Each endpoint is tried once; after that the EWMA keeps every call on the fast one.
+    assert slow.requests == 1
+    assert fast.requests == 5
+    assert fast.ttft_ewma < slow.ttft_ewma
+
+
+def test_fails_over_when_an_endpoint_errors_before_the_first_chunk():
+    broken, healthy = Endpoint("proj", "broken"), stub_endpoint("healthy", 0)
+    backend = pool_backend(EndpointPool([broken, healthy], hedging=False),
+                           lambda ep: FailingBackend() if ep is broken else StubBackend(**ep.options))
+
+    assert answer(backend)
+    assert broken.errors == 1
+    assert healthy.requests == 1 and healthy.errors == 0
+    assert broken.in_flight == healthy.in_flight == 0
+
+
+def test_benches_an_endpoint_after_repeated_errors():
+    broken, healthy = Endpoint("proj", "broken"), stub_endpoint("healthy", 0)
+    pool = EndpointPool([broken, healthy], hedging=False, error_threshold=0.5, cooldown_seconds=60)
+    backend = pool_backend(pool, lambda ep: FailingBackend() if ep is broken else StubBackend(**ep.options))
+
+    # The broken endpoint has no TTFT samples, so it keeps being tried until its error rate benches it.
+    for _ in range(4):
+        assert answer(backend)
+    assert broken.errors == 4
+    assert not broken.healthy(time.monotonic())
+
+    for _ in range(3):
+        assert answer(backend)
+    assert broken.requests == 4
+    assert healthy.requests == 7
+    assert pool.stats()["endpoints"]["proj/broken"]["benched"]
+
+
+def hedging_pool(monkeypatch):
+    monkeypatch.setattr(endpoints, "ENDPOINT_HEDGE_MIN_SAMPLES", 2)
+    # The slow endpoint's history says it is the faster one, so it is the primary.
+    slow, fast = stub_endpoint("slow", 400), stub_endpoint("fast", 5)
+    pool = EndpointPool([slow, fast], hedging=True, hedge_percentile=50, hedge_min_delay_ms=30)
+    pool.first_chunk(slow, 0.01)
+    pool.first_chunk(fast, 0.02)
+    return pool, slow, fast
+
+
+def test_hedges_to_the_next_endpoint_after_the_delay(monkeypatch):
+    pool, slow, fast = hedging_pool(monkeypatch)
+    backend = pool_backend(pool)
+    assert pool.hedge_delay() == pytest.approx(0.03)
+
+    started = time.perf_counter()
+    assert answer(backend)
+    assert time.perf_counter() - started < 0.3
+    assert pool.hedged == 1
+    assert fast.hedges_won == 1
+    # The losing primary is closed once its blocking first read returns.
+    assert wait_for(lambda: slow.in_flight == 0)
+    assert slow.errors == 0
+
+
+def test_hedges_async_streams_and_cancels_the_loser(monkeypatch):
+    pool, slow, fast = hedging_pool(monkeypatch)
+    backend = pool_backend(pool)
+
+    started = time.perf_counter()
+    assert asyncio.run(aanswer(backend))
+    assert time.perf_counter() - started < 0.3
+    assert pool.hedged == 1
+    assert fast.hedges_won == 1
+    assert slow.in_flight == 0
+    assert slow.errors == 0
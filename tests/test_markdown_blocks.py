@@ -0,0 +1,23 @@
+from conftest import parse_sse
+
+
+def test_chat_blocks_mode_streams_block_events(client):
+    response = client.post("/chat", json={"prompt": "Describe the framing of a block stream", "history": [],
+                                          "cache": False, "render": "blocks"})
+    assert response.status_code == 200
+    assert response.headers["X-Render-Mode"] == "blocks"
+    events = {event for _, event, _ in parse_sse(response.data)}
+    assert "message" not in events
+    assert events - {"request"}
+
+
+def test_text_mode_has_no_render_header(client):
+    response = client.post("/chat", json={"prompt": "Describe the framing of a text stream", "history": [],
+                                          "cache": False})
+    assert "X-Render-Mode" not in response.headers
+    assert "message" in {event for _, event, _ in parse_sse(response.data)}
+
+
+def test_unknown_render_mode_is_rejected(client):
+    response = client.post("/chat", json={"prompt": "Hello", "history": [], "render": "pdf"})
+    assert response.status_code == 400
@@ -0,0 +1,38 @@
+from conftest import parse_sse, wait_for
+
+
+def answer_text(frames):
+    return "".join(data for _, event, data in frames if event == "message")
+
+
+def test_chat_rejects_invalid_payloads(client):
+    assert client.post("/chat", data="prompt", content_type="text/plain").status_code == 415
+    assert client.post("/chat", json={"prompt": "", "history": []}).status_code == 400
+    assert client.post("/chat", json={"prompt": "Hello", "history": "not a list"}).status_code == 400
+    assert client.post("/chat", json={"prompt": "Hello", "conversation_id": "not-alphanumeric!"}).status_code == 400
+
+
+def test_session_continues_from_server_held_history(client, app_module):
+    first = client.post("/chat", json={"prompt": "Start a session", "conversation_id": None, "cache": False})
+    assert first.status_code == 200
+    frames = parse_sse(first.data)
+    conversation = [data for _, event, data in frames if event == "conversation"]
+    conversation_id = conversation[0]["conversation_id"]
+    assert first.headers["X-Conversation-Id"] == conversation_id
+
+    session = wait_for(lambda: len(app_module.session_store.get(conversation_id).messages) == 2
+                       and app_module.session_store.get(conversation_id))
+    assert session.messages[0] == {"role": "user", "text": "Start a session"}
+    assert session.messages[1]["text"] == answer_text(frames)
+
+    second = client.post("/chat", json={"prompt": "Continue it", "conversation_id": conversation_id, "cache": False})
+    assert second.status_code == 200
+    assert second.headers["X-Conversation-Id"] == conversation_id
+    assert "conversation" not in {event for _, event, _ in parse_sse(second.data)}
+    assert wait_for(lambda: len(app_module.session_store.get(conversation_id).messages) == 4)
+
+
+def test_unknown_session_asks_for_the_full_history(client):
+    response = client.post("/chat", json={"prompt": "Hello again", "conversation_id": "doesnotexist"})
+    assert response.status_code == 404
+    assert response.get_json()["code"] == "conversation_not_found"
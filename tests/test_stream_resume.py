@@ -0,0 +1,125 @@
+import os
+import pytest
+from conftest import parse_sse, wait_for
+
+
+def post_chat(client, prompt, **payload):
+    payload.setdefault("history", [])
+    payload.setdefault("cache", False)
+    return client.post("/chat", json={"prompt": prompt, **payload})
+
+
+def answer_text(frames):
+    return "".join(data for _, event, data in frames if event == "message")
+
+
+def test_chat_streams_numbered_sse_frames(client):
+    response = post_chat(client, "Describe the framing of a chat stream")
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["X-Request-Id"]
+    assert response.headers["X-Stream-Id"]
+
+    frames = parse_sse(response.data)
+    ids = [event_id for event_id, _, _ in frames]
+    assert ids == list(range(1, len(frames) + 1))
+    assert frames[0][1] == "request"
+    assert frames[0][2]["request_id"] == response.headers["X-Request-Id"]
+    assert answer_text(frames)
+    assert not [frame for frame in frames if frame[1] == "error"]
+
+
+def test_resume_replays_frames_after_last_event_id(client):
+    response = post_chat(client, "Tell me something worth resuming")
+    frames = parse_sse(response.data)
+    stream_id = response.headers["X-Stream-Id"]
+
+    resumed = client.get(f"/chat/stream/{stream_id}", headers={"Last-Event-ID": "2"})
+    assert resumed.status_code == 200
+    assert resumed.headers["X-Stream-Id"] == stream_id
+    assert parse_sse(resumed.data) == frames[2:]
+
+    by_query = client.get(f"/chat/stream/{stream_id}?last_event_id={len(frames)}")
+    assert by_query.status_code == 200
+    assert parse_sse(by_query.data) == []
+
+
+def test_resume_errors(client):
+    assert client.get("/chat/stream/unknown", headers={"Last-Event-ID": "1"}).status_code == 404
+    stream_id = post_chat(client, "Tell me something else").headers["X-Stream-Id"]
+    response = client.get(f"/chat/stream/{stream_id}", headers={"Last-Event-ID": "-3"})
+    assert response.status_code == 400
+    assert response.get_json()["code"] == "invalid_last_event_id"
+
+
+def test_delete_cancels_the_running_stream(client, app_module, stub):
+    stub.tokens_per_second = 20.0
+    stub.chunk_tokens = 1
+    stub.response_tokens = 400
+    response = client.post("/chat", json={"prompt": "Write a very long answer", "history": [], "cache": False},
+                           buffered=False)
+    stream_id = response.headers["X-Stream-Id"]
+    stream_buffer = app_module.stream_registry.get(stream_id)
+    assert wait_for(lambda: stream_buffer.last_event_id >= 3)
+
+    assert client.delete(f"/chat/stream/{stream_id}").status_code == 204
+    assert wait_for(lambda: stream_buffer.done, timeout=3.0)
+    assert stream_buffer.cancel_reason == "client_cancelled"
+    # Well short of the 400 tokens the stub would have generated.
+    assert stream_buffer.last_event_id < 100
+    response.close()
+
+    assert client.delete("/chat/stream/unknown").status_code == 404
+
+
+def test_client_disconnect_cancels_after_the_short_grace(client, app_module, stub, monkeypatch):
+    monkeypatch.setattr(app_module.stream_registry, "disconnect_grace_seconds", 0.2)
+    stub.tokens_per_second = 20.0
+    stub.chunk_tokens = 1
+    stub.response_tokens = 400
+    response = client.post("/chat", json={"prompt": "Write another very long answer", "history": [], "cache": False},
+                           buffered=False)
+    stream_buffer = app_module.stream_registry.get(response.headers["X-Stream-Id"])
+    frames = response.iter_encoded()
+    assert next(frames).startswith(b"id: 1\n")
+    response.close()  # What the server does when writing to a closed connection fails.
+
+    assert wait_for(lambda: stream_buffer.done, timeout=3.0)
+    assert stream_buffer.cancel_reason == "client_disconnected"
+    assert stream_buffer.abandoned
+
+
+@pytest.fixture
+def shared_streams(app_module, monkeypatch):
+    """Turns on the shared level, as under several worker processes."""
+    import stream_buffers
+    monkeypatch.setattr(app_module.shared_state, "enabled", True)
+    monkeypatch.setattr(stream_buffers, "RESUME_CANCEL_POLL_SECONDS", 0.05)
+    return app_module.shared_state
+
+
+def test_stream_on_another_worker(client, shared_streams):
+    shared_streams.put("stream", "elsewhere", {"pid": -1}, 60)
+    response = client.get("/chat/stream/elsewhere", headers={"Last-Event-ID": "1"})
+    assert response.status_code == 409
+    assert response.get_json()["code"] == "stream_on_other_worker"
+
+    assert client.delete("/chat/stream/elsewhere").status_code == 202
+    assert shared_streams.get("stream_cancel", "elsewhere") is True
+
+
+def test_cancel_flag_from_another_worker_stops_the_stream(client, app_module, stub, shared_streams):
+    stub.tokens_per_second = 20.0
+    stub.chunk_tokens = 1
+    stub.response_tokens = 400
+    response = client.post("/chat", json={"prompt": "A long answer cancelled elsewhere", "history": [], "cache": False},
+                           buffered=False)
+    stream_id = response.headers["X-Stream-Id"]
+    stream_buffer = app_module.stream_registry.get(stream_id)
+    assert shared_streams.get("stream", stream_id) == {"pid": os.getpid()}
+
+    # What a DELETE handled by another worker leaves behind.
+    shared_streams.put("stream_cancel", stream_id, True, 60)
+    assert wait_for(lambda: stream_buffer.done, timeout=3.0)
+    assert stream_buffer.cancel_reason == "client_cancelled"
+    response.close()
@@ -0,0 +1,15 @@
+import sys
+from conftest import parse_sse
+
+
+def test_stub_backend_never_touches_the_vertex_sdk(client):
+    response = client.post("/chat", json={"prompt": "No cloud needed", "history": [
+        {"role": "user", "text": "Hello"}, {"role": "model", "text": "Hi, how can I help?"}], "cache": False})
+    assert response.status_code == 200
+    assert not [frame for frame in parse_sse(response.data) if frame[1] == "error"]
+    titled = client.post("/name_chat", json={"chat_history": [{"role": "user", "text": "No cloud needed"}]})
+    assert titled.status_code == 200
+
+    assert client.get("/readyz").status_code == 200
+    # Importing the SDK would also run vertexai.init, which needs GOOGLE_PROJECT_ID and GOOGLE_LOCATION.
+    assert "vertexai" not in sys.modules
@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+import urllib.request
+from contextlib import contextmanager
+
+# Per-request span tracing.
+# When a reply was slow there was no way to tell where the time went: JSON parsing, converting
+# history into Content objects, building the model handle, waiting for Vertex's first chunk,
+# chunk-processing errors or SSE writes. A trace is started per /chat and /name_chat request,
+# and code along the way opens named spans with tracing.span(); the current trace and span
+# travel in contextvars, and ChatRequest rebinds them on the thread or task that streams.
+#
+# Sampling happens at the tail, once the request is over: failed requests, requests slower than
+# TRACE_SLOW_MS and requests marked with Trace.keep() (a slow first chunk) are always exported,
+# the rest at TRACE_SAMPLE_RATE. Kept traces go onto a bounded queue that a background thread
+# drains into a JSONL file (TRACE_FILE) and/or an OTLP/HTTP JSON collector (TRACE_OTLP_ENDPOINT,
+# e.g. http://localhost:4318/v1/traces), so exporting never blocks a request. An incoming W3C
+# traceparent header continues the caller's trace.
+
+TRACING = os.getenv("TRACING", "1") != "0"
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "traces.jsonl"))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "zorofinal")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "30000"))
+TRACE_SLOW_FIRST_CHUNK_MS = float(os.getenv("TRACE_SLOW_FIRST_CHUNK_MS", "3000"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "256"))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "1000"))
+TRACE_EXPORT_BATCH = 50
+TRACE_OTLP_TIMEOUT_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+_trace_var = contextvars.ContextVar("trace", default=None)
+_span_var = contextvars.ContextVar("span", default=None)
+
+
+def _new_id(hex_chars: int):
+    return f"{random.getrandbits(hex_chars * 4):0{hex_chars}x}"
+
+
+def parse_traceparent(header: str):
+    """Returns (trace id, parent span id) from a W3C traceparent header, or (None, None)."""
+    parts = (header or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None, None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None, None
+    return parts[1], parts[2]
+
+
+class Span:
+    """One timed operation in a trace."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "end", "attributes", "events", "error")
+
+    def __init__(self, trace, name: str, parent_id: str = None, start: float = None, attributes: dict = None):
+        self.trace = trace
+        self.span_id = _new_id(16)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.attributes = dict(attributes) if attributes else {}
+        self.events = []
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def event(self, name: str, **attributes):
+        """Records a point-in-time event, e.g. an exception that was handled."""
+        if len(self.events) < TRACE_MAX_SPANS:
+            self.events.append((time.time(), name, attributes))
+
+    def fail(self, error):
+        # Only the span: whether the request failed is decided by whoever finishes the trace.
+        self.error = str(error) or type(error).__name__
+
+    def finish(self, end: float = None):
+        if self.end is None:
+            self.end = end if end is not None else time.time()
+
+    def to_dict(self, origin: float):
+        body = {"span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start_ms": round((self.start - origin) * 1000, 3),
+                "duration_ms": round(((self.end or time.time()) - self.start) * 1000, 3)}
+        if self.attributes:
+            body["attributes"] = self.attributes
+        if self.events:
+            body["events"] = [{"name": name, "at_ms": round((at - origin) * 1000, 3), **attrs} for at, name, attrs in self.events]
+        if self.error:
+            body["error"] = self.error
+        return body
+
+
+class Trace:
+    """The spans of one request, exported as a unit once the request is over."""
+
+    def __init__(self, name: str, request_id: str = None, traceparent: str = None, **attributes):
+        trace_id, parent_id = parse_traceparent(traceparent)
+        self.trace_id = trace_id or _new_id(32)
+        self.request_id = request_id
+        self.error = None
+        self.keep_reasons = []
+        self.finished = False
+        self.spans = []
+        self.dropped_spans = 0
+        self._lock = threading.Lock()
+        self.root = self._add(Span(self, name, parent_id, attributes=attributes))
+
+    def _add(self, span: Span):
+        with self._lock:
+            if self.finished or len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped_spans += 1
+            else:
+                self.spans.append(span)
+        return span
+
+    def start_span(self, name: str, parent: Span = None, **attributes):
+        return self._add(Span(self, name, (parent or self.root).span_id, attributes=attributes))
+
+    def record_span(self, name: str, start: float, end: float, parent: Span = None, **attributes):
+        """Adds an already-measured span, e.g. time accumulated over many SSE writes."""
+        span = self._add(Span(self, name, (parent or self.root).span_id, start, attributes))
+        span.finish(end)
+        return span
+
+    def keep(self, reason: str):
+        """Exports this trace whatever the sampling rate."""
+        self.keep_reasons.append(reason)
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.root.span_id}-01"
+
+    def finish(self, error: str = None):
+        """Ends the root span and hands the trace to the exporter if tail sampling keeps it."""
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+        if error:
+            self.error = self.root.error = self.error or error
+        self.root.finish()
+        if _trace_var.get() is self:
+            _trace_var.set(None)
+            _span_var.set(None)
+        exporter.offer(self)
+
+    def sample_reason(self):
+        if self.error:
+            return "error"
+        if (self.root.end - self.root.start) * 1000 >= TRACE_SLOW_MS:
+            return "slow"
+        if self.keep_reasons:
+            return self.keep_reasons[0]
+        if random.random() < TRACE_SAMPLE_RATE:
+            return "sampled"
+        return None
+
+    def to_dict(self, reason: str):
+        with self._lock:
+            spans = list(self.spans)
+        origin = self.root.start
+        return {"trace_id": self.trace_id, "request_id": self.request_id, "name": self.root.name,
+                "start": round(origin, 6), "duration_ms": round((self.root.end - origin) * 1000, 3),
+                "error": self.error, "kept": reason, "dropped_spans": self.dropped_spans,
+                "spans": [span.to_dict(origin) for span in spans]}
+
+
+def start_trace(name: str, request_id: str = None, traceparent: str = None, **attributes):
+    """
+    Starts a request's trace and makes it current.
+
+    Returns:
+        Trace: The trace, or None when tracing is off.
+    """
+    if not TRACING or not exporter.enabled:
+        return None
+    trace = Trace(name, request_id, traceparent, **attributes)
+    bind(trace)
+    return trace
+
+
+def bind(trace: Trace, parent: Span = None):
+    """
+    Makes a trace current in this thread or task, e.g. in the thread that streams a response.
+
+    Args:
+        parent (Span, optional): Span that new spans nest under; defaults to the root span.
+    """
+    _trace_var.set(trace)
+    _span_var.set((parent or trace.root) if trace else None)
+
+
+def current_trace():
+    return _trace_var.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Times the enclosed block as a child of the current span; a no-op outside a trace.
+
+    An exception leaving the block marks the span as failed, then propagates.
+    """
+    trace = _trace_var.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, _span_var.get(), **attributes)
+    token = _span_var.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            current.fail(e)
+        raise
+    finally:
+        current.finish()
+        _span_var.reset(token)
+
+
+def start_span(name: str, **attributes):
+    """
+    Opens a child of the current span without making it current; the caller finishes it.
+
+    For phases that span a generator's yields, where a context manager cannot be used.
+
+    Returns:
+        Span: The span, or None outside a trace.
+    """
+    trace = _trace_var.get()
+    if trace is None:
+        return None
+    return trace.start_span(name, _span_var.get(), **attributes)
+
+
+def add_event(name: str, **attributes):
+    """Adds an event to the current span, if any."""
+    current = _span_var.get()
+    if current is not None:
+        current.event(name, **attributes)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def otlp_payload(traces: list):
+    """Builds an OTLP/HTTP JSON ExportTraceServiceRequest for finished traces."""
+    spans = []
+    for trace in traces:
+        with trace._lock:
+            trace_spans = list(trace.spans)
+        for item in trace_spans:
+            attributes = dict(item.attributes)
+            if item is trace.root and trace.request_id:
+                attributes["request_id"] = trace.request_id
+            body = {
+                "traceId": trace.trace_id, "spanId": item.span_id, "name": item.name,
+                "kind": 2 if item is trace.root else 1,  # SERVER for the request, INTERNAL below it.
+                "startTimeUnixNano": str(int(item.start * 1e9)),
+                "endTimeUnixNano": str(int((item.end or item.start) * 1e9)),
+                "attributes": _otlp_attributes(attributes),
+                "status": {"code": 2, "message": item.error} if item.error else {"code": 0},
+            }
+            if item.parent_id:
+                body["parentSpanId"] = item.parent_id
+            if item.events:
+                body["events"] = [{"timeUnixNano": str(int(at * 1e9)), "name": name, "attributes": _otlp_attributes(attrs)}
+                                  for at, name, attrs in item.events]
+            spans.append(body)
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME})},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+    }]}
+
+
+class TraceExporter:
+    """Tail-samples finished traces and writes them out on a background thread."""
+
+    def __init__(self, path: str = TRACE_FILE, otlp_endpoint: str = TRACE_OTLP_ENDPOINT):
+        self.path = path or None
+        self.otlp_endpoint = otlp_endpoint or None
+        self.enabled = bool(self.path or self.otlp_endpoint)
+        self.finished = 0
+        self.kept = {}
+        self.dropped = 0
+        self.exported = 0
+        self.export_errors = 0
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # The exporter thread does not survive fork(); a worker starts its own on first use.
+        self._queue = queue.Queue(TRACE_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def offer(self, trace: Trace):
+        self.finished += 1
+        reason = trace.sample_reason()
+        if reason is None:
+            return
+        self.kept[reason] = self.kept.get(reason, 0) + 1
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((trace, reason))
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < TRACE_EXPORT_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.export_errors += 1
+                logger.warning("Trace export failed: %s", e, extra={"traces": len(batch)})
+
+    def export(self, batch: list):
+        """Writes (trace, sample reason) pairs to the configured exporters."""
+        if self.path:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            lines = "".join(json.dumps(trace.to_dict(reason), default=str) + "\n" for trace, reason in batch)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+        if self.otlp_endpoint:
+            body = json.dumps(otlp_payload([trace for trace, _ in batch])).encode("utf-8")
+            request = urllib.request.Request(self.otlp_endpoint, data=body, headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=TRACE_OTLP_TIMEOUT_SECONDS) as response:
+                response.read()
+
+    def stats(self):
+        return {"enabled": TRACING and self.enabled, "file": self.path, "otlp_endpoint": self.otlp_endpoint,
+                "sample_rate": TRACE_SAMPLE_RATE, "finished": self.finished, "kept": dict(self.kept),
+                "queued": self._queue.qsize(), "dropped": self.dropped, "exported": self.exported,
+                "export_errors": self.export_errors}
+
+
+exporter = TraceExporter()
@@ -0,0 +1,170 @@
+import os
+import time
+import logging
+import threading
+from dotenv import load_dotenv
+
+# Lazy, once-per-process Vertex AI initialization.
+# Importing the SDK takes seconds and vertexai.init used to run (and raise) at import time in
+# both chatbot.py and name_chat.py. Modules now call generative_models() when they first need
+# the SDK; the import and init happen once, are timed, and can be done ahead of traffic by a
+# background pre-warm that also opens the model connections. Under the pre-fork server the
+# parent never initializes the SDK; each worker does, after the fork (gunicorn.conf.py).
+# With CHAT_BACKEND=stub nothing reaches Vertex, so the SDK is never imported or initialized:
+# conversations are built from the plain Content/Part classes below, and the tests and the SSE
+# load generator run without GOOGLE_PROJECT_ID, GOOGLE_LOCATION or credentials.
+
+load_dotenv()
+
+SDK_FREE = os.getenv("CHAT_BACKEND", "vertex") == "stub"
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_generative_models = None
+_state = {
+    "pid": None,
+    "initialized": False,
+    "error": None,
+    "import_seconds": None,
+    "init_seconds": None,
+    "prewarm": {},  # name -> None while running, then True/False
+}
+
+
+def _reset_after_fork():
+    # The SDK's channels belong to the parent, and a lock held by one of its threads would never
+    # be released here; the pid check then re-runs init on first use in this process.
+    global _lock
+    _lock = threading.Lock()
+    _state["prewarm"] = {}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def ensure_initialized():
+    """
+    Imports the SDK and runs vertexai.init once per process.
+
+    Re-runs after a fork so each worker process owns its own SDK state.
+
+    Raises:
+        ValueError: If GOOGLE_PROJECT_ID or GOOGLE_LOCATION is missing.
+    """
+    global _generative_models
+    if _state["initialized"] and _state["pid"] == os.getpid():
+        return
+    with _lock:
+        if _state["initialized"] and _state["pid"] == os.getpid():
+            return
+        started = time.perf_counter()
+        import vertexai
+        from vertexai import generative_models
+        imported = time.perf_counter()
+        try:
+            project_id = os.getenv("GOOGLE_PROJECT_ID")
+            location = os.getenv("GOOGLE_LOCATION")
+            if (not project_id or not location) and os.getenv("VERTEX_ENDPOINTS"):
+                # Default to the first pooled endpoint; calls address their endpoint by resource name.
+                project_id, _, location = os.getenv("VERTEX_ENDPOINTS").split(",")[0].split("?")[0].partition(":")
+            if not project_id or not location:
+                raise ValueError("GOOGLE_PROJECT_ID and GOOGLE_LOCATION must be set in .env file")
+            vertexai.init(project=project_id, location=location)
+        except Exception as e:
+            logger.error("Error initializing Vertex AI: %s", e)
+            _state["error"] = str(e)
+            raise
+        _generative_models = generative_models
+        _state.update(pid=os.getpid(), initialized=True, error=None,
+                      import_seconds=round(imported - started, 4),
+                      init_seconds=round(time.perf_counter() - imported, 4))
+        logger.info("Vertex AI initialized for project: %s in location: %s", project_id, location,
+                    extra={"import_seconds": _state["import_seconds"], "init_seconds": _state["init_seconds"]})
+
+
+def generative_models():
+    """Returns the vertexai.generative_models module, initializing the SDK on first use."""
+    if _generative_models is None or _state["pid"] != os.getpid():
+        ensure_initialized()
+    return _generative_models
+
+
+def caching():
+    """Returns the vertexai.preview.caching module, initializing the SDK on first use."""
+    generative_models()
+    from vertexai.preview import caching as caching_module
+    return caching_module
+
+
+class Part:
+    """SDK-free stand-in for a text generative_models.Part."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class Content:
+    """SDK-free stand-in for generative_models.Content, used when SDK_FREE."""
+
+    def __init__(self, role: str, parts: list):
+        self.role = role
+        self.parts = parts
+
+
+def content_class():
+    """Returns the class make_content builds: the SDK's Content, or the stand-in when SDK_FREE."""
+    return Content if SDK_FREE else generative_models().Content
+
+
+def make_content(role: str, text: str):
+    """Builds a single-part text Content object."""
+    if SDK_FREE:
+        return Content(role, [Part(text)])
+    gm = generative_models()
+    return gm.Content(role=role, parts=[gm.Part.from_text(text)])
+
+
+def run_prewarm(warmups: dict):
+    """
+    Initializes the SDK and runs each warmup callable, recording which backends are warm.
+
+    Args:
+        warmups (dict): name -> callable returning True when that backend answered.
+    """
+    try:
+        if not SDK_FREE:
+            ensure_initialized()
+    except Exception:
+        return
+    for name, warmup in warmups.items():
+        try:
+            _state["prewarm"][name] = bool(warmup())
+        except Exception as e:
+            logger.warning("Pre-warm '%s' failed: %s", name, e, exc_info=True)
+            _state["prewarm"][name] = False
+
+
+def start_prewarm(warmups: dict):
+    """Runs run_prewarm on a daemon thread so startup never waits on the network."""
+    for name in warmups:
+        _state["prewarm"].setdefault(name, None)
+    threading.Thread(target=run_prewarm, args=(warmups,), name="vertex-prewarm", daemon=True).start()
+
+
+def is_ready():
+    """Ready once the SDK is initialized (unless SDK_FREE) and every registered warmup has succeeded."""
+    if not SDK_FREE and not (_state["initialized"] and _state["pid"] == os.getpid()):
+        return False
+    return all(_state["prewarm"].values())
+
+
+def status():
+    return {
+        "initialized": _state["initialized"] and _state["pid"] == os.getpid(),
+        "error": _state["error"],
+        "sdk_import_seconds": _state["import_seconds"],
+        "sdk_init_seconds": _state["init_seconds"],
+        "prewarm": dict(_state["prewarm"]),
+    }